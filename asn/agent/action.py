@@ -1,7 +1,14 @@
 import json
+import asyncio
 from datetime import datetime
+from typing import Optional
 from asn.llm.llm import LLMManager, get_sft
+from asn.llm.retry import LLMUnavailableError
 from asn.llm.prompt import Prompts
+from asn.llm.assembly import assemble_prompt
+from asn.llm.schema import REACT_SCHEMA, POST_SCHEMA, reacts_schema, get_fallback_stats
+from asn.llm.stream import react_stop, reacts_stop, post_stop
+from asn.llm.budget import PromptTooLongError, get_prompt_budget
 from asn.utils.logger import get_logger
 
 
@@ -29,122 +36,242 @@ class Act:
         act = Act(dict["type"], dict["text"], datetime.strptime(dict["timestamp"], "%Y-%m-%d %H:%M:%S"))
         return act
     
+def parse_react_result(result: str):
+    result = result.strip("`|json| ")
+    action = json.loads(result)
+    get_logger().info(f"Parsed actions: {action}")
+    return action
+
+def parse_reacts_result(result: str):
+    result = result.strip("`|json| ")
+    actions = json.loads(result)
+    get_logger().info(f"Parsed actions: {actions}")
+    return actions
+
+def parse_post(result: str):
+    result = result.strip("`|json| ")
+    posts = [json.loads(result)]
+    posts = [post["Post"] for post in posts if "no post" not in post["Post"].lower()]
+    get_logger().info(f"Parsed posts: {posts}")
+    return posts
+
+def acts_from_action(action: dict, post: dict, now: datetime):
+    acts: list[Act] = []
+    acts.append(Act("read", post["text"], now))
+    if action["Like"].lower() == "yes":
+        acts.append(Act("like", post["text"], now))
+    if action["Repost"].lower() == "yes":
+        acts.append(Act("retweet", post["text"], now))
+    return acts
+
+def format_memories(memories_retrieved: list):
+    return "\n".join(["{idx}. {memory}".format(idx=i+1, memory=memory) for i, memory in enumerate(memories_retrieved)])
+
+
 class ActionModule:
+    # 批量反应时每次请求中的帖子数
+    batch_size = 10
+
     def __init__(self):
         self.llm = LLMManager.get_llm()
         embed_size, self.embed_model = LLMManager.get_embed_model()
 
-    def react_to_post(self, post: dict, memories_retrieved: list, characteristics: str, now: datetime, extra_experience=None, log=None):
-        def parse_react_result(result: str):
-            result = result.strip("`|json| ")
-            action = json.loads(result)
-            get_logger().info(f"Parsed actions: {action}")
-            return action
-        try:
-            prompt_sys = Prompts.react_system.format(characteristics=characteristics)
-            prompt = Prompts.react.format(timestamp=datetime.strftime(now, "%y-%m-%d %H:%M"), memories="\n".join(["{idx}. {memory}".format(idx=i+1, memory=memory) for i, memory in enumerate(memories_retrieved)]), post=post)
+    def _react_prompt(self, post: dict, memories_retrieved: list, characteristics: str, now: datetime, extra_experience=None):
+        instructions, persona = Prompts.react_system.format(), Prompts.persona.format(characteristics=characteristics)
+
+        def render(extra_experience, memories):
+            prompt = Prompts.react.format(timestamp=datetime.strftime(now, "%y-%m-%d %H:%M"), memories=format_memories(memories), post=post)
             if extra_experience is not None:
                 prompt += "\n" + "There are some examples:\n" + extra_experience
-            response = self.llm._call(prompt=prompt, prompt_sys=prompt_sys, sft=get_sft())
-            if log is not None:
-                log.append({
-                    "prompt": prompt,
-                    "response": response
-                })
-            action = parse_react_result(response)
-        except Exception as e:
-            get_logger().debug(f"Error in invoking chain_react: {e} \n\n post={post}, memories={memories_retrieved}, characteristics={characteristics}")
-            action = {"Like": "No", "Repost": "No"}
-        acts: list[Act] = []
-        acts.append(Act("read", post["text"], now))
-        if action["Like"].lower() == "yes":
-            acts.append(Act("like", post["text"], now))
-        if action["Repost"].lower() == "yes":
-            acts.append(Act("retweet", post["text"], now))
+            return prompt
+        # 超出上下文长度时先去掉示例，再从最不相关的记忆开始去掉
+        prompt = get_prompt_budget().fit("react", instructions + persona, render, extra_experience=extra_experience, memories=list(memories_retrieved))
+        return assemble_prompt("react", instructions, persona, prompt)
+
+    def _reacts_prompt(self, posts: list, memories_retrieved: list, characteristics: str, now: datetime, extra_experience=None):
+        instructions, persona = Prompts.reacts_system.format(), Prompts.persona.format(characteristics=characteristics)
+
+        def render(extra_experience, memories):
+            prompt = Prompts.reacts.format(timestamp=datetime.strftime(now, "%y-%m-%d %H:%M"), memories=format_memories(memories), posts="\n".join(["{idx}. {post}".format(idx=i+1, post=post) for i, post in enumerate(posts)]))
+            if extra_experience is not None:
+                prompt += "\n" + "There are some examples:\n" + extra_experience
+            return prompt
+        # 帖子不在这里裁剪，仍然放不下时由 react_to_posts 拆成更小的批次
+        prompt = get_prompt_budget().fit("reacts", instructions + persona, render, extra_experience=extra_experience, memories=list(memories_retrieved))
+        return assemble_prompt("reacts", instructions, persona, prompt)
+
+    def _post_prompt(self, memories_retrieved: list, characteristics: str, previous_posts: list, now: datetime, force=False, extra_experience=None):
+        instructions, persona = Prompts.post_system.format(), Prompts.persona.format(characteristics=characteristics)
+
+        def render(extra_experience, memories, newest_posts):
+            if len(newest_posts):
+                previous_posts_text = "\n".join(["{idx}. {post}".format(idx=i+1, post=post) for i, post in enumerate(newest_posts[::-1])])
+            else:
+                previous_posts_text = "No previous posts"
+            memories_text = format_memories(memories)
+            prompt = Prompts.post.format(timestamp=datetime.strftime(now, "%Y-%m-%d %H:%M"), memories=memories_text, previous_posts=previous_posts_text)
+            if force:
+                prompt = Prompts.post_force.format(timestamp=datetime.strftime(now, "%Y-%m-%d %H:%M"), memories=memories_text, previous_posts=previous_posts_text)
+            if extra_experience is not None:
+                prompt += "\n" + "There are some examples:\n" + extra_experience
+            return prompt
+        # previous_posts 按时间从旧到新排列，倒序传入使得最早的帖子最先被去掉
+        prompt = get_prompt_budget().fit("post", instructions + persona, render, extra_experience=extra_experience, memories=list(memories_retrieved), newest_posts=list(previous_posts)[::-1])
+        return assemble_prompt("post", instructions, persona, prompt)
+
+    def _react_result(self, post: dict, now: datetime, prompt: str, response: str, log=None):
+        # 同步和异步调用共用：记录日志并解析反应，解析失败时抛出异常
+        if log is not None:
+            log.append({
+                "prompt": prompt,
+                "response": response
+            })
+        action = parse_react_result(response)
+        acts = acts_from_action(action, post, now)
+        get_fallback_stats().record("react", False)
         return acts
-    
+
+    def _react_fallback(self, error: Exception, post: dict, memories_retrieved: list, characteristics: str, now: datetime):
+        if isinstance(error, (LLMUnavailableError, PromptTooLongError)):
+            get_logger().error(f"Error in invoking chain_react: {error}")
+        else:
+            get_logger().debug(f"Error in invoking chain_react: {error} \n\n post={post}, memories={memories_retrieved}, characteristics={characteristics}")
+            get_fallback_stats().record("react", True)
+        return acts_from_action({"Like": "No", "Repost": "No"}, post, now)
+
+    def react_to_post(self, post: dict, memories_retrieved: list, characteristics: str, now: datetime, extra_experience=None, log=None):
+        try:
+            prompt_sys, prompt = self._react_prompt(post, memories_retrieved, characteristics, now, extra_experience)
+            response = self.llm._call(prompt=prompt, prompt_sys=prompt_sys, sft=get_sft(), call_site="react", schema=REACT_SCHEMA, stop_when=react_stop())
+            return self._react_result(post, now, prompt, response, log)
+        except Exception as e:
+            return self._react_fallback(e, post, memories_retrieved, characteristics, now)
+
+    async def areact_to_post(self, post: dict, memories_retrieved: list, characteristics: str, now: datetime, extra_experience=None, log=None):
+        try:
+            prompt_sys, prompt = self._react_prompt(post, memories_retrieved, characteristics, now, extra_experience)
+            response = await self.llm._acall(prompt=prompt, prompt_sys=prompt_sys, sft=get_sft(), call_site="react", schema=REACT_SCHEMA, stop_when=react_stop())
+            return self._react_result(post, now, prompt, response, log)
+        except Exception as e:
+            return self._react_fallback(e, post, memories_retrieved, characteristics, now)
+
+    def _reacts_result(self, posts: list, now: datetime, prompt: str, response: str, log=None):
+        actions = parse_reacts_result(response)
+        if len(actions) != len(posts):
+            raise ValueError("actions length not equal to posts length: %d != %d" % (len(actions), len(posts)))
+        if log is not None:
+            log.append({
+                "prompt": prompt,
+                "response":response
+            })
+        get_fallback_stats().record("reacts", False)
+        return [acts_from_action(action, post, now) for action, post in zip(actions, posts)]
+
+    def _reacts_fallback(self, error: Exception, posts: list, response: Optional[str], memories_retrieved: list, characteristics: str, now: datetime):
+        """Acts for a failed batch, or None if the posts should be retried one by one. PromptTooLongError is handled by the caller."""
+        if isinstance(error, LLMUnavailableError):
+            # 服务器不可用时逐个重试只会放大请求量，直接按未互动处理
+            get_logger().error(f"Error in invoking chain_reacts: {error}")
+            return [acts_from_action({"Like": "No", "Repost": "No"}, post, now) for post in posts]
+        get_logger().debug(f"Error in invoking chain_reacts: {error} \n\n posts={posts}, memories={memories_retrieved}, characteristics={characteristics}")
+        get_fallback_stats().record("reacts", True)
+        if self.llm.structured_output:
+            # 约束解码下仍然解析失败时，逐个重试多半同样失败，只会放大请求量，按未互动处理
+            return [acts_from_action({"Like": "No", "Repost": "No"}, post, now) for post in posts]
+        get_logger().debug(f"Response: {response} Retry with chain_react")
+        return None
+
     def react_to_posts(self, posts: list, memories_retrieved: list, characteristics: str, now: datetime, extra_experience=None, log=None):
-        def parse_reacts_result(result: str):
-            result = result.strip("`|json| ")
-            actions = json.loads(result)
-            get_logger().info(f"Parsed actions: {actions}")
-            return actions
         # 将posts分批处理
-        def react_to_posts_batch(posts: list, memories_retrieved: list, characteristics: str, now: datetime, extra_experience=None, log=None):
-            acts: list[list[Act]] = [[] for _ in posts]
+        def react_to_posts_batch(posts: list):
+            response = None
             try:
-                prompt_sys = Prompts.reacts_system.format(characteristics=characteristics)
-                prompt = Prompts.reacts.format(timestamp=datetime.strftime(now, "%y-%m-%d %H:%M"), memories="\n".join(["{idx}. {memory}".format(idx=i+1, memory=memory) for i, memory in enumerate(memories_retrieved)]), posts="\n".join(["{idx}. {post}".format(idx=i+1, post=post) for i, post in enumerate(posts)]))
-                if extra_experience is not None:
-                    prompt += "\n" + "There are some examples:\n" + extra_experience
-                response = self.llm._call(prompt=prompt, prompt_sys=prompt_sys, sft=get_sft())
-                actions = parse_reacts_result(response)
-                if len(actions) != len(posts):
-                    get_logger().debug("Error in invoking chain_reacts: actions length not equal to posts length: %d != %d" % (len(actions), len(posts)))
-                    return None
-                if log is not None:
-                    log.append({
-                        "prompt": prompt,
-                        "response":response
-                    })
-                for i, action in enumerate(actions):
-                    post = posts[i]
-                    acts[i].append(Act("read", post["text"], now))
-                    if action["Like"].lower() == "yes":
-                        acts[i].append(Act("like", post["text"], now))
-                    if action["Repost"].lower() == "yes":
-                        acts[i].append(Act("retweet", post["text"], now))
-                return acts
+                prompt_sys, prompt = self._reacts_prompt(posts, memories_retrieved, characteristics, now, extra_experience)
+                response = self.llm._call(prompt=prompt, prompt_sys=prompt_sys, sft=get_sft(), call_site="reacts", schema=reacts_schema(len(posts)), stop_when=reacts_stop(len(posts)))
+                return self._reacts_result(posts, now, prompt, response, log)
+            except PromptTooLongError as e:
+                # 放不进上下文时拆成两个更小的批次
+                get_logger().debug(f"Error in invoking chain_reacts: {e}")
+                if len(posts) == 1:
+                    return [acts_from_action({"Like": "No", "Repost": "No"}, posts[0], now)]
+                half = len(posts) // 2
+                return react_to_posts_batch(posts[:half]) + react_to_posts_batch(posts[half:])
             except Exception as e:
-                get_logger().debug(f"Error in invoking chain_reacts: {e} \n\n posts={posts}, memories={memories_retrieved}, characteristics={characteristics}")
-                get_logger().debug(f"Response: {response} Retry with chain_react")
+                acts = self._reacts_fallback(e, posts, response, memories_retrieved, characteristics, now)
+                if acts is not None:
+                    return acts
                 # 批量处理失败，逐个处理
-                for i, post in enumerate(posts):
-                    acts[i] = self.react_to_post(post, memories_retrieved, characteristics, now, extra_experience, log)
-                return acts
-            
-        batch_size = 10
+                return [self.react_to_post(post, memories_retrieved, characteristics, now, extra_experience, log) for post in posts]
+
         acts = []
-        for i in range(0, len(posts), batch_size):
-            posts_batch = posts[i:i + batch_size]
-            acts_batch = react_to_posts_batch(posts_batch, memories_retrieved, characteristics, now, extra_experience, log)
+        for i in range(0, len(posts), self.batch_size):
+            posts_batch = posts[i:i + self.batch_size]
+            acts_batch = react_to_posts_batch(posts_batch)
             if acts_batch is None:
                 return None
             acts.extend(acts_batch)
         return acts
 
-    def write_post(self, memories_retrieved: list, characteristics: str, previous_posts: list, now: datetime, force=False, extra_experience=None, log=None):
-        def parse_post(result: str):
-            result = result.strip("`|json| ")
-            posts = [json.loads(result)]
-            posts = [post["Post"] for post in posts if "no post" not in post["Post"].lower()]
-            get_logger().info(f"Parsed posts: {posts}")
-            return posts
-        
-        if len(previous_posts):
-            previous_posts = "\n".join(["{idx}. {post}".format(idx=i+1, post=post) for i, post in enumerate(previous_posts)])
-        else:
-            previous_posts = "No previous posts"
-        memories_text = "\n".join(["{idx}. {memory}".format(idx=i+1, memory=memory) for i, memory in enumerate(memories_retrieved)])
-        # try:
-        prompt_sys = Prompts.post_system.format(characteristics=characteristics)
-        prompt = Prompts.post.format(timestamp=datetime.strftime(now, "%Y-%m-%d %H:%M"), memories=memories_text, previous_posts=previous_posts)
-        if force:
-            prompt = Prompts.post_force.format(timestamp=datetime.strftime(now, "%Y-%m-%d %H:%M"), memories=memories_text, previous_posts=previous_posts)
-        if extra_experience is not None:
-            prompt += "\n" + "There are some examples:\n" + extra_experience
-        response = self.llm._call(prompt=prompt, prompt_sys=prompt_sys, sft=get_sft())
+    async def areact_to_posts(self, posts: list, memories_retrieved: list, characteristics: str, now: datetime, extra_experience=None, log=None):
+        async def react_to_posts_batch(posts: list):
+            response = None
+            try:
+                prompt_sys, prompt = self._reacts_prompt(posts, memories_retrieved, characteristics, now, extra_experience)
+                response = await self.llm._acall(prompt=prompt, prompt_sys=prompt_sys, sft=get_sft(), call_site="reacts", schema=reacts_schema(len(posts)), stop_when=reacts_stop(len(posts)))
+                return self._reacts_result(posts, now, prompt, response, log)
+            except PromptTooLongError as e:
+                get_logger().debug(f"Error in invoking chain_reacts: {e}")
+                if len(posts) == 1:
+                    return [acts_from_action({"Like": "No", "Repost": "No"}, posts[0], now)]
+                half = len(posts) // 2
+                first, second = await asyncio.gather(react_to_posts_batch(posts[:half]), react_to_posts_batch(posts[half:]))
+                return first + second
+            except Exception as e:
+                acts = self._reacts_fallback(e, posts, response, memories_retrieved, characteristics, now)
+                if acts is not None:
+                    return acts
+                # 批量处理失败，逐个处理（并发）
+                return list(await asyncio.gather(*[self.areact_to_post(post, memories_retrieved, characteristics, now, extra_experience, log) for post in posts]))
+
+        # 各批次之间相互独立，并发发出
+        acts_batches = await asyncio.gather(*[react_to_posts_batch(posts[i:i + self.batch_size]) for i in range(0, len(posts), self.batch_size)])
+        acts = []
+        for acts_batch in acts_batches:
+            if acts_batch is None:
+                return None
+            acts.extend(acts_batch)
+        return acts
+
+    def _post_result(self, now: datetime, prompt: str, response: str, log=None):
         if log is not None:
             log.append({
                 "prompt": prompt,
                 "response": response
             })
-        posts = parse_post(response)
-        acts = []
-        for post in posts:
-            acts.append(Act("post", post, now))
-        return acts
-        # except Exception as e:
-        #     get_logger().debug(f"Error in invoking chain_post: {e} \n\n memories={memories_retrieved}, characteristics={characteristics}")
-        #     # 处理失败，返回空列表
-        #     return []
+        try:
+            posts = parse_post(response)
+        except Exception as e:
+            # 与原来一致，解析失败时抛出异常，由调用方处理
+            get_logger().debug(f"Error in invoking chain_post: {e} \n\n response={response}")
+            get_fallback_stats().record("post", True)
+            raise
+        get_fallback_stats().record("post", False)
+        return [Act("post", post, now) for post in posts]
+
+    def write_post(self, memories_retrieved: list, characteristics: str, previous_posts: list, now: datetime, force=False, extra_experience=None, log=None):
+        try:
+            prompt_sys, prompt = self._post_prompt(memories_retrieved, characteristics, previous_posts, now, force, extra_experience)
+            response = self.llm._call(prompt=prompt, prompt_sys=prompt_sys, sft=get_sft(), call_site="post", schema=POST_SCHEMA, stop_when=post_stop())
+        except (LLMUnavailableError, PromptTooLongError) as e:
+            get_logger().error(f"Error in invoking chain_post: {e}")
+            return []
+        return self._post_result(now, prompt, response, log)
+
+    async def awrite_post(self, memories_retrieved: list, characteristics: str, previous_posts: list, now: datetime, force=False, extra_experience=None, log=None):
+        try:
+            prompt_sys, prompt = self._post_prompt(memories_retrieved, characteristics, previous_posts, now, force, extra_experience)
+            response = await self.llm._acall(prompt=prompt, prompt_sys=prompt_sys, sft=get_sft(), call_site="post", schema=POST_SCHEMA, stop_when=post_stop())
+        except (LLMUnavailableError, PromptTooLongError) as e:
+            get_logger().error(f"Error in invoking chain_post: {e}")
+            return []
+        return self._post_result(now, prompt, response, log)
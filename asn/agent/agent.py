@@ -5,6 +5,8 @@ from asn.agent.profile import ProfileModule
 from asn.agent.memory import NaiveMemoryModule
 from asn.agent.action import ActionModule
 from asn.agent.plan import Plan
+from asn.agent.template import get_template_memory
+from asn.agent.consolidation import get_memory_budget
 from asn.llm.llm import LLMManager
 from asn.llm.prompt import *
 from asn.utils.logger import get_logger
@@ -20,7 +22,13 @@ class Agent:
     def recieve(self, text: str, now: datetime, update_memory=True, incontext=False, fake_history=None, log=None):
         raise NotImplementedError
 
-    def recieve_all(self, texts, now: datetime, update_memory=True, incontext=False, fake_history=None, log=None):
+    def recieve_all(self, texts, now: datetime, update_memory=True, incontext=False, fake_history=None, log=None, memories_retrieved=None):
+        raise NotImplementedError
+
+    async def arecieve(self, text: str, now: datetime, update_memory=True, incontext=False, fake_history=None, log=None):
+        raise NotImplementedError
+
+    async def arecieve_all(self, texts, now: datetime, update_memory=True, incontext=False, fake_history=None, log=None, memories_retrieved=None):
         raise NotImplementedError
 
     def generate(self, now: datetime, update_memory=True, incontext=False, fake_history=None, log=None):
@@ -64,18 +72,37 @@ class LLMAgent(Agent):
         observation = datetime.strftime(now, "%Y-%m-%d %H:%M") + "\n" + observation
         self.memory.add_memory(observation, now)
 
-    def recieve(self, text: str, now: datetime, update_memory=True, incontext=False, fake_history=None, log=None):
-        """
-        The agent reads a post and reacts to it.
-        """
-        experience = None
-        if incontext:
-            assert fake_history is not None
-            experience = fake_history_to_example_react(fake_history, 10)
-        memories_retrieved = self.memory.fetch_memories(text, now)
-        characteristics = self.profile.characteristics
-        acts = self.action.react_to_post({"text": text}, memories_retrieved, characteristics, now, experience, log=log)
-        # agent add memory
+    async def aadd_to_memory(self, observation, now):
+        get_logger().debug("Add to memory: {observation}".format(observation=observation))
+        observation = datetime.strftime(now, "%Y-%m-%d %H:%M") + "\n" + observation
+        await self.memory.aadd_memory(observation, now)
+
+    def _record_behavior(self, acts) -> None:
+        self.behavior_record.extend(acts)
+        # 有记忆预算时只保留最近的行为记录
+        budget = get_memory_budget()
+        if budget is not None and len(self.behavior_record) > budget.max_behavior_record:
+            del self.behavior_record[:-budget.max_behavior_record]
+
+    def _template_memory(self, acts, now: datetime):
+        # 只有阅读、没有点赞/转发/发帖的批次按模板写入记忆，不调用 LLM；返回 None 表示需要 LLM 总结
+        template = get_template_memory()
+        return template.write(acts, now) if template is not None else None
+
+    @staticmethod
+    def _experience(incontext: bool, fake_history, to_example):
+        # 上下文学习时从历史行为中取示例
+        if not incontext:
+            return None
+        assert fake_history is not None
+        return to_example(fake_history, 10)
+
+    @staticmethod
+    def feed_query(texts) -> str:
+        # recieve_all 检索记忆时使用的查询，模拟器批量检索时也用它
+        return "\n".join(["%d. %s" % (i, text) for i, text in enumerate(texts)])
+
+    def _recieve_memory(self, text: str, acts) -> str:
         recieve_memory = "I read a post: \"\"\"{text}\"\"\"".format(text=text)
         for act in acts:
             if act.type == "read":
@@ -89,22 +116,54 @@ class LLMAgent(Agent):
                 # get_logger().info("User {id} reposts: {text}".format(id=self.profile.info["id"], text=text[:50] + "......"))
             else:
                 get_logger().error("Unknown action type: {type}".format(type=act.type))
+        return recieve_memory
+
+    def recieve(self, text: str, now: datetime, update_memory=True, incontext=False, fake_history=None, log=None):
+        """
+        The agent reads a post and reacts to it.
+        """
+        experience = self._experience(incontext, fake_history, fake_history_to_example_react)
+        memories_retrieved = self.memory.fetch_memories(text, now)
+        characteristics = self.profile.characteristics
+        acts = self.action.react_to_post({"text": text}, memories_retrieved, characteristics, now, experience, log=log)
+        # agent add memory
+        recieve_memory = self._recieve_memory(text, acts)
         if update_memory:
-            self.add_to_memory(recieve_memory, now)
-            self.behavior_record.extend(acts)
+            memory = self._template_memory(acts, now)
+            if memory is not None:
+                self.memory.add_raw_memory(memory, now)
+            else:
+                self.add_to_memory(recieve_memory, now)
+            self._record_behavior(acts)
         return acts
 
-    def recieve_all(self, texts, now: datetime, update_memory=True, incontext=False, fake_history=None, log=None):
+    async def arecieve(self, text: str, now: datetime, update_memory=True, incontext=False, fake_history=None, log=None):
+        """
+        Async version of `recieve`.
+        """
+        experience = self._experience(incontext, fake_history, fake_history_to_example_react)
+        memories_retrieved = await self.memory.afetch_memories(text, now)
+        characteristics = self.profile.characteristics
+        acts = await self.action.areact_to_post({"text": text}, memories_retrieved, characteristics, now, experience, log=log)
+        if update_memory:
+            memory = self._template_memory(acts, now)
+            if memory is not None:
+                await self.memory.aadd_raw_memory(memory, now)
+            else:
+                await self.aadd_to_memory(self._recieve_memory(text, acts), now)
+            self._record_behavior(acts)
+        return acts
+
+    def recieve_all(self, texts, now: datetime, update_memory=True, incontext=False, fake_history=None, log=None, memories_retrieved=None):
         """
         The agent reads a batch of posts and reacts to them.
+        `memories_retrieved` can be fetched in advance for several agents at once (see `NaiveMemoryModule.fetch_memories_many`).
         """
         if not texts:
             return []
-        experience = None
-        if incontext:
-            assert fake_history is not None
-            experience = fake_history_to_example_reacts(fake_history, 10)
-        memories_retrieved = self.memory.fetch_memories("\n".join(["%d. %s" % (i, text) for i, text in enumerate(texts)]), now)
+        experience = self._experience(incontext, fake_history, fake_history_to_example_reacts)
+        if memories_retrieved is None:
+            memories_retrieved = self.memory.fetch_memories(self.feed_query(texts), now)
         characteristics = self.profile.characteristics
         actss = self.action.react_to_posts([{"text": text} for text in texts], memories_retrieved, characteristics, now, experience, log=log)
         # agent add memory
@@ -112,34 +171,45 @@ class LLMAgent(Agent):
         for i, acts in enumerate(actss):
             text = texts[i]
             acts = actss[i]
-            recieve_memory = "I read a post: \"\"\"{text}\"\"\"".format(text=text)
-            for act in acts:
-                if act.type == "read":
-                    pass
-                    # get_logger().info("User {id} reads: {text}".format(id=self.profile.info["id"], text=text[:50] + "......"))
-                elif act.type == "like":
-                    recieve_memory += "\nI like this post very much."
-                    # get_logger().info("User {id} likes: {text}".format(id=self.profile.info["id"], text=text[:50] + "......"))
-                elif act.type == "retweet" or act.type == "share" or act.type == "repost":
-                    recieve_memory += "\nI retweet this post."
-                    # get_logger().info("User {id} reposts: {text}".format(id=self.profile.info["id"], text=text[:50] + "......"))
-                else:
-                    get_logger().error("Unknown action type: {type}".format(type=act.type))
-            memories_saved.append(recieve_memory)
+            memories_saved.append(self._recieve_memory(text, acts))
+        if update_memory:
+            acts = [act for acts in actss for act in acts]  # flatten the list
+            memory = self._template_memory(acts, now)
+            if memory is not None:
+                self.memory.add_raw_memory(memory, now)
+            else:
+                self.memory.add_memories(memories_saved, now)
+            self._record_behavior(acts)
+        return actss
+
+    async def arecieve_all(self, texts, now: datetime, update_memory=True, incontext=False, fake_history=None, log=None, memories_retrieved=None):
+        """
+        Async version of `recieve_all`.
+        """
+        if not texts:
+            return []
+        experience = self._experience(incontext, fake_history, fake_history_to_example_reacts)
+        if memories_retrieved is None:
+            memories_retrieved = await self.memory.afetch_memories(self.feed_query(texts), now)
+        characteristics = self.profile.characteristics
+        actss = await self.action.areact_to_posts([{"text": text} for text in texts], memories_retrieved, characteristics, now, experience, log=log)
+        # agent add memory
+        memories_saved = [self._recieve_memory(text, acts) for text, acts in zip(texts, actss)]
         if update_memory:
-            self.memory.add_memories(memories_saved, now)
             acts = [act for acts in actss for act in acts]  # flatten the list
-            self.behavior_record.extend(acts)
+            memory = self._template_memory(acts, now)
+            if memory is not None:
+                await self.memory.aadd_raw_memory(memory, now)
+            else:
+                await self.memory.aadd_memories(memories_saved, now)
+            self._record_behavior(acts)
         return actss
             
     def generate(self, now: datetime, previous_posts, update_memory=True, force=False, incontext=False, fake_history=None, log=None):
         """
         The agent actively generates a post.
         """
-        experience = None
-        if incontext:
-            assert fake_history is not None
-            experience = fake_history_to_example_post(fake_history, 10)
+        experience = self._experience(incontext, fake_history, fake_history_to_example_post)
         memories_retrieved = self.memory.fetch_memories("Something that impresses.", now)
         characteristics = self.profile.characteristics
         acts = self.action.write_post(memories_retrieved, characteristics, previous_posts, now, extra_experience=experience, log=log, force=force)
@@ -148,7 +218,7 @@ class LLMAgent(Agent):
             generate_memory = "I write a post: \"\"\"{text}\"\"\"".format(text=act.text)
             if update_memory:
                 self.add_to_memory(generate_memory, now)
-                self.behavior_record.extend(acts)
+                self._record_behavior(acts)
         return acts
     
     def make_plan(self, now: datetime):
@@ -157,6 +227,28 @@ class LLMAgent(Agent):
         plan = self.plan.make_plan(characteristics, date)
         return plan
 
+    async def agenerate(self, now: datetime, previous_posts, update_memory=True, force=False, incontext=False, fake_history=None, log=None):
+        """
+        Async version of `generate`.
+        """
+        experience = self._experience(incontext, fake_history, fake_history_to_example_post)
+        memories_retrieved = await self.memory.afetch_memories("Something that impresses.", now)
+        characteristics = self.profile.characteristics
+        acts = await self.action.awrite_post(memories_retrieved, characteristics, previous_posts, now, extra_experience=experience, log=log, force=force)
+        # agent add memory
+        for act in acts:
+            generate_memory = "I write a post: \"\"\"{text}\"\"\"".format(text=act.text)
+            if update_memory:
+                await self.aadd_to_memory(generate_memory, now)
+                self._record_behavior(acts)
+        return acts
+
+    async def amake_plan(self, now: datetime):
+        date = datetime.strftime(now, "%Y-%m-%d")
+        characteristics = self.profile.characteristics
+        plan = await self.plan.amake_plan(characteristics, date)
+        return plan
+
     def replay(self, act):  # TODO
         """
         Replay the agent's history.
@@ -174,7 +266,7 @@ class LLMAgent(Agent):
                 self.add_to_memory("I didn't write a post this time.", act.timestamp)
             else:
                 self.add_to_memory("I write a post: \"\"\"{text}\"\"\"".format(text=act.text), act.timestamp)
-        self.behavior_record.append(act)
+        self._record_behavior([act])
 
     def replay_batch(self, acts, timestamp: datetime):
         """
@@ -199,8 +291,12 @@ class LLMAgent(Agent):
                 else:
                     memories.append("I write a post: \"\"\"{text}\"\"\"".format(text=act.text))
         get_logger().debug("Replays actions: {acts}, add memories: {memories}".format(acts=acts, memories=memories))
-        self.memory.add_memories(memories, timestamp)
-        self.behavior_record.extend(acts)
+        memory = self._template_memory(acts, timestamp)
+        if memory is not None:
+            self.memory.add_raw_memory(memory, timestamp)
+        else:
+            self.memory.add_memories(memories, timestamp)
+        self._record_behavior(acts)
 
     def get_opinion(self, topic, now):
         memories_retrieved = self.memory.fetch_memories(topic, now)
@@ -0,0 +1,113 @@
+"""
+Bounded agent memory.
+每次回放、反应、发帖和 daily_reflect 都会新增一条记忆，behavior_record 也只增不减，索引、checkpoint 和检索开销都随模拟时长线性增长。
+开启后每个 agent 最多保留 max_memories 条记忆：超出时把较旧、得分较低的记忆按周期（默认一周）分组，
+每组由 LLM 整合成一条周期总结（有每日反思时基于每日反思），原记忆从索引中删除，记忆数降到 low_water 比例以下；
+behavior_record 只保留最近的 max_behavior_record 条。长时间模拟的每步开销因此保持不变。
+"""
+import threading
+import numpy as np
+from datetime import datetime
+from typing import List
+from langchain_core.documents import Document
+from asn.agent.template import excerpt
+
+
+class MemoryBudget:
+    """
+    Per-agent memory budget. The newest `keep_recent` memories are never consolidated, and an earlier summary is only
+    merged into the next summary of its period; if only summaries are left to evict, the oldest summaries are dropped.
+    """
+    def __init__(self, max_memories: int = 500, low_water: float = 0.8, keep_recent: int = 50, period_days: int = 7,
+                 max_behavior_record: int = 200, max_excerpts: int = 5):
+        self.max_memories = max_memories
+        self.low_water = low_water
+        self.keep_recent = keep_recent
+        self.period_days = period_days
+        self.max_behavior_record = max_behavior_record
+        self.max_excerpts = max_excerpts
+        self.lock = threading.Lock()
+        self.consolidations = 0
+        self.summaries = 0
+        self.evicted = 0
+        self.dropped = 0
+
+    def over(self, num_memories: int) -> bool:
+        return num_memories > self.max_memories
+
+    def _period(self, document: Document) -> int:
+        return int(document.metadata["created_at"].timestamp() // (self.period_days * 86400))
+
+    def select(self, documents: List[Document], now: datetime, decay_rate: float) -> List[List[Document]]:
+        """
+        Groups (by period) of the lowest-scoring old memories, enough that replacing each group by one summary
+        brings `documents` (oldest first) down to `low_water * max_memories`.
+        """
+        excess = len(documents) - int(self.max_memories * self.low_water)
+        candidates = [document for document in documents[:max(0, len(documents) - self.keep_recent)] if document.metadata["kind"] != "summary"]
+        if excess <= 0 or not candidates:
+            return []
+        # 与检索相同的时间衰减得分（不含相似度），得分越低越先被整合
+        hours_passed = np.array([(now - document.metadata["last_accessed_at"]).total_seconds() / 3600 for document in candidates])
+        importance = np.array([document.metadata["importance"] if "importance" in document.metadata else 0.0 for document in candidates])
+        scores = (1.0 - decay_rate) ** hours_passed + importance
+        # 同一周期之前的总结并入新的总结，每个周期最终只保留一条
+        summaries = {}
+        for document in documents:
+            if document.metadata["kind"] == "summary":
+                summaries.setdefault(self._period(document), []).append(document)
+        groups = {}
+        for i in np.argsort(scores, kind="stable"):
+            period = self._period(candidates[i])
+            if period not in groups:
+                groups[period] = list(summaries[period]) if period in summaries else []
+            groups[period].append(candidates[i])
+            if sum(len(group) - 1 for group in groups.values()) >= excess:
+                break
+        # 只有一条的组整合后不会减少记忆数
+        return [sorted(group, key=lambda document: document.metadata["created_at"]) for group in groups.values() if len(group) > 1]
+
+    def overflow(self, documents: List[Document]) -> List[Document]:
+        """The oldest summaries to drop when consolidation alone cannot bring `documents` under `max_memories`."""
+        excess = len(documents) - self.max_memories
+        if excess <= 0:
+            return []
+        return [document for document in documents if document.metadata["kind"] == "summary"][:excess]
+
+    def material(self, group: List[Document]) -> List[str]:
+        # 该周期之前的总结在前；有每日反思时用每日反思生成周期总结，否则直接用原记忆
+        summaries = [document.page_content for document in group if document.metadata["kind"] == "summary"]
+        reflections = [document.page_content for document in group if document.metadata["kind"] == "daily_reflection"]
+        return summaries + (reflections if reflections else [document.page_content for document in group if document.metadata["kind"] != "summary"])
+
+    def period(self, group: List[Document]) -> str:
+        return f"{group[0].metadata['created_at']:%Y-%m-%d} to {group[-1].metadata['created_at']:%Y-%m-%d}"
+
+    def fallback(self, group: List[Document]) -> str:
+        # LLM 不可用时的确定性总结，保留部分原文以便按内容检索
+        excerpts = ["\"%s\"" % excerpt(text, 80) for text in self.material(group)[:self.max_excerpts]]
+        return f"From {self.period(group)}, I had {len(group)} memories, including: " + "; ".join(excerpts)
+
+    def record(self, groups: List[List[Document]], dropped: int) -> None:
+        with self.lock:
+            self.consolidations += 1
+            self.summaries += len(groups)
+            self.evicted += sum(len(group) for group in groups)
+            self.dropped += dropped
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "consolidations": self.consolidations,
+                "summaries": self.summaries,
+                "evicted": self.evicted,
+                "dropped_summaries": self.dropped,
+            }
+
+
+MEMORY_BUDGET: MemoryBudget = None
+def set_memory_budget(budget: MemoryBudget) -> None:
+    global MEMORY_BUDGET
+    MEMORY_BUDGET = budget
+def get_memory_budget() -> MemoryBudget:
+    return MEMORY_BUDGET
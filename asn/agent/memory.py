@@ -4,6 +4,7 @@ import numpy as np
 import random
 import faiss
 import copy
+import asyncio
 from langchain.llms.base import LLM
 from langchain.retrievers import TimeWeightedVectorStoreRetriever
 from langchain_community.docstore import InMemoryDocstore
@@ -21,6 +22,15 @@ from langchain_experimental.generative_agents.memory import GenerativeAgentMemor
 from langchain_community.vectorstores.utils import DistanceStrategy
 from asn.llm.prompt import *
 from asn.llm.llm import LLMManager
+from asn.llm.assembly import assemble_prompt
+from asn.llm.usage import usage_scope
+from asn.llm.retry import LLMUnavailableError
+from asn.llm.budget import PromptTooLongError, get_prompt_budget
+from asn.agent.summarizer import get_memory_summarizer
+from asn.agent.memory_store import SharedMemoryRetriever, afetch_many, fetch_many, get_shared_memory_store
+from asn.agent.retriever import NativeMemoryRetriever, get_native_retriever
+from asn.agent.consolidation import get_memory_budget
+from asn.utils.logger import get_logger
 
 
 class NaiveMemoryModule(GenerativeAgentMemory):
@@ -28,37 +38,221 @@ class NaiveMemoryModule(GenerativeAgentMemory):
     prompt_multi: PromptTemplate = PromptTemplate.from_template(PROMPT_NAIVE_MULTI_MEMORY)
     prompt_daily: PromptTemplate = PromptTemplate.from_template(PROMPT_DAILY_REFLECTION)
     llm: LLM
+    # TimeWeightedVectorStoreRetriever、NativeMemoryRetriever，或共享记忆库中的一个分区（SharedMemoryRetriever）
+    memory_retriever: Any
+    # 延迟总结模式下尚未替换的记忆：(文档 id, 提交时间, 总结任务)
+    pending: list = []
     def __init__(self, k: int = 5, decay_rate: float = 1e-6, memory_retriever: Optional[TimeWeightedVectorStoreRetriever] = None):
         llm = LLMManager.get_llm()
-        if memory_retriever is None:
+        if memory_retriever is None and get_shared_memory_store() is not None:
+            embed_size, embed_model = LLMManager.get_embed_model()
+            memory_retriever = SharedMemoryRetriever(get_shared_memory_store(), embed_model, k=k, decay_rate=decay_rate)
+        elif memory_retriever is None and get_native_retriever():
+            embed_size, embed_model = LLMManager.get_embed_model()
+            memory_retriever = NativeMemoryRetriever(embed_model, embed_size, k=k, decay_rate=decay_rate)
+        elif memory_retriever is None:
             embed_size, embed_model = LLMManager.get_embed_model()
             vector_store = FAISS(embed_model, faiss.IndexFlatIP(embed_size), InMemoryDocstore(), {}, normalize_L2=True)
             memory_retriever = TimeWeightedVectorStoreRetriever(vectorstore=vector_store, decay_rate=decay_rate, k=k)
         super().__init__(llm=llm, memory_retriever=memory_retriever)
 
+    def _summarize_chain(self, call_site: str, instructions: str, prompt: PromptTemplate, behavior: str, now: datetime):
+        # 总结指令放在 system 消息中作为所有 agent 共享的前缀，行为记录放在 user 消息中
+        timestamp = datetime.strftime(now, "%Y-%m-%d")
+
+        def render(newest_lines):
+            return prompt.format(behavior="\n".join(newest_lines[::-1]), timestamp=timestamp)
+        # 行为记录随历史增长（多条记忆、一天的活动），超出上下文长度时从最早的记录开始去掉
+        content = get_prompt_budget().fit(call_site, instructions, render, newest_lines=behavior.split("\n")[::-1])
+        prompt_sys, prompt = assemble_prompt(call_site, instructions, content=content)
+        return self.llm.bind(call_site=call_site, prompt_sys=prompt_sys), prompt
+
+    def _summarize(self, call_site: str, instructions: str, prompt: PromptTemplate, behavior: str, now: datetime):
+        # 在 MemorySummarizer 的线程中运行：总结并嵌入新文本，失败时返回 None，保留原始观察
+        try:
+            llm, prompt = self._summarize_chain(call_site, instructions, prompt, behavior, now)
+            memory_content = llm.invoke(prompt)
+        except (LLMUnavailableError, PromptTooLongError) as e:
+            get_logger().error(f"Error in summarizing memory: {e}")
+            return None
+        with usage_scope(call_site="memory"):
+            embedding = self._embeddings().embed_documents([memory_content])[0]
+        return memory_content, embedding
+
+    def _defer(self, ids: List[str], call_site: str, instructions: str, prompt: PromptTemplate, behavior: str, now: datetime) -> None:
+        future = get_memory_summarizer().submit(self._summarize, call_site, instructions, prompt, behavior, now)
+        self.pending.append((ids[0], now, future))
+
+    def _shared(self) -> bool:
+        return isinstance(self.memory_retriever, SharedMemoryRetriever)
+
+    def _native(self) -> bool:
+        # 不经过 LangChain 的检索器：检索时直接传入 now，文档 id 为行号
+        return isinstance(self.memory_retriever, (SharedMemoryRetriever, NativeMemoryRetriever))
+
+    def _embeddings(self):
+        return self.memory_retriever.embeddings if self._native() else self.memory_retriever.vectorstore.embeddings
+
+    def _replace(self, doc_id: str, memory_content: str, embedding: List[float]) -> None:
+        if self._native():
+            self.memory_retriever.replace(doc_id, memory_content, embedding)
+            return
+        vectorstore = self.memory_retriever.vectorstore
+        document = vectorstore.docstore.search(doc_id)
+        self.memory_retriever.memory_stream[document.metadata["buffer_idx"]].page_content = memory_content
+        vectorstore.delete([doc_id])
+        vectorstore.add_embeddings([(memory_content, embedding)], metadatas=[document.metadata], ids=[doc_id])
+
+    def _count(self) -> int:
+        return len(self.memory_retriever) if self._native() else len(self.memory_retriever.memory_stream)
+
+    def _all_documents(self) -> List[Document]:
+        # 所有记忆（从旧到新），metadata 中的 buffer_idx 为 _remove 使用的 id
+        if self._native():
+            return self.memory_retriever.all_documents()
+        return [Document(page_content=document.page_content, metadata={"kind": "memory", **document.metadata}) for document in self.memory_retriever.memory_stream]
+
+    def _remove(self, buffer_idxs: List[str]) -> None:
+        if self._native():
+            self.memory_retriever.remove(buffer_idxs)
+            return
+        # FAISS：从向量库删除，再重建 memory_stream，并同步更新向量库文档中的 buffer_idx
+        removed = set(int(buffer_idx) for buffer_idx in buffer_idxs)
+        vectorstore = self.memory_retriever.vectorstore
+        documents = {doc_id: vectorstore.docstore.search(doc_id) for doc_id in vectorstore.index_to_docstore_id.values()}
+        deleted = [doc_id for doc_id, document in documents.items() if document.metadata["buffer_idx"] in removed]
+        if deleted:
+            vectorstore.delete(deleted)
+        kept = [i for i in range(len(self.memory_retriever.memory_stream)) if i not in removed]
+        new_idx = {old: new for new, old in enumerate(kept)}
+        # 两处文档可能共用同一个 metadata，先算好新的 buffer_idx 再统一写入
+        updates = [(document, new_idx[document.metadata["buffer_idx"]]) for doc_id, document in documents.items() if doc_id not in deleted]
+        memory_stream = [self.memory_retriever.memory_stream[i] for i in kept]
+        updates += [(document, new) for new, document in enumerate(memory_stream)]
+        for document, new in updates:
+            document.metadata["buffer_idx"] = new
+        self.memory_retriever.memory_stream = memory_stream
+
+    def _split_pending(self, now: Optional[datetime]):
+        # 之前的步提交的总结必须在检索前完成；当前步（提交时间不早于 now）尚未完成的继续保持原始观察
+        ready, waiting, pending = [], [], []
+        for doc_id, submitted_at, future in self.pending:
+            if future.done():
+                ready.append((doc_id, future))
+            elif now is None or submitted_at < now:
+                waiting.append((doc_id, future))
+            else:
+                pending.append((doc_id, submitted_at, future))
+        if waiting:
+            get_memory_summarizer().record_wait()
+        self.pending = pending
+        return ready, waiting
+
+    def _apply(self, doc_id: str, future) -> None:
+        try:
+            result = future.result()
+        except Exception as e:
+            get_logger().error(f"Error in summarizing memory: {e}")
+            return
+        if result is not None:
+            self._replace(doc_id, *result)
+
+    def apply_summaries(self, now: Optional[datetime] = None) -> None:
+        """Swap finished deferred summaries into the memory, waiting for those submitted before `now` (all if None)."""
+        if not self.pending:
+            return
+        ready, waiting = self._split_pending(now)
+        for doc_id, future in ready + waiting:
+            self._apply(doc_id, future)
+
+    async def aapply_summaries(self, now: Optional[datetime] = None) -> None:
+        """Async version of `apply_summaries`."""
+        if not self.pending:
+            return
+        ready, waiting = self._split_pending(now)
+        if waiting:
+            await asyncio.wait([asyncio.wrap_future(future) for doc_id, future in waiting])
+        for doc_id, future in ready + waiting:
+            self._apply(doc_id, future)
+
+    def _summary(self, call_site: str, instructions: str, prompt: PromptTemplate, behavior: str, now: datetime) -> str:
+        try:
+            llm, prompt = self._summarize_chain(call_site, instructions, prompt, behavior, now)
+            return llm.invoke(prompt)
+        except (LLMUnavailableError, PromptTooLongError) as e:
+            # 总结失败时直接保存原始观察，保证记忆不丢失
+            get_logger().error(f"Error in summarizing {call_site}: {e}")
+            return behavior
+
+    async def _asummary(self, call_site: str, instructions: str, prompt: PromptTemplate, behavior: str, now: datetime) -> str:
+        try:
+            llm, prompt = self._summarize_chain(call_site, instructions, prompt, behavior, now)
+            return await llm.ainvoke(prompt)
+        except (LLMUnavailableError, PromptTooLongError) as e:
+            get_logger().error(f"Error in summarizing {call_site}: {e}")
+            return behavior
+
+    def _add_summarized(self, call_site: str, instructions: str, prompt: PromptTemplate, behavior: str, now: datetime) -> List[str]:
+        # 延迟总结模式下先按原始观察写入，总结在后台完成
+        deferred = get_memory_summarizer() is not None
+        memory_content = behavior if deferred else self._summary(call_site, instructions, prompt, behavior, now)
+        with usage_scope(call_site="memory"):
+            result = self.memory_retriever.add_documents([Document(page_content=memory_content, metadata={"created_at": now})], current_time=now)
+        if deferred:
+            self._defer(result, call_site, instructions, prompt, behavior, now)
+        self.consolidate(now)
+        return result
+
+    async def _aadd_summarized(self, call_site: str, instructions: str, prompt: PromptTemplate, behavior: str, now: datetime) -> List[str]:
+        deferred = get_memory_summarizer() is not None
+        memory_content = behavior if deferred else await self._asummary(call_site, instructions, prompt, behavior, now)
+        with usage_scope(call_site="memory"):
+            result = await self.memory_retriever.aadd_documents([Document(page_content=memory_content, metadata={"created_at": now})], current_time=now)
+        if deferred:
+            self._defer(result, call_site, instructions, prompt, behavior, now)
+        await self.aconsolidate(now)
+        return result
+
+    @staticmethod
+    def _join_memories(memories: List[str]) -> str:
+        return "\n".join(["%d. %s" % (i, memory) for i, memory in enumerate(memories)])
+
     def add_memory(
         self, memory_content: str, now: datetime
     ) -> List[str]:
         """Add an observation or memory to the agent's memory."""
-        memory_content = (self.prompt | self.llm).invoke({"behavior": memory_content, "timestamp": datetime.strftime(now, "%Y-%m-%d")})
-        document = Document(
-            page_content=memory_content, metadata={"created_at": now}
-        )
-        result = self.memory_retriever.add_documents([document], current_time=now)
-        return result
-    
+        return self._add_summarized("memory", PROMPT_NAIVE_MEMORY_SYSTEM, self.prompt, memory_content, now)
+
     def add_memories(
         self, memories: List[str], now: datetime
     ) -> List[str]:
         """Add multiple observations or memories to the agent's memory ONCE."""
-        memories = "\n".join(["%d. %s" % (i, memory) for i, memory in enumerate(memories)])
-        memory_content = (self.prompt_multi | self.llm).invoke({"behavior": memories, "timestamp": datetime.strftime(now, "%Y-%m-%d")})
-        documents = [
-            Document(
-                page_content=memory_content, metadata={"created_at": now}
-            )
-        ]
-        result = self.memory_retriever.add_documents(documents, current_time=now)
+        return self._add_summarized("multi-memory", PROMPT_NAIVE_MULTI_MEMORY_SYSTEM, self.prompt_multi, self._join_memories(memories), now)
+
+    async def aadd_memory(
+        self, memory_content: str, now: datetime
+    ) -> List[str]:
+        """Async version of `add_memory`."""
+        return await self._aadd_summarized("memory", PROMPT_NAIVE_MEMORY_SYSTEM, self.prompt, memory_content, now)
+
+    async def aadd_memories(
+        self, memories: List[str], now: datetime
+    ) -> List[str]:
+        """Async version of `add_memories`."""
+        return await self._aadd_summarized("multi-memory", PROMPT_NAIVE_MULTI_MEMORY_SYSTEM, self.prompt_multi, self._join_memories(memories), now)
+
+    def add_raw_memory(self, memory_content: str, now: datetime) -> List[str]:
+        """Add a memory as is, without summarizing it (e.g. a templated memory)."""
+        with usage_scope(call_site="memory"):
+            result = self.memory_retriever.add_documents([Document(page_content=memory_content, metadata={"created_at": now})], current_time=now)
+        self.consolidate(now)
+        return result
+
+    async def aadd_raw_memory(self, memory_content: str, now: datetime) -> List[str]:
+        """Async version of `add_raw_memory`."""
+        with usage_scope(call_site="memory"):
+            result = await self.memory_retriever.aadd_documents([Document(page_content=memory_content, metadata={"created_at": now})], current_time=now)
+        await self.aconsolidate(now)
         return result
 
     def daily_reflect(self, daily_action, now: datetime):
@@ -79,25 +273,107 @@ class NaiveMemoryModule(GenerativeAgentMemory):
                     else:
                         activities.append("I write a post: \"\"\"{text}\"\"\"".format(text=act.text))
         activities = "\n".join(activities)
-        daily_reflection = (self.prompt_daily | self.llm).invoke({"behavior": activities, "timestamp": datetime.strftime(now, "%Y-%m-%d")})
+        daily_reflection = self._summary("daily-reflection", PROMPT_DAILY_REFLECTION_SYSTEM, self.prompt_daily, activities, now)
         document = Document(
-            page_content=daily_reflection, metadata={"created_at": now}
+            page_content=daily_reflection, metadata={"created_at": now, "kind": "daily_reflection"}
         )
-        result = self.memory_retriever.add_documents([document], current_time=now)
+        with usage_scope(call_site="daily-reflection"):
+            result = self.memory_retriever.add_documents([document], current_time=now)
+        self.consolidate(now)
         return daily_reflection
 
+    def _consolidate_group(self, group: List[Document]) -> str:
+        budget = get_memory_budget()
+        period = budget.period(group)
+        try:
+            content = get_prompt_budget().fit("consolidation", PROMPT_CONSOLIDATION_SYSTEM, lambda memories: PROMPT_CONSOLIDATION.format(period=period, memories="\n".join(memories)), memories=budget.material(group))
+            prompt_sys, prompt = assemble_prompt("consolidation", PROMPT_CONSOLIDATION_SYSTEM, content=content)
+            return self.llm.bind(call_site="consolidation", prompt_sys=prompt_sys).invoke(prompt)
+        except (LLMUnavailableError, PromptTooLongError) as e:
+            get_logger().error(f"Error in consolidating memories: {e}")
+            return budget.fallback(group)
+
+    def consolidate(self, now: datetime) -> None:
+        """Replace old low-score memories by period summaries once the memory budget is exceeded."""
+        budget = get_memory_budget()
+        if budget is None or not budget.over(self._count()):
+            return
+        # 淘汰记忆会改变文档 id，先完成所有延迟总结
+        self.apply_summaries()
+        groups = budget.select(self._all_documents(), now, self.memory_retriever.decay_rate)
+        evicted = []
+        for group in groups:
+            summary = self._consolidate_group(group)
+            importance = max(document.metadata["importance"] if "importance" in document.metadata else 0.0 for document in group)
+            metadata = {"created_at": group[-1].metadata["created_at"], "kind": "summary", "importance": importance}
+            evicted.extend(str(document.metadata["buffer_idx"]) for document in group)
+            with usage_scope(call_site="consolidation"):
+                self.memory_retriever.add_documents([Document(page_content=summary, metadata=metadata)], current_time=now)
+        self._remove(evicted)
+        dropped = budget.overflow(self._all_documents())
+        if dropped:
+            self._remove([str(document.metadata["buffer_idx"]) for document in dropped])
+        budget.record(groups, len(dropped))
+
+    async def aconsolidate(self, now: datetime) -> None:
+        """Async version of `consolidate`."""
+        budget = get_memory_budget()
+        if budget is None or not budget.over(self._count()):
+            return
+        await asyncio.to_thread(self.consolidate, now)
+
     def fetch_memories(
         self, observation: str, now: Optional[datetime] = None
     ) -> List[Document]:
         """Fetch related memories."""
-        if now is not None:
+        self.apply_summaries(now)
+        if self._native():
+            # 原生检索器按传入的 now 计算时间衰减
+            with usage_scope(call_site="memory-retrieval"):
+                memories_retrieved = self.memory_retriever.invoke(observation, now=now)
+        elif now is not None:
             # with mock_now(now):
             # !!! 多线程mock_now（猴子补丁修改datetime.datetime），导致datetime.datetime被永久污染，无法恢复
-            memories_retrieved = self.memory_retriever.invoke(observation)
+            with usage_scope(call_site="memory-retrieval"):
+                memories_retrieved = self.memory_retriever.invoke(observation)
         else:
-            memories_retrieved = self.memory_retriever.invoke(observation)
+            with usage_scope(call_site="memory-retrieval"):
+                memories_retrieved = self.memory_retriever.invoke(observation)
+        return [memory.page_content for memory in memories_retrieved]
+
+    async def afetch_memories(
+        self, observation: str, now: Optional[datetime] = None
+    ) -> List[Document]:
+        """Async version of `fetch_memories`."""
+        await self.aapply_summaries(now)
+        with usage_scope(call_site="memory-retrieval"):
+            if self._native():
+                memories_retrieved = await self.memory_retriever.ainvoke(observation, now=now)
+            else:
+                memories_retrieved = await self.memory_retriever.ainvoke(observation)
         return [memory.page_content for memory in memories_retrieved]
 
+    @staticmethod
+    def fetch_memories_many(
+        memories: List["NaiveMemoryModule"], observations: List[str], now: Optional[datetime] = None
+    ) -> List[List[str]]:
+        """Fetch related memories for several agents at once. All of them must use the shared memory store."""
+        for memory in memories:
+            memory.apply_summaries(now)
+        with usage_scope(call_site="memory-retrieval"):
+            memories_retrieved = fetch_many([memory.memory_retriever for memory in memories], observations, now)
+        return [[document.page_content for document in documents] for documents in memories_retrieved]
+
+    @staticmethod
+    async def afetch_memories_many(
+        memories: List["NaiveMemoryModule"], observations: List[str], now: Optional[datetime] = None
+    ) -> List[List[str]]:
+        """Async version of `fetch_memories_many`."""
+        await asyncio.gather(*[memory.aapply_summaries(now) for memory in memories])
+        with usage_scope(call_site="memory-retrieval"):
+            memories_retrieved = await afetch_many([memory.memory_retriever for memory in memories], observations, now)
+        return [[document.page_content for document in documents] for documents in memories_retrieved]
+
     @staticmethod
     def save_document_to_dict(document: Document) -> dict:
         # Datetime or MockDatetime in metadata
@@ -122,6 +398,24 @@ class NaiveMemoryModule(GenerativeAgentMemory):
         )
 
     def save_to_dict(self, path, index) -> dict:
+        self.apply_summaries()
+        if self._shared():
+            # 记忆本身随共享记忆库一起保存（见 simulator.py），这里只记录分区
+            return {
+                "shared": True,
+                "partition": self.memory_retriever.partition,
+                "decay_rate": self.memory_retriever.decay_rate,
+                "k": self.memory_retriever.k
+            }
+        if self._native():
+            self.memory_retriever.save(path, index)
+            return {
+                "native": True,
+                "path": path,
+                "index": index,
+                "decay_rate": self.memory_retriever.decay_rate,
+                "k": self.memory_retriever.k
+            }
         # Transform mockdatetime to datetime
         for doc in self.memory_retriever.vectorstore.docstore._dict.values():
             doc.metadata["created_at"] = doc.metadata["created_at"].timestamp()
@@ -141,6 +435,14 @@ class NaiveMemoryModule(GenerativeAgentMemory):
         
     @classmethod
     def load_from_dict(cls, data: dict) -> "NaiveMemoryModule":
+        if "shared" in data and data["shared"]:
+            embed_size, embed_model = LLMManager.get_embed_model()
+            memory_retriever = SharedMemoryRetriever(get_shared_memory_store(), embed_model, partition=data["partition"], k=data["k"], decay_rate=data["decay_rate"])
+            return NaiveMemoryModule(memory_retriever=memory_retriever)
+        if "native" in data and data["native"]:
+            embed_size, embed_model = LLMManager.get_embed_model()
+            memory_retriever = NativeMemoryRetriever.load(data["path"], data["index"], embed_model, k=data["k"], decay_rate=data["decay_rate"])
+            return NaiveMemoryModule(memory_retriever=memory_retriever)
         path = data["path"]
         index = data["index"]
         memory_stream = [cls.load_document_from_dict(doc) for doc in data["memory_stream"]]
@@ -0,0 +1,301 @@
+"""
+Shared, partitioned vector store for all agents' memories.
+每个 NaiveMemoryModule 原本各自持有一个 faiss.IndexFlatIP、InMemoryDocstore 和 TimeWeightedVectorStoreRetriever，
+上万个 agent 就是上万个很小的索引和 Python 对象，每个 checkpoint 还要为每个 agent 写一对 save_local 文件。
+这里所有记忆的向量放在一个连续的 float32 矩阵中，每个 agent 是其中的一个分区（行号列表），
+创建时间、最近访问时间和 importance 也保存为数组；候选规则和相似度得分与原来的 FAISS + TimeWeightedVectorStoreRetriever 相同（见 relevance），
+时间衰减按传入的模拟时间 now 计算（原来用的是系统时间）。search_many / fetch_many 可以在一次向量化计算中完成多个 agent 的检索。
+每个分区有自己的锁，不同 agent 的读写互不阻塞；全局锁只用于分配行。需要多个分区锁时总是按分区名排序后获取。
+"""
+import os
+import json
+import uuid
+import threading
+from contextlib import contextmanager
+import numpy as np
+from datetime import datetime
+from typing import List, Optional, Union
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+
+def relevance(similarity: np.ndarray) -> np.ndarray:
+    # 与原来的检索器一致：FAISS 默认按欧氏距离换算相关度 1 - d / sqrt(2)，而 IndexFlatIP 返回的 d 是余弦相似度
+    return 1.0 - similarity / np.sqrt(2)
+
+
+def _segment_rank(values: np.ndarray, segments: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    # 每个元素在所属分段内按 values 从大到小的名次（从 0 开始）
+    order = np.lexsort((-values, segments))
+    rank = np.empty(len(values), dtype=np.int64)
+    rank[order] = np.arange(len(values)) - starts[segments[order]]
+    return rank
+
+
+class SharedMemoryStore:
+    """
+    Memories of all agents in one matrix. Each agent owns a partition (its rows in insertion order) with its own lock;
+    `lock` only guards allocating rows; growing the matrix also takes every partition lock (after `lock`, in name order).
+    Candidates are the `search_k` most similar memories and the `k` latest ones, as in TimeWeightedVectorStoreRetriever over the
+    original FAISS store. They are scored by `(1 - decay_rate) ** hours_since_last_access + importance`, plus `relevance(similarity)`
+    for the `search_k` most similar; hours are counted from the simulation time passed as `now`.
+    """
+    def __init__(self, dim: int, capacity: int = 1024, chunk_rows: int = 65536):
+        self.dim = dim
+        self.chunk_rows = chunk_rows
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.created_at = np.zeros(capacity, dtype=np.float64)
+        self.last_accessed_at = np.zeros(capacity, dtype=np.float64)
+        self.importance = np.zeros(capacity, dtype=np.float64)
+        self.texts: List[str] = []
+        # 记忆类型（"memory"、"daily_reflection"、"summary"），供记忆整合使用
+        self.kinds: List[str] = []
+        self.size = 0
+        self.partitions = {}
+        # 被淘汰的记忆留下的空行，新记忆优先复用
+        self.free: List[int] = []
+        self.lock = threading.Lock()
+        self.partition_locks = {}
+
+    def new_partition(self) -> str:
+        name = uuid.uuid4().hex
+        with self.lock:
+            self.partitions[name] = []
+            self.partition_locks[name] = threading.Lock()
+        return name
+
+    @contextmanager
+    def _partitions(self, partitions: List[str]):
+        # 按分区名排序后加锁，多个分区同时加锁时不会死锁
+        locks = [self.partition_locks[name] for name in sorted(set(partitions))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def _grow(self, size: int) -> None:
+        # 调用方已持有 self.lock；扩容会替换数组，需要等所有分区的读写结束
+        capacity = len(self.vectors)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        with self._partitions(list(self.partition_locks)):
+            self.vectors = np.concatenate([self.vectors, np.zeros((capacity - len(self.vectors), self.dim), dtype=np.float32)])
+            self.created_at = np.concatenate([self.created_at, np.zeros(capacity - len(self.created_at))])
+            self.last_accessed_at = np.concatenate([self.last_accessed_at, np.zeros(capacity - len(self.last_accessed_at))])
+            self.importance = np.concatenate([self.importance, np.zeros(capacity - len(self.importance))])
+
+    @staticmethod
+    def _normalize(embeddings) -> np.ndarray:
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    def add(self, partition: str, texts: List[str], embeddings: List[List[float]], created_at: Union[float, List[float]],
+            last_accessed_at: float = None, kinds: List[str] = None, importance: List[float] = None) -> List[int]:
+        vectors = self._normalize(embeddings)
+        # 先在全局锁下分配行，再在分区锁下写入
+        with self.lock:
+            reused = [self.free.pop() for _ in range(min(len(texts), len(self.free)))]
+            start = self.size
+            self._grow(start + len(texts) - len(reused))
+            self.size += len(texts) - len(reused)
+            self.texts.extend([""] * (len(texts) - len(reused)))
+            self.kinds.extend([""] * (len(texts) - len(reused)))
+            rows = reused + list(range(start, self.size))
+        with self.partition_locks[partition]:
+            self.vectors[rows] = vectors
+            self.created_at[rows] = created_at
+            self.last_accessed_at[rows] = created_at if last_accessed_at is None else last_accessed_at
+            self.importance[rows] = 0.0 if importance is None else importance
+            for row, text, kind in zip(rows, texts, kinds or ["memory"] * len(texts)):
+                self.texts[row] = text
+                self.kinds[row] = kind
+            self.partitions[partition].extend(rows)
+        return rows
+
+    def remove(self, partition: str, rows: List[int]) -> None:
+        """Evict `rows` from `partition`; their slots are reused by later memories."""
+        with self.partition_locks[partition]:
+            removed = set(rows) & set(self.partitions[partition])
+            self.partitions[partition] = [row for row in self.partitions[partition] if row not in removed]
+            for row in removed:
+                self.texts[row] = ""
+                self.kinds[row] = ""
+        with self.lock:
+            self.free.extend(sorted(removed, reverse=True))
+
+    def replace(self, partition: str, row: int, text: str, embedding: List[float]) -> None:
+        vector = self._normalize([embedding])[0]
+        with self.partition_locks[partition]:
+            self.vectors[row] = vector
+            self.texts[row] = text
+
+    def search(self, partition: str, query: List[float], now: float, k: int, decay_rate: float, search_k: int = 100) -> List[Document]:
+        """Top-`k` memories of `partition` for `query`, best first; their access time is set to `now`."""
+        return self.search_many([partition], [query], now, k, decay_rate, search_k)[0]
+
+    def search_many(self, partitions: List[str], queries: List[List[float]], now: float, k: int, decay_rate: float, search_k: int = 100) -> List[List[Document]]:
+        """Top-`k` memories of each partition for its query in one vectorised pass, best first; their access time is set to `now`."""
+        queries = self._normalize(queries)
+        with self._partitions(partitions):
+            parts = [self.partitions[partition] for partition in partitions]
+            lengths = np.array([len(part) for part in parts], dtype=np.int64)
+            if lengths.sum() == 0:
+                return [[] for _ in partitions]
+            rows = np.concatenate([np.asarray(part, dtype=np.int64) for part in parts])
+            segments = np.repeat(np.arange(len(parts)), lengths)
+            starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+            positions = np.arange(len(rows)) - starts[segments]
+            # 分块计算每行与所属分区查询向量的内积，限制临时矩阵的大小
+            similarity = np.empty(len(rows), dtype=np.float32)
+            for begin in range(0, len(rows), self.chunk_rows):
+                end = begin + self.chunk_rows
+                similarity[begin:end] = np.einsum("ij,ij->i", self.vectors[rows[begin:end]], queries[segments[begin:end]])
+            salient = _segment_rank(similarity, segments, starts) < search_k
+            latest = positions >= (lengths[segments] - k)
+            hours_passed = (now - self.last_accessed_at[rows]) / 3600
+            scores = (1.0 - decay_rate) ** hours_passed + self.importance[rows] + np.where(salient, relevance(similarity), 0.0)
+            scores = np.where(salient | latest, scores, -np.inf)
+            rank = _segment_rank(scores, segments, starts)
+            selected = np.flatnonzero((rank < k) & np.isfinite(scores))
+            selected = selected[np.lexsort((rank[selected], segments[selected]))]
+            self.last_accessed_at[rows[selected]] = now
+            bounds = np.searchsorted(segments[selected], np.arange(len(parts) + 1))
+            return [self._documents(rows[selected[bounds[i]:bounds[i + 1]]].tolist()) for i in range(len(parts))]
+
+    def _documents(self, rows: List[int]) -> List[Document]:
+        # 调用方已持有这些行所属分区的锁
+        return [
+            Document(page_content=self.texts[row], metadata={
+                "created_at": datetime.fromtimestamp(self.created_at[row]),
+                "last_accessed_at": datetime.fromtimestamp(self.last_accessed_at[row]),
+                "importance": float(self.importance[row]),
+                "kind": self.kinds[row],
+                "buffer_idx": row,
+            })
+            for row in rows
+        ]
+
+    def documents(self, partition: str) -> List[Document]:
+        """All memories of `partition`, oldest first."""
+        with self.partition_locks[partition]:
+            return self._documents(list(self.partitions[partition]))
+
+    def save(self, path: str) -> str:
+        """Write the store into the directory `path` (`memory_store.npz` and `memory_store.json`), returning `path`."""
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with self.lock, self._partitions(list(self.partition_locks)):
+            np.savez(os.path.join(path, "memory_store.npz"), vectors=self.vectors[:self.size], created_at=self.created_at[:self.size],
+                     last_accessed_at=self.last_accessed_at[:self.size], importance=self.importance[:self.size])
+            with open(os.path.join(path, "memory_store.json"), "w") as f:
+                json.dump({"dim": self.dim, "texts": self.texts, "kinds": self.kinds, "partitions": self.partitions, "free": self.free}, f)
+        return path
+
+    @classmethod
+    def load(cls, path: str) -> "SharedMemoryStore":
+        with open(os.path.join(path, "memory_store.json"), "r") as f:
+            meta = json.load(f)
+        arrays = np.load(os.path.join(path, "memory_store.npz"))
+        store = cls(meta["dim"], capacity=max(1024, len(meta["texts"])))
+        store.size = len(meta["texts"])
+        store.vectors[:store.size] = arrays["vectors"]
+        store.created_at[:store.size] = arrays["created_at"]
+        store.last_accessed_at[:store.size] = arrays["last_accessed_at"]
+        if "importance" in arrays:
+            store.importance[:store.size] = arrays["importance"]
+        store.texts = meta["texts"]
+        store.kinds = meta["kinds"] if "kinds" in meta else ["memory"] * store.size
+        store.partitions = meta["partitions"]
+        store.partition_locks = {name: threading.Lock() for name in store.partitions}
+        store.free = meta["free"] if "free" in meta else []
+        return store
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"memories": self.size - len(self.free), "free": len(self.free), "partitions": len(self.partitions), "bytes": int(self.vectors[:self.size].nbytes)}
+
+
+class SharedMemoryRetriever:
+    """
+    One agent's view of a SharedMemoryStore, offering the parts of TimeWeightedVectorStoreRetriever that NaiveMemoryModule uses.
+    Document ids are the row numbers in the store (as strings).
+    """
+    def __init__(self, store: SharedMemoryStore, embeddings: Embeddings, partition: str = None, k: int = 5, decay_rate: float = 1e-6, search_k: int = 100):
+        self.store = store
+        self.embeddings = embeddings
+        self.partition = partition if partition is not None else store.new_partition()
+        self.k = k
+        self.decay_rate = decay_rate
+        self.search_k = search_k
+
+    @staticmethod
+    def _timestamp(time: Optional[datetime]) -> float:
+        return (time if time is not None else datetime.now()).timestamp()
+
+    def _add(self, documents: List[Document], embeddings: List[List[float]], current_time: Optional[datetime]) -> List[str]:
+        created_at = [self._timestamp(document.metadata["created_at"] if "created_at" in document.metadata else current_time) for document in documents]
+        kinds = [document.metadata["kind"] if "kind" in document.metadata else "memory" for document in documents]
+        importance = [document.metadata["importance"] if "importance" in document.metadata else 0.0 for document in documents]
+        rows = self.store.add(self.partition, [document.page_content for document in documents], embeddings, created_at, self._timestamp(current_time), kinds, importance)
+        return [str(row) for row in rows]
+
+    def add_documents(self, documents: List[Document], current_time: datetime = None, **kwargs) -> List[str]:
+        return self._add(documents, self.embeddings.embed_documents([document.page_content for document in documents]), current_time)
+
+    async def aadd_documents(self, documents: List[Document], current_time: datetime = None, **kwargs) -> List[str]:
+        return self._add(documents, await self.embeddings.aembed_documents([document.page_content for document in documents]), current_time)
+
+    def search(self, query: List[float], now: datetime = None) -> List[Document]:
+        return self.store.search(self.partition, query, self._timestamp(now), self.k, self.decay_rate, self.search_k)
+
+    def invoke(self, query: str, now: datetime = None) -> List[Document]:
+        return self.search(self.embeddings.embed_query(query), now)
+
+    async def ainvoke(self, query: str, now: datetime = None) -> List[Document]:
+        return self.search(await self.embeddings.aembed_query(query), now)
+
+    def replace(self, doc_id: str, text: str, embedding: List[float]) -> None:
+        self.store.replace(self.partition, int(doc_id), text, embedding)
+
+    def remove(self, doc_ids: List[str]) -> None:
+        self.store.remove(self.partition, [int(doc_id) for doc_id in doc_ids])
+
+    def all_documents(self) -> List[Document]:
+        """All memories of this agent, oldest first."""
+        return self.store.documents(self.partition)
+
+    def __len__(self) -> int:
+        return len(self.store.partitions[self.partition])
+
+
+def _search_many(retrievers: List[SharedMemoryRetriever], embeddings: List[List[float]], now: Optional[datetime]) -> List[List[Document]]:
+    first = retrievers[0]
+    return first.store.search_many([retriever.partition for retriever in retrievers], embeddings, first._timestamp(now), first.k, first.decay_rate, first.search_k)
+
+
+def fetch_many(retrievers: List[SharedMemoryRetriever], queries: List[str], now: datetime = None) -> List[List[Document]]:
+    """Retrieve memories for several agents of the same store in one vectorised pass (one embedding request, one scoring pass)."""
+    if not retrievers:
+        return []
+    return _search_many(retrievers, retrievers[0].embeddings.embed_documents(queries), now)
+
+
+async def afetch_many(retrievers: List[SharedMemoryRetriever], queries: List[str], now: datetime = None) -> List[List[Document]]:
+    """Async version of `fetch_many`."""
+    if not retrievers:
+        return []
+    return _search_many(retrievers, await retrievers[0].embeddings.aembed_documents(queries), now)
+
+
+SHARED_MEMORY_STORE: SharedMemoryStore = None
+def set_shared_memory_store(store: SharedMemoryStore) -> None:
+    global SHARED_MEMORY_STORE
+    SHARED_MEMORY_STORE = store
+def get_shared_memory_store() -> SharedMemoryStore:
+    return SHARED_MEMORY_STORE
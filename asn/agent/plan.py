@@ -5,6 +5,8 @@ Planning module.
 from typing import List, Dict
 from asn.llm.llm import LLMManager
 from asn.llm.prompt import Prompts
+from asn.llm.assembly import assemble_prompt
+from asn.llm.schema import PLAN_SCHEMA, get_fallback_stats
 import json
 
 class Plan:
@@ -21,14 +23,30 @@ class Plan:
         self.plan = data["plan"]
 
     def make_plan(self, characteristics: str, date: str) -> str:
-        prompt_system = Prompts.plan_system.format(characteristics=characteristics)
-        prompt = Prompts.plan.format(date=date)
+        prompt_system, prompt = assemble_prompt("plan", Prompts.plan_system, Prompts.persona.format(characteristics=characteristics), Prompts.plan.format(date=date))
+        plan = None
         try:
-            plan = self.llm._call(prompt=prompt, prompt_sys=prompt_system)
+            plan = self.llm._call(prompt=prompt, prompt_sys=prompt_system, call_site="plan", schema=PLAN_SCHEMA)
             self.plan = json.loads(plan)
+            get_fallback_stats().record("plan", False)
             return plan
         except Exception as e:
             print(f"Error decoding JSON: {plan}\n{e}")
+            get_fallback_stats().record("plan", True)
+            self.plan = []
+            return []
+
+    async def amake_plan(self, characteristics: str, date: str) -> str:
+        prompt_system, prompt = assemble_prompt("plan", Prompts.plan_system, Prompts.persona.format(characteristics=characteristics), Prompts.plan.format(date=date))
+        plan = None
+        try:
+            plan = await self.llm._acall(prompt=prompt, prompt_sys=prompt_system, call_site="plan", schema=PLAN_SCHEMA)
+            self.plan = json.loads(plan)
+            get_fallback_stats().record("plan", False)
+            return plan
+        except Exception as e:
+            print(f"Error decoding JSON: {plan}\n{e}")
+            get_fallback_stats().record("plan", True)
             self.plan = []
             return []
     
@@ -1,7 +1,10 @@
 from langchain.prompts import PromptTemplate
 from asn.utils.time import *
 from asn.llm.llm import LLM, LLMManager
+from asn.llm.retry import LLMUnavailableError
 from asn.llm.prompt import Prompts
+from asn.llm.assembly import assemble_prompt
+from asn.llm.budget import PromptTooLongError, get_prompt_budget
 from asn.utils.logger import get_logger
 
 class ProfileModule:
@@ -23,20 +26,29 @@ class ProfileModule:
                 history_text += f"{time_step} to {add_interval(time_step, time_intv)}: No activities.\n"
             hists.extend(history_step[-20:])
             time_step = add_interval(time_step, time_intv)
+        hist_lines = []
         for hist in hists[-100:]:
             if hist["type"] == "read":
-                history_text += f"{hist['timestamp']} read a post: \"{hist['text']}\"\n"
+                hist_lines.append(f"{hist['timestamp']} read a post: \"{hist['text']}\"\n")
             elif hist["type"] == "like":
-                history_text += f"{hist['timestamp']} like a post: \"{hist['text']}\"\n"
+                hist_lines.append(f"{hist['timestamp']} like a post: \"{hist['text']}\"\n")
             elif hist["type"] == "post":
-                history_text += f"{hist['timestamp']} write a post: \"{hist['text']}\"\n"
+                hist_lines.append(f"{hist['timestamp']} write a post: \"{hist['text']}\"\n")
             elif hist["type"] == "repost" or hist["type"] == "retweet" or hist["type"] == "share":
-                history_text += f"{hist['timestamp']} repost a post: \"{hist['text']}\"\n"
+                hist_lines.append(f"{hist['timestamp']} repost a post: \"{hist['text']}\"\n")
             else:
                 get_logger().error(f"Profile: Unknown history type: {hist['type']}")
-        result = self.llm._call(Prompts.profile.format(history=history_text))
+        try:
+            # 超出上下文长度时从最早的活动开始去掉
+            content = get_prompt_budget().fit("profile", Prompts.profile_system, lambda newest_history: Prompts.profile.format(history=history_text + "".join(newest_history[::-1])), newest_history=hist_lines[::-1])
+            prompt_sys, prompt = assemble_prompt("profile", Prompts.profile_system, content=content)
+            result = self.llm._call(prompt, prompt_sys=prompt_sys, call_site="profile")
+        except (LLMUnavailableError, PromptTooLongError) as e:
+            # 不缓存失败结果，下次调用时重新生成画像
+            get_logger().error(f"ProfileModule: Failed to portrait: {e}")
+            return ""
         self.characteristics = result
-        get_logger().debug(f"Profile: History: {history} to History text: {history_text} to Characteristics: {self.characteristics}")
+        get_logger().debug(f"Profile: History: {history} to History text: {content} to Characteristics: {self.characteristics}")
         get_logger().debug("ProfileModule: New characteristics: " + self.characteristics)
         return self.characteristics
         
@@ -0,0 +1,186 @@
+"""
+Native time-weighted memory retriever.
+TimeWeightedVectorStoreRetriever 每次检索都要先做一次相似度搜索，再在 Python 中逐条为 memory_stream 中的文档计算时间衰减得分、
+逐条改写 last_accessed_at，一周的模拟下来每个 agent 有上千条记忆，检索延迟随之线性增长。
+这里把向量、created_at、last_accessed_at 和 importance 都保存为 NumPy 数组，打分用数组运算完成，top-k 用 argpartition 选出，
+访问时间批量更新。候选规则和相似度得分与原来的 FAISS + TimeWeightedVectorStoreRetriever 相同（见 memory_store.relevance），
+时间衰减按传入的模拟时间 now 计算（原来用的是系统时间），并加上 importance。
+"""
+import os
+import json
+import threading
+import numpy as np
+from datetime import datetime
+from typing import List, Optional
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from asn.agent.memory_store import SharedMemoryStore, relevance
+
+
+def _top(scores: np.ndarray, k: int) -> np.ndarray:
+    # 得分最高的 k 个下标（无序）
+    if len(scores) <= k:
+        return np.arange(len(scores))
+    return np.argpartition(-scores, k - 1)[:k]
+
+
+class NativeMemoryRetriever:
+    """
+    One agent's memories as NumPy arrays, offering the parts of TimeWeightedVectorStoreRetriever that NaiveMemoryModule uses.
+    Score: `(1 - decay_rate) ** hours_since_last_access + importance` plus `relevance(similarity)` for the `search_k` most similar memories,
+    with hours counted from the simulation time passed as `now`; candidates are those `search_k` memories and the `k` latest ones.
+    `importance` is read from the document metadata (0 if absent).
+    Document ids are the row numbers (as strings).
+    """
+    def __init__(self, embeddings: Embeddings, dim: int, k: int = 5, decay_rate: float = 1e-6, search_k: int = 100, capacity: int = 64):
+        self.embeddings = embeddings
+        self.dim = dim
+        self.k = k
+        self.decay_rate = decay_rate
+        self.search_k = search_k
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.created_at = np.zeros(capacity, dtype=np.float64)
+        self.last_accessed_at = np.zeros(capacity, dtype=np.float64)
+        self.importance = np.zeros(capacity, dtype=np.float64)
+        self.texts: List[str] = []
+        self.kinds: List[str] = []
+        self.size = 0
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _timestamp(time: Optional[datetime]) -> float:
+        return (time if time is not None else datetime.now()).timestamp()
+
+    def _grow(self, size: int) -> None:
+        capacity = len(self.vectors)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        extra = capacity - len(self.vectors)
+        self.vectors = np.concatenate([self.vectors, np.zeros((extra, self.dim), dtype=np.float32)])
+        self.created_at = np.concatenate([self.created_at, np.zeros(extra)])
+        self.last_accessed_at = np.concatenate([self.last_accessed_at, np.zeros(extra)])
+        self.importance = np.concatenate([self.importance, np.zeros(extra)])
+
+    def _add(self, documents: List[Document], embeddings: List[List[float]], current_time: Optional[datetime]) -> List[str]:
+        if not documents:
+            return []
+        num = len(documents)
+        with self.lock:
+            start = self.size
+            self._grow(start + num)
+            self.vectors[start:start + num] = SharedMemoryStore._normalize(embeddings)
+            self.created_at[start:start + num] = [self._timestamp(document.metadata["created_at"] if "created_at" in document.metadata else current_time) for document in documents]
+            self.last_accessed_at[start:start + num] = self._timestamp(current_time)
+            self.importance[start:start + num] = [document.metadata["importance"] if "importance" in document.metadata else 0.0 for document in documents]
+            self.texts.extend(document.page_content for document in documents)
+            self.kinds.extend(document.metadata["kind"] if "kind" in document.metadata else "memory" for document in documents)
+            self.size += num
+        return [str(row) for row in range(start, start + num)]
+
+    def add_documents(self, documents: List[Document], current_time: datetime = None, **kwargs) -> List[str]:
+        return self._add(documents, self.embeddings.embed_documents([document.page_content for document in documents]), current_time)
+
+    async def aadd_documents(self, documents: List[Document], current_time: datetime = None, **kwargs) -> List[str]:
+        return self._add(documents, await self.embeddings.aembed_documents([document.page_content for document in documents]), current_time)
+
+    def search(self, query: List[float], now: datetime = None) -> List[Document]:
+        query = SharedMemoryStore._normalize([query])[0]
+        now = self._timestamp(now)
+        with self.lock:
+            size = self.size
+            if size == 0:
+                return []
+            similarity = self.vectors[:size] @ query
+            salient = np.zeros(size, dtype=bool)
+            salient[_top(similarity, self.search_k)] = True
+            latest = np.zeros(size, dtype=bool)
+            latest[max(0, size - self.k):] = True
+            hours_passed = (now - self.last_accessed_at[:size]) / 3600
+            scores = (1.0 - self.decay_rate) ** hours_passed + self.importance[:size] + np.where(salient, relevance(similarity), 0.0)
+            scores = np.where(salient | latest, scores, -np.inf)
+            rows = _top(scores, self.k)
+            rows = rows[np.isfinite(scores[rows])]
+            rows = rows[np.argsort(-scores[rows], kind="stable")]
+            self.last_accessed_at[rows] = now
+            return self.documents(rows.tolist())
+
+    def invoke(self, query: str, now: datetime = None) -> List[Document]:
+        return self.search(self.embeddings.embed_query(query), now)
+
+    async def ainvoke(self, query: str, now: datetime = None) -> List[Document]:
+        return self.search(await self.embeddings.aembed_query(query), now)
+
+    def replace(self, doc_id: str, text: str, embedding: List[float]) -> None:
+        with self.lock:
+            self.vectors[int(doc_id)] = SharedMemoryStore._normalize([embedding])[0]
+            self.texts[int(doc_id)] = text
+
+    def remove(self, doc_ids: List[str]) -> None:
+        """Evict memories. The remaining rows are compacted, so ids of later memories change."""
+        with self.lock:
+            keep = np.ones(self.size, dtype=bool)
+            keep[[int(doc_id) for doc_id in doc_ids]] = False
+            num = int(keep.sum())
+            self.vectors[:num] = self.vectors[:self.size][keep]
+            self.created_at[:num] = self.created_at[:self.size][keep]
+            self.last_accessed_at[:num] = self.last_accessed_at[:self.size][keep]
+            self.importance[:num] = self.importance[:self.size][keep]
+            self.texts = [text for text, kept in zip(self.texts, keep) if kept]
+            self.kinds = [kind for kind, kept in zip(self.kinds, keep) if kept]
+            self.size = num
+
+    def all_documents(self) -> List[Document]:
+        """All memories, oldest first."""
+        with self.lock:
+            return self.documents(list(range(self.size)))
+
+    def documents(self, rows: List[int]) -> List[Document]:
+        with self.lock:
+            return [
+                Document(page_content=self.texts[row], metadata={
+                    "created_at": datetime.fromtimestamp(self.created_at[row]),
+                    "last_accessed_at": datetime.fromtimestamp(self.last_accessed_at[row]),
+                    "importance": float(self.importance[row]),
+                    "kind": self.kinds[row],
+                    "buffer_idx": row,
+                })
+                for row in rows
+            ]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def save(self, path: str, index: str) -> None:
+        """Write the memories to `{path}/{index}.npz` and `{path}/{index}.json`."""
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with self.lock:
+            np.savez(os.path.join(path, f"{index}.npz"), vectors=self.vectors[:self.size], created_at=self.created_at[:self.size],
+                     last_accessed_at=self.last_accessed_at[:self.size], importance=self.importance[:self.size])
+            with open(os.path.join(path, f"{index}.json"), "w") as f:
+                json.dump({"dim": self.dim, "texts": self.texts, "kinds": self.kinds}, f)
+
+    @classmethod
+    def load(cls, path: str, index: str, embeddings: Embeddings, k: int = 5, decay_rate: float = 1e-6) -> "NativeMemoryRetriever":
+        with open(os.path.join(path, f"{index}.json"), "r") as f:
+            meta = json.load(f)
+        arrays = np.load(os.path.join(path, f"{index}.npz"))
+        retriever = cls(embeddings, meta["dim"], k=k, decay_rate=decay_rate, capacity=max(64, len(meta["texts"])))
+        retriever.size = len(meta["texts"])
+        retriever.vectors[:retriever.size] = arrays["vectors"]
+        retriever.created_at[:retriever.size] = arrays["created_at"]
+        retriever.last_accessed_at[:retriever.size] = arrays["last_accessed_at"]
+        retriever.importance[:retriever.size] = arrays["importance"]
+        retriever.texts = meta["texts"]
+        retriever.kinds = meta["kinds"] if "kinds" in meta else ["memory"] * retriever.size
+        return retriever
+
+
+NATIVE_RETRIEVER = False
+def set_native_retriever(native: bool) -> None:
+    global NATIVE_RETRIEVER
+    NATIVE_RETRIEVER = native
+def get_native_retriever() -> bool:
+    return NATIVE_RETRIEVER
@@ -0,0 +1,58 @@
+"""
+Deferred memory summarisation.
+开启后 add_memory / add_memories 先写入原始观察（按原文嵌入，检索照常可用），LLM 总结和新文本的嵌入交给后台线程池完成，
+不再占用 agent 每一步的关键路径；总结结果由 agent 自己在下一次检索前替换进记忆（见 NaiveMemoryModule）。
+"""
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+
+class MemorySummarizer:
+    """Thread pool running memory summaries in the background; `waits` counts retrievals that had to wait for one."""
+    def __init__(self, max_workers: int = 32):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="MemorySummarizer")
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.waits = 0
+
+    def submit(self, fn: Callable, *args) -> Future:
+        # 复制 contextvars，使后台调用仍然记到提交它的用户名下
+        context = contextvars.copy_context()
+        with self.lock:
+            self.submitted += 1
+        future = self.executor.submit(context.run, fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future) -> None:
+        with self.lock:
+            if future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def record_wait(self) -> None:
+        with self.lock:
+            self.waits += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "pending": self.submitted - self.completed - self.failed,
+                "waits": self.waits,
+            }
+
+
+MEMORY_SUMMARIZER: MemorySummarizer = None
+def set_memory_summarizer(summarizer: MemorySummarizer) -> None:
+    global MEMORY_SUMMARIZER
+    MEMORY_SUMMARIZER = summarizer
+def get_memory_summarizer() -> MemorySummarizer:
+    return MEMORY_SUMMARIZER
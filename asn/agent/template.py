@@ -0,0 +1,99 @@
+"""
+Template fast path for trivial memories.
+大部分观察只是“读了帖子，没有点赞也没有转发”，信息量很低，却仍然要经过 PROMPT_NAIVE_MULTI_MEMORY 改写。
+开启后这类批次直接按确定性的模板汇总成一条记忆（读了几条、关于哪些话题、都没有互动），只有包含点赞、转发或发帖的批次才调用 LLM。
+"""
+import re
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import List, Optional
+
+
+# 只有这些行为的批次视为低信息量（"no post" 表示这次没有发帖）
+TRIVIAL_TYPES = {"read"}
+
+STOPWORDS = {
+    "about", "after", "again", "being", "could", "every", "first", "their", "there", "these", "thing", "think",
+    "those", "where", "which", "while", "would", "should", "other", "today", "still", "really", "people", "https",
+}
+
+
+def is_trivial(act) -> bool:
+    return act.type in TRIVIAL_TYPES or (act.type == "post" and act.text.lower() == "no post")
+
+
+def topics(texts: List[str], num: int = 3) -> List[str]:
+    # 优先使用话题标签，不够时补充出现次数最多的长词
+    hashtags = Counter(tag.lower() for text in texts for tag in re.findall(r"#\w+", text))
+    found = [tag for tag, _ in hashtags.most_common(num)]
+    if len(found) < num:
+        words = Counter(
+            word.lower() for text in texts for word in re.findall(r"(?<![#\w])[A-Za-z]{5,}", text)
+            if word.lower() not in STOPWORDS
+        )
+        # 多条帖子时只保留至少出现两次的词
+        least = 2 if len(texts) > 1 else 1
+        found += [word for word, count in words.most_common() if count >= least and "#" + word not in found][:num - len(found)]
+    return found
+
+
+def excerpt(text: str, max_chars: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= max_chars else text[:max_chars].rstrip() + "..."
+
+
+class TemplateMemory:
+    """
+    Writes memories for batches without likes, reposts or posts from a template instead of the LLM.
+    Up to `max_excerpts` posts are quoted (`excerpt_chars` characters each) so that the memory can still be retrieved by content.
+    """
+    def __init__(self, max_excerpts: int = 5, excerpt_chars: int = 80):
+        self.max_excerpts = max_excerpts
+        self.excerpt_chars = excerpt_chars
+        self.lock = threading.Lock()
+        self.templated = 0
+        self.llm_calls = 0
+
+    def render(self, texts: List[str], now: datetime) -> str:
+        if not texts:
+            return f"On {now:%Y-%m-%d %H:%M}, I didn't write a post."
+        about = topics(texts)
+        about = " about " + ", ".join(about) if about else ""
+        if len(texts) == 1:
+            memory = f"On {now:%Y-%m-%d %H:%M}, I read a post{about}, and I didn't like or repost it."
+        else:
+            memory = f"On {now:%Y-%m-%d %H:%M}, I read {len(texts)} posts{about}, and I didn't like or repost any of them."
+        excerpts = ["\"%s\"" % excerpt(text, self.excerpt_chars) for text in texts[:self.max_excerpts]]
+        if excerpts:
+            memory += "\nSome of them: " + "; ".join(excerpts)
+        return memory
+
+    def write(self, acts: list, now: datetime) -> Optional[str]:
+        """The templated memory for `acts`, or None if the batch is informative enough to go through the LLM."""
+        trivial = all(is_trivial(act) for act in acts)
+        with self.lock:
+            if trivial:
+                self.templated += 1
+            else:
+                self.llm_calls += 1
+        if not trivial:
+            return None
+        return self.render([act.text for act in acts if act.type == "read"], now)
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.templated + self.llm_calls
+            return {
+                "llm_calls_avoided": self.templated,
+                "llm_calls": self.llm_calls,
+                "avoided_rate": self.templated / total if total else 0.0,
+            }
+
+
+TEMPLATE_MEMORY: TemplateMemory = None
+def set_template_memory(template: TemplateMemory) -> None:
+    global TEMPLATE_MEMORY
+    TEMPLATE_MEMORY = template
+def get_template_memory() -> TemplateMemory:
+    return TEMPLATE_MEMORY
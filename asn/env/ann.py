@@ -0,0 +1,154 @@
+"""
+Approximate nearest neighbour backend for the recommender.
+精确打分要和 Environment 中的每一条消息计算相似度，模拟中不断产生的帖子和转发使这部分开销无限增长。
+开启后消息数超过 threshold 时，Recommender 自动建立 FAISS HNSW（或 IVF）索引并随新消息增量 add：
+兴趣推荐先用索引取出最相似的 candidates 条消息，加上最新的 recent 条消息（时间衰减下它们最可能胜出），
+再按时间衰减和交互惩罚精确重排；热点推荐不受影响。
+
+召回率基准（与精确打分比较）：python -m asn.env.ann --messages 1000000 --dim 256
+"""
+import time
+import argparse
+import threading
+import numpy as np
+import faiss
+
+
+class ANNIndex:
+    """Incremental inner-product index over the recommender's rows (faiss ids are row numbers)."""
+    def __init__(self, dim: int, kind: str = "hnsw", M: int = 32, ef_construction: int = 80, ef_search: int = 128, nlist: int = 1024, nprobe: int = 32):
+        self.kind = kind
+        if kind == "hnsw":
+            self.index = faiss.IndexHNSWFlat(dim, M, faiss.METRIC_INNER_PRODUCT)
+            self.index.hnsw.efConstruction = ef_construction
+            self.index.hnsw.efSearch = ef_search
+        elif kind == "ivf":
+            self.quantizer = faiss.IndexFlatIP(dim)
+            self.index = faiss.IndexIVFFlat(self.quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            self.index.nprobe = nprobe
+        else:
+            raise ValueError(f"Unknown ANN index type: {kind}")
+        self.lock = threading.Lock()
+
+    def build(self, vectors: np.ndarray) -> None:
+        # IVF 需要先用已有的向量训练聚类中心
+        with self.lock:
+            if not self.index.is_trained:
+                self.index.train(np.ascontiguousarray(vectors, dtype=np.float32))
+            self.index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+
+    def add(self, vectors: np.ndarray) -> None:
+        with self.lock:
+            self.index.add(np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.index.d))
+
+    def search(self, queries: np.ndarray, k: int) -> np.ndarray:
+        """Rows of the `k` most similar messages for each query (-1 where there are fewer)."""
+        with self.lock:
+            _, rows = self.index.search(np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.index.d), k)
+        return rows
+
+    def __len__(self) -> int:
+        return self.index.ntotal
+
+
+class ANNBackend:
+    """
+    Settings for switching the recommender to an ANN index once it holds more than `threshold` messages.
+    `params` are passed to ANNIndex (e.g. M, ef_search for HNSW; nlist, nprobe for IVF).
+    """
+    def __init__(self, kind: str = "hnsw", threshold: int = 200000, candidates: int = 512, recent: int = 4096, **params):
+        self.kind = kind
+        self.threshold = threshold
+        self.candidates = candidates
+        self.recent = recent
+        self.params = params
+        self.lock = threading.Lock()
+        self.builds = 0
+        self.build_seconds = 0.0
+        self.searches = 0
+
+    def build(self, vectors: np.ndarray) -> ANNIndex:
+        start = time.time()
+        index = ANNIndex(vectors.shape[1], self.kind, **self.params)
+        index.build(vectors)
+        with self.lock:
+            self.builds += 1
+            self.build_seconds += time.time() - start
+        return index
+
+    def candidate_rows(self, index: ANNIndex, queries: np.ndarray, size: int) -> list:
+        """Per query: the ANN candidates plus the `recent` newest rows, deduplicated."""
+        found = index.search(queries, self.candidates)
+        recent = np.arange(max(0, size - self.recent), size)
+        with self.lock:
+            self.searches += len(found)
+        return [np.union1d(rows[(rows >= 0) & (rows < size)], recent) for rows in found]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"builds": self.builds, "build_seconds": self.build_seconds, "searches": self.searches}
+
+
+ANN_BACKEND: ANNBackend = None
+def set_ann_backend(backend: ANNBackend) -> None:
+    global ANN_BACKEND
+    ANN_BACKEND = backend
+def get_ann_backend() -> ANNBackend:
+    return ANN_BACKEND
+
+
+def benchmark(messages: int = 200000, dim: int = 256, queries: int = 200, k: int = 5, hours: int = 24 * 14, clusters: int = 256,
+              seed: int = 0, backends: list = None) -> list:
+    """
+    Recall of the ANN interest ranking (similarity x time decay, top `k`) against exact scoring on synthetic clustered messages
+    posted in time order over `hours` hours, with per-query latencies.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, messages)] + 0.5 * rng.normal(size=(messages, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    decay = (0.96 ** np.linspace(hours, 0, messages)).astype(np.float32)
+    interests = vectors[rng.integers(0, messages, (queries, 5))].mean(axis=1)
+    interests /= np.linalg.norm(interests, axis=1, keepdims=True)
+
+    def top(scores, k):
+        rows = np.argpartition(-scores, k - 1)[:k]
+        return rows[np.argsort(-scores[rows])]
+
+    start = time.time()
+    exact = [top((vectors @ query) * decay, k) for query in interests]
+    exact_ms = (time.time() - start) / queries * 1000
+    results = [{"backend": "exact", "recall": 1.0, "ms_per_query": exact_ms}]
+    # recent=0 单独衡量 ANN 候选本身的召回率
+    backends = backends if backends is not None else [ANNBackend("hnsw"), ANNBackend("hnsw", recent=0), ANNBackend("ivf"), ANNBackend("ivf", recent=0)]
+    indexes = {}
+    for backend in backends:
+        key = (backend.kind, tuple(sorted(backend.params.items())))
+        if key not in indexes:
+            indexes[key] = backend.build(vectors), backend.build_seconds
+        index, build_seconds = indexes[key]
+        start = time.time()
+        hits = 0
+        for query, truth in zip(interests, exact):
+            rows = backend.candidate_rows(index, query[None, :], messages)[0]
+            picked = rows[top((vectors[rows] @ query) * decay[rows], min(k, len(rows)))]
+            hits += len(np.intersect1d(picked, truth))
+        results.append({
+            "backend": f"{backend.kind} {backend.params} candidates={backend.candidates} recent={backend.recent}",
+            "recall": hits / (queries * k),
+            "ms_per_query": (time.time() - start) / queries * 1000,
+            "build_seconds": build_seconds,
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall and latency of ANN candidate retrieval against exact recommender scoring")
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--hours", type=int, default=24 * 14)
+    args = parser.parse_args()
+    for result in benchmark(args.messages, args.dim, args.queries, args.k, args.hours):
+        print(result)
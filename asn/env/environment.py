@@ -5,8 +5,10 @@ import threading
 from asn.utils.time import TIME_FORMAT
 from asn.utils.mastodon import post_status_with_time
 from asn.env.recommender import Recommender
+from asn.env.timeline import TimeIndex, FollowFeed, get_follow_feed, merge
 from asn.agent.action import Act
 from asn.agent.agent import Agent
+from asn.llm.usage import usage_scope
 from asn.utils.logger import get_logger
 
 
@@ -58,8 +60,18 @@ class User:
         return acts
     
     # Agent calls
-    def read_posts(self, msgs, now: datetime):
-        actss = self.agent.recieve_all(msgs, now)
+    def read_posts(self, msgs, now: datetime, memories_retrieved=None):
+        actss = self.agent.recieve_all(msgs, now, memories_retrieved=memories_retrieved)
+        return actss
+
+    # Agent calls
+    async def aread_post(self, msg, now: datetime):
+        acts = await self.agent.arecieve(msg, now)
+        return acts
+
+    # Agent calls
+    async def aread_posts(self, msgs, now: datetime, memories_retrieved=None):
+        actss = await self.agent.arecieve_all(msgs, now, memories_retrieved=memories_retrieved)
         return actss
     
     def save_to_dict(self, path):
@@ -145,10 +157,21 @@ class Environment:
         self.messages: List[Message] = []
         self.id2user: Dict[int, User] = {}
         self.id2message: Dict[int, Message] = {}
+        # 按时间排序的消息索引：全部消息和只含原始消息（不含转发）的视图
+        self.timeline = TimeIndex()
+        self.origin_timeline = TimeIndex()
+        # 关注内容：每个作者的原始消息时间索引，关注者反向索引，以及开启 fan_out 时每个用户的收件箱
+        self.feed = get_follow_feed() if get_follow_feed() is not None else FollowFeed()
+        self.author_timelines: Dict[int, TimeIndex] = {}
+        self.followers_of: Dict[int, List[int]] = {}
+        self.inboxes: Dict[int, TimeIndex] = {}
         self.log = []
         self.now = None
         self.intv = None
         self.recommender = Recommender()
+        # 本步预先为活跃用户计算好的推荐结果 {user.id: List[Message]}，及其对应的时间窗口
+        self.recommendations = {}
+        self.recommendations_window = None
         self.lock_message = threading.Lock()
 
     def get_user_by_id(self, id: str) -> User:
@@ -159,14 +182,36 @@ class Environment:
 
     def add_message(self, message: Message, need_embed: bool = True):
         if need_embed:
-            message.embed = self.recommender.embed_model.embed_query(message.text)
+            with usage_scope(call_site="message"):
+                message.embed = self.recommender.embed_model.embed_query(message.text)
         self.messages.append(message)
         self.id2message[message.id] = message
+        self.timeline.add(message.timestamp, message)
+        if message.origin_id() == message.id:
+            self.origin_timeline.add(message.timestamp, message)
+            self.author_timelines.setdefault(message.author_id, TimeIndex()).add(message.timestamp, message)
+            if self.feed.fan_out:
+                for user_id in self.followers_of.get(message.author_id, []):
+                    self.inboxes[user_id].add(message.timestamp, message)
+        self.recommender.add(message)
         return message
 
+    def like_message(self, message: Message, user_id, timestamp: str):
+        # 点赞数同时记入推荐器
+        message.liked_by.append((user_id, timestamp))
+        self.recommender.like(message)
+
     def add_user(self, user: User):
         self.users.append(user)
         self.id2user[user.id] = user
+        for following_id in set(user.get_following_ids()):
+            self.followers_of.setdefault(following_id, []).append(user.id)
+        if self.feed.fan_out:
+            # 用户加入前已有的关注内容一次性写入收件箱
+            inbox = TimeIndex()
+            for message in merge([self.author_timelines[following_id] for following_id in set(user.get_following_ids()) if following_id in self.author_timelines]):
+                inbox.add(message.timestamp, message)
+            self.inboxes[user.id] = inbox
         return user
 
     def update_time(self, now: datetime, intv: str=None):
@@ -174,17 +219,37 @@ class Environment:
         if intv:
             self.intv = intv
 
+    def messages_between(self, time_begin: Optional[datetime] = None, time_end: Optional[datetime] = None, origin_only: bool = True) -> List[Message]:
+        """Messages posted within [time_begin, time_end] (None: unbounded) in time order, only original ones by default."""
+        return (self.origin_timeline if origin_only else self.timeline).between(time_begin, time_end)
+
+    def followed_messages(self, user: User, time_begin: Optional[datetime] = None, time_end: Optional[datetime] = None, limit: Optional[int] = None) -> List[Message]:
+        """Original messages by `user`'s followings within the window, oldest first; at most the newest `limit` (default: the feed's limit)."""
+        limit = limit if limit is not None else self.feed.limit
+        if self.feed.fan_out:
+            return self.inboxes[user.id].between(time_begin, time_end, limit)
+        return merge([self.author_timelines[following_id] for following_id in set(user.get_following_ids()) if following_id in self.author_timelines], time_begin, time_end, limit)
+
+    def recommend_all(self, users: List[User], time_begin: Optional[datetime] = None, time_end: Optional[datetime] = None, k: int=10):
+        """Precompute this step's recommendations for `users` in one batch, served by `distribute_messages_for_user_by_time` for the same window."""
+        interacted_ids = [set(user.get_status_ids() + user.get_like_ids() + user.get_repost_ids()) for user in users]
+        self.recommendations = self.recommender.recommend_all(users, self.messages_between(time_begin, time_end), top_k=k, interacted_ids=interacted_ids, time_now=self.now)
+        self.recommendations_window = (time_begin, time_end)
+
     def distribute_messages_for_user_by_time(self, user: User, time_begin: datetime, time_end: datetime, k: int=10) -> List[Message]:
         # 排除用户已经交互过的帖子
         msg_ids_interacted = set(user.get_status_ids() + user.get_like_ids() + user.get_repost_ids())
 
-        msgs_origin = [msg for msg in self.messages if msg.origin_id() == msg.id]
+        # 只考虑时间窗口内的原始消息
+        msgs_origin = self.messages_between(time_begin, time_end)
         # followings' messages
-        following_ids = set(user.get_following_ids())
-        msgs_follow = [msg for msg in msgs_origin if msg.author_id in following_ids]
+        msgs_follow = self.followed_messages(user, time_begin, time_end)
         # print(f"msgs_follow for user {user.id}: {msgs_follow}")
-        # recommend messages
-        msgs_recommended = self.recommender.recommend(user, [msg for msg in msgs_origin], top_k=k, interacted_ids=msg_ids_interacted)
+        # recommend messages（时间衰减按模拟时间计算）
+        if self.recommendations_window == (time_begin, time_end) and user.id in self.recommendations:
+            msgs_recommended = self.recommendations.pop(user.id)
+        else:
+            msgs_recommended = self.recommender.recommend(user, msgs_origin, top_k=k, interacted_ids=msg_ids_interacted, time_now=self.now)
         get_logger().info(f"Recommended messages {[msg.origin_id() for msg in msgs_recommended]} for user {user.id}")
         # print(f"msgs_recommended for user {user.id}: {msgs_recommended}")
         # remove duplicates
@@ -219,5 +284,4 @@ class Environment:
         env.log = dict["log"]
         env.now = datetime.strptime(dict["now"], TIME_FORMAT)
         env.intv = dict["intv"]
-        env.recommender = Recommender()
         return env
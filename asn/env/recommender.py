@@ -1,58 +1,209 @@
+import threading
 import numpy as np
-from typing import List, Dict
+from typing import List, Dict, Optional
 from langchain_core.embeddings import Embeddings
 from datetime import datetime
 from asn.utils.time import *
 from asn.llm.llm import LLMManager
+from asn.env.ann import ANNIndex, get_ann_backend
+from asn.utils.logger import get_logger
 
 
 class Recommender:
+    """
+    Recommends messages by interest similarity and hotness.
+    Messages are indexed as they are added: normalised embeddings in one growable float32 matrix, with parallel arrays
+    of timestamps, like counts and whether the message is original (not a repost).
+    With an ANN backend set (see asn/env/ann.py), interest candidates come from an ANN index once there are enough messages.
+    The index is built in a background thread from a snapshot of the rows; until it is swapped in, scoring stays exact.
+    """
     embed_size: int
     embed_model: Embeddings
 
-    def __init__(self):
+    def __init__(self, capacity: int = 1024):
         self.embed_size, self.embed_model = LLMManager.get_embed_model()
+        self.vectors = np.zeros((capacity, self.embed_size), dtype=np.float32)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.likes = np.zeros(capacity, dtype=np.float64)
+        self.is_origin = np.zeros(capacity, dtype=bool)
+        self.messages = []
+        self.id2row: Dict[str, int] = {}
+        self.ann: Optional[ANNIndex] = None
+        self.ann_builder: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
 
-    def recommend(self, user, messages, top_k: int = 10, interacted_ids = [], time_now = None):
+    def _grow(self, size: int) -> None:
+        capacity = len(self.timestamps)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        extra = capacity - len(self.timestamps)
+        self.vectors = np.concatenate([self.vectors, np.zeros((extra, self.vectors.shape[1]), dtype=np.float32)])
+        self.timestamps = np.concatenate([self.timestamps, np.zeros(extra)])
+        self.likes = np.concatenate([self.likes, np.zeros(extra)])
+        self.is_origin = np.concatenate([self.is_origin, np.zeros(extra, dtype=bool)])
+
+    def add(self, message) -> None:
+        """Index a message (its embedding must already be set)."""
+        with self.lock:
+            row = len(self.messages)
+            self._grow(row + 1)
+            if message.embed is not None:
+                vector = np.asarray(message.embed, dtype=np.float32)
+                norm = np.linalg.norm(vector)
+                self.vectors[row] = vector / norm if norm > 0 else vector
+            self.timestamps[row] = message.timestamp.timestamp()
+            self.likes[row] = len(message.liked_by)
+            self.is_origin[row] = message.origin_id() == message.id
+            self.messages.append(message)
+            self.id2row[message.id] = row
+            # 消息数达到阈值时在后台线程建立 ANN 索引，之后增量添加
+            backend = get_ann_backend()
+            if self.ann is not None:
+                self.ann.add(self.vectors[row])
+            elif backend is not None and self.ann_builder is None and len(self.messages) >= backend.threshold:
+                # 已写入的行不会再改变，扩容也只替换数组，所以快照不需要复制
+                self.ann_builder = threading.Thread(target=self._build_ann, args=(backend, self.vectors[:len(self.messages)]), daemon=True)
+                self.ann_builder.start()
+
+    def _build_ann(self, backend, snapshot: np.ndarray) -> None:
+        # 在锁外建索引，不阻塞 add / like / recommend；建好后补上期间新增的行再换上
+        try:
+            index = backend.build(snapshot)
+        except Exception as e:
+            # 不再重试，继续精确打分
+            get_logger().error(f"Error in building the ANN index: {e}")
+            return
+        with self.lock:
+            index.add(self.vectors[len(snapshot):len(self.messages)])
+            self.ann = index
+
+    def like(self, message) -> None:
+        with self.lock:
+            self.likes[self.id2row[message.id]] += 1
+
+    def _rows(self, ids) -> np.ndarray:
+        return np.array([self.id2row[id] for id in ids if id in self.id2row], dtype=np.int64)
+
+    def _top(self, scores: np.ndarray, k: int) -> np.ndarray:
+        # 得分最高的 k 个下标，按得分从高到低排列
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k <= 0:
+            return np.array([], dtype=np.int64)
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top], kind="stable")]
+
+    def _snapshot(self, messages=None):
+        # 候选消息的行号（messages 为 None 时为所有原始消息）及其向量、时间戳、点赞数
+        with self.lock:
+            size = len(self.messages)
+            if messages is None:
+                rows = np.flatnonzero(self.is_origin[:size])
+            else:
+                rows = self._rows(msg.id for msg in messages)
+                rows = rows[rows < size]
+            return rows, self.vectors[:size], self.timestamps[rows], self.likes[rows]
+
+    def _interest(self, user) -> Optional[np.ndarray]:
+        # 获取用户喜欢的所有帖子（不限于候选的时间窗口），按时间排序取最后5个，平均embedding（归一化）；没有喜欢的帖子时返回 None
+        with self.lock:
+            fav = self._rows(user.get_like_ids())
+            if len(fav) == 0:
+                return None
+            fav = fav[np.argsort(-self.timestamps[fav], kind="stable")[:5]]
+            embeds = [self.messages[row].embed for row in fav]
+        user_embed = np.mean(embeds, axis=0).astype(np.float32)
+        norm = np.linalg.norm(user_embed)
+        return user_embed / norm if norm > 0 else user_embed
+
+    def _use_ann(self, num_candidates: int) -> bool:
+        # 候选少（例如时间窗口内的消息）时精确打分更快也更准
+        return self.ann is not None and num_candidates >= get_ann_backend().threshold
+
+    def _ann_candidates(self, rows: np.ndarray, vectors: np.ndarray, queries: np.ndarray) -> list:
+        # 每个查询的 ANN 候选在 rows 中的位置
+        position = np.full(len(vectors), -1, dtype=np.int64)
+        position[rows] = np.arange(len(rows))
+        found = get_ann_backend().candidate_rows(self.ann, queries, len(vectors))
+        return [position[found_rows][position[found_rows] >= 0] for found_rows in found]
+
+    def recommend(self, user, messages=None, top_k: int = 10, interacted_ids = [], time_now = None):
         """
+        param messages: 候选消息，None 表示所有原始消息（不含转发）
         param interacted_ids: List[int] #交互过的消息origin_id，降低这些消息的推荐权重
         """
+        # 一次矩阵-向量乘法完成打分，时间衰减和交互惩罚都是数组运算，top-k 用 argpartition 选出
+        rows, vectors, timestamps, likes = self._snapshot(messages)
+        decay = self.decay_weights(timestamps, time_now if time_now is not None else datetime.now())
+        # 交互过的消息得分减半
+        penalty = np.where(np.isin(rows, self._rows(interacted_ids)), 0.5, 1.0)
         # 一半是热点，一半基于兴趣
-        messages_sim = []
-        messages_hot = []
-        # 获取用户喜欢的帖子，按时间排序取最后5个，平均embedding
-        fav_ids = set(user.get_like_ids())
-        fav_messages = [msg for msg in messages if msg.id in fav_ids]
-        if len(fav_messages) > 0:
-            fav_messages = sorted(fav_messages, key=lambda x: x.timestamp, reverse=True)[:5]
-            user_embed = np.mean([msg.embed for msg in fav_messages], axis=0)
+        messages_sim = np.array([], dtype=np.int64)
+        user_embed = self._interest(user)
+        if user_embed is not None and self._use_ann(len(rows)):
+            # ANN 取出候选后按时间衰减和交互惩罚重排
+            found = self._ann_candidates(rows, vectors, user_embed[None, :])[0]
+            messages_sim = found[self._top((vectors[rows[found]] @ user_embed) * decay[found] * penalty[found], top_k // 2)]
+        elif user_embed is not None:
             # 计算相似度
-            sim = [(msg, self.similarity(user_embed, msg.embed) * self.decay_weight(msg.timestamp, datetime.now())) for msg in messages]
-            # 降低交互过的消息的相似度
-            updated_sim = []
-            for msg, _ in sim:
-                if msg.origin_id() in interacted_ids:
-                    updated_sim.append((msg, _ * 0.5))
-                else:
-                    updated_sim.append((msg, _))
-            sim = updated_sim
-            # 按相似度排序
-            sim = sorted(sim, key=lambda x: x[1], reverse=True)
-            messages_sim = [msg for msg, _ in sim[:top_k//2]]
+            messages_sim = self._top((vectors[rows] @ user_embed) * decay * penalty, top_k // 2)
         # 热点
-        hot = [(msg, len(msg.liked_by) * self.decay_weight(msg.timestamp, datetime.now())) for msg in messages if msg.id not in [m.id for m in messages_sim]]
-        # 降低交互过的消息的热度
-        updated_hot = []
-        for msg, _ in hot:
-            if msg.origin_id() in interacted_ids:
-                updated_hot.append((msg, _ * 0.5))
-            else:
-                updated_hot.append((msg, _))
-        hot = updated_hot
-        hot = sorted(hot, key=lambda x: x[1], reverse=True)
-        messages_hot = [msg for msg, _ in hot[:top_k//2]]
-        return list(set(messages_sim + messages_hot))
-    
+        hot = likes * decay * penalty
+        hot[messages_sim] = -np.inf
+        messages_hot = self._top(hot, top_k // 2)
+        return list(set(self.messages[row] for row in rows[np.concatenate([messages_sim, messages_hot])]))
+
+    def recommend_all(self, users, messages=None, top_k: int = 10, interacted_ids = None, time_now = None, chunk_users: int = 256) -> Dict:
+        """
+        Recommendations for many users at once, equal to calling `recommend` for each of them on the same snapshot.
+        The candidates, decay and hotness are computed once, and interest scores of `chunk_users` users at a time with one matrix-matrix product.
+        param interacted_ids: 每个用户交互过的消息 id，与 users 一一对应
+        return: {user.id: List[Message]}
+        """
+        interacted_ids = interacted_ids if interacted_ids is not None else [[] for _ in users]
+        rows, vectors, timestamps, likes = self._snapshot(messages)
+        decay = self.decay_weights(timestamps, time_now if time_now is not None else datetime.now())
+        # 每个用户交互过的消息在候选中的位置（交互惩罚是稀疏的）
+        interacted = [np.flatnonzero(np.isin(rows, self._rows(ids))) for ids in interacted_ids]
+        # 兴趣：有喜欢的帖子的用户分块堆叠成矩阵，一次矩阵乘法得到所有候选的相似度
+        messages_sim = {}
+        interests = [(i, self._interest(user)) for i, user in enumerate(users)]
+        interests = [(i, embed) for i, embed in interests if embed is not None]
+        if interests and self._use_ann(len(rows)):
+            # ANN 一次批量取出所有用户的候选，再逐个用户精确重排
+            found = self._ann_candidates(rows, vectors, np.stack([embed for _, embed in interests]))
+            for (i, embed), found_rows in zip(interests, found):
+                scores = (vectors[rows[found_rows]] @ embed) * decay[found_rows] * np.where(np.isin(found_rows, interacted[i]), 0.5, 1.0)
+                messages_sim[i] = found_rows[self._top(scores, top_k // 2)]
+            interests = []
+        if interests:
+            candidate_vectors, candidate_decay = vectors[rows], decay.astype(np.float32)
+        for begin in range(0, len(interests), chunk_users):
+            chunk = interests[begin:begin + chunk_users]
+            sim = (np.stack([embed for _, embed in chunk]) @ candidate_vectors.T) * candidate_decay
+            for j, (i, _) in enumerate(chunk):
+                sim[j, interacted[i]] *= 0.5
+                messages_sim[i] = self._top(sim[j], top_k // 2)
+        # 热点：所有用户共用一个按热度排好的顺序，每个用户的热点只可能来自其前缀（长度为 k/2 加上排除和降权的消息数）
+        hot = likes * decay
+        order = np.argsort(-hot, kind="stable")
+        results = {}
+        for i, user in enumerate(users):
+            picked = messages_sim[i] if i in messages_sim else np.array([], dtype=np.int64)
+            prefix = order[:top_k // 2 + len(picked) + len(interacted[i])]
+            scores = hot[prefix] * np.where(np.isin(prefix, interacted[i]), 0.5, 1.0)
+            scores[np.isin(prefix, picked)] = -np.inf
+            messages_hot = prefix[self._top(scores, top_k // 2)]
+            results[user.id] = list(set(self.messages[row] for row in rows[np.concatenate([picked, messages_hot])]))
+        return results
+
+    def decay_weights(self, timestamps: np.ndarray, time_now: datetime) -> np.ndarray:
+        # 时间衰减，晚于 time_now 的消息不衰减
+        decay_factor = 0.96
+        hours = np.maximum(time_now.timestamp() - timestamps, 0) / 3600
+        return decay_factor ** hours
+
     def decay_weight(self, time_message: datetime, time_now: datetime) -> float:
         # 时间衰减
         decay_factor = 0.96
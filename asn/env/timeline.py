@@ -0,0 +1,72 @@
+"""
+Time-ordered message indexes.
+消息按时间戳有序保存，按时间窗口查询时用二分查找定位，开销只与窗口内的消息数有关，与历史消息总数无关。
+关注内容同样按作者建立时间索引：读取时对每个关注的作者二分定位时间窗口再按时间归并（拉模式）；
+开启 fan_out 后，新消息写入时直接追加到每个关注者的收件箱，读取只需一次二分（推模式）。
+"""
+import heapq
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+
+class TimeIndex:
+    """Items kept in timestamp order. Items added in time order are appended; late ones are inserted in place."""
+    def __init__(self):
+        self.times: List[datetime] = []
+        self.items: list = []
+
+    def add(self, timestamp: datetime, item) -> None:
+        if not self.times or timestamp >= self.times[-1]:
+            self.times.append(timestamp)
+            self.items.append(item)
+            return
+        pos = bisect_right(self.times, timestamp)
+        self.times.insert(pos, timestamp)
+        self.items.insert(pos, item)
+
+    def _bounds(self, time_begin: Optional[datetime], time_end: Optional[datetime], limit: Optional[int]) -> Tuple[int, int]:
+        lo = bisect_left(self.times, time_begin) if time_begin is not None else 0
+        hi = bisect_right(self.times, time_end) if time_end is not None else len(self.times)
+        if limit is not None:
+            lo = max(lo, hi - limit)
+        return lo, hi
+
+    def between(self, time_begin: Optional[datetime] = None, time_end: Optional[datetime] = None, limit: Optional[int] = None) -> list:
+        """Items with `time_begin <= timestamp <= time_end` (None: unbounded), oldest first; at most the newest `limit` of them."""
+        lo, hi = self._bounds(time_begin, time_end, limit)
+        return self.items[lo:hi]
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+def merge(indexes: List[TimeIndex], time_begin: Optional[datetime] = None, time_end: Optional[datetime] = None, limit: Optional[int] = None) -> list:
+    """Items of several TimeIndex within the window, merged oldest first; at most the newest `limit` of them."""
+    pairs = []
+    for index in indexes:
+        # 每个索引最多取最新的 limit 条，合并后的最新 limit 条一定在其中
+        lo, hi = index._bounds(time_begin, time_end, limit)
+        pairs.append(zip(index.times[lo:hi], index.items[lo:hi]))
+    items = [item for _, item in heapq.merge(*pairs, key=lambda pair: pair[0])]
+    if limit is not None:
+        items = items[max(0, len(items) - limit):]
+    return items
+
+
+class FollowFeed:
+    """
+    Settings for reading followed users' messages. `fan_out` keeps a per-user inbox updated when messages are written;
+    `limit` caps the followed messages a user reads per call to the newest ones (None: no cap).
+    """
+    def __init__(self, fan_out: bool = False, limit: Optional[int] = None):
+        self.fan_out = fan_out
+        self.limit = limit
+
+
+FOLLOW_FEED: FollowFeed = None
+def set_follow_feed(feed: FollowFeed) -> None:
+    global FOLLOW_FEED
+    FOLLOW_FEED = feed
+def get_follow_feed() -> FollowFeed:
+    return FOLLOW_FEED
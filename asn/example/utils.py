@@ -111,7 +111,7 @@ def replay_history(env: Environment, data: Data, time_begin: str, time_end: str,
                     with env.lock_message:
                         if hist["post_id"] in pid2mid:  # 只处理存在于系统之中的消息
                             msg = env.id2message[env.id2message[pid2mid[hist["post_id"]]].origin_id()]
-                            msg.liked_by.append((user.id, hist["timestamp"]))
+                            env.like_message(msg, user.id, hist["timestamp"])
                             user.like(msg.origin_id())
                             env.log_act(user, msg, Act("like", msg.text, datetime.strptime(hist["timestamp"], TIME_FORMAT)), use_act_time=True)
             time_step = add_interval(time_step, interval)
@@ -195,7 +195,7 @@ def simulate_user(user: User, env: Environment, data: Data, conf: dict):
                     env.add_message(message)
             if act.type == "like":
                 with env.lock_message:
-                    env.id2message[msg.origin_id()].liked_by.append((user.id, datetime_to_str(env.now)))
+                    env.like_message(env.id2message[msg.origin_id()], user.id, datetime_to_str(env.now))
             env.log_act(user, msg, act)
     elif conf["react_strategy"] == "all": # 一次对所有消息做出反应
         actss = user.read_posts([msg.text for msg in msgs], env.now)
@@ -212,7 +212,7 @@ def simulate_user(user: User, env: Environment, data: Data, conf: dict):
                         env.add_message(message)
                 if act.type == "like":
                     with env.lock_message:
-                        env.id2message[msg.origin_id()].liked_by.append((user.id, datetime_to_str(env.now)))
+                        env.like_message(env.id2message[msg.origin_id()], user.id, datetime_to_str(env.now))
                 env.log_act(user, msg, act)
     # 生成消息
     previous_posts = [hist["text"] for hist in data.get_history_by_time(user.id, time_end=conf["time_init_end"]) if hist["type"] == "post"][-5:]
@@ -0,0 +1,75 @@
+"""
+Prefix-cache-aware prompt assembly.
+vLLM 的自动前缀缓存只能复用逐 token 完全相同的前缀，因此 prompt 按共享程度从高到低拼接：
+全局指令（所有 agent 共享）-> agent 人设（同一 agent 的所有调用共享）-> 本次调用的内容。
+全局指令和人设放在 system 消息中，本次调用的内容放在 user 消息中。
+同时按调用位置统计估计的可复用前缀长度，用来检查大部分 prompt token 能否命中 KV cache。
+"""
+import os
+import hashlib
+import threading
+from typing import Optional, Tuple
+from asn.llm.budget import estimate_tokens
+
+
+class PrefixStats:
+    """
+    Estimates, per call site, how many prompt tokens share a prefix with an earlier request.
+    A prefix counts as reusable once the same instructions (and persona) have been sent before,
+    plus the common prefix of the per-call content with the previous call of the same agent and call site.
+    This is an upper bound: it ignores KV cache eviction and vLLM's block granularity.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.last_content = {}
+        self.sites = {}
+
+    def record(self, call_site: str, instructions: str, persona: Optional[str], content: str) -> int:
+        instructions_key = hashlib.sha1(instructions.encode("utf-8")).hexdigest()
+        persona_key = hashlib.sha1((instructions + (persona or "")).encode("utf-8")).hexdigest()
+        with self.lock:
+            reusable = 0
+            if instructions_key in self.seen:
+                reusable += estimate_tokens(instructions)
+                if persona and persona_key in self.seen:
+                    reusable += estimate_tokens(persona)
+            if persona_key in self.seen:
+                last = self.last_content.get((call_site, persona_key))
+                if last is not None:
+                    reusable += estimate_tokens(os.path.commonprefix([last, content]))
+            self.seen.add(instructions_key)
+            self.seen.add(persona_key)
+            self.last_content[(call_site, persona_key)] = content
+            total = estimate_tokens(instructions) + estimate_tokens(persona or "") + estimate_tokens(content)
+            site = self.sites.setdefault(call_site, {"calls": 0, "prompt_tokens": 0, "reusable_prefix_tokens": 0})
+            site["calls"] += 1
+            site["prompt_tokens"] += total
+            site["reusable_prefix_tokens"] += reusable
+        return reusable
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                call_site: {
+                    **site,
+                    "avg_reusable_prefix_tokens": site["reusable_prefix_tokens"] / site["calls"] if site["calls"] else 0.0,
+                    "reusable_ratio": site["reusable_prefix_tokens"] / site["prompt_tokens"] if site["prompt_tokens"] else 0.0,
+                }
+                for call_site, site in self.sites.items()
+            }
+
+
+PREFIX_STATS = PrefixStats()
+def get_prefix_stats() -> PrefixStats:
+    return PREFIX_STATS
+
+
+def assemble_prompt(call_site: str, instructions: str, persona: Optional[str] = None, content: str = "") -> Tuple[str, str]:
+    """
+    Build `(prompt_sys, prompt)` ordered from most-shared to least-shared:
+    the global `instructions` and the per-agent `persona` form the system prompt, the per-call `content` the user prompt.
+    """
+    prompt_sys = instructions if persona is None else instructions.rstrip("\n") + "\n" + persona
+    PREFIX_STATS.record(call_site, instructions, persona, content)
+    return prompt_sys, content
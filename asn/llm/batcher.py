@@ -0,0 +1,80 @@
+"""
+Cross-thread embedding micro-batcher.
+并发的 embed_query 调用先进入队列，攒够 max_batch 条或等待 max_wait_ms 后合并成一个 embeddings 请求发出，再分别返回结果。
+"""
+import time
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List
+from asn.utils.logger import get_logger
+
+
+class EmbedBatcher:
+    """
+    Coalesces single-text embedding requests from many threads into batched requests.
+    `embed_batch` is called with a list of distinct texts and must return one embedding per text.
+    Up to `max_concurrent` batches can be in flight at the same time.
+    """
+    def __init__(self, embed_batch: Callable[[List[str]], List[List[float]]], max_batch: int = 64, max_wait_ms: float = 5, max_concurrent: int = 4):
+        self.embed_batch = embed_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="EmbedBatcher")
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self._run, name="EmbedBatcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self.queue.put((text, future))
+        return future
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.executor.submit(self._flush, batch)
+
+    def _flush(self, batch: list) -> None:
+        # 同一批次中相同的文本只请求一次
+        waiters = {}
+        for text, future in batch:
+            waiters.setdefault(text, []).append(future)
+        texts = list(waiters.keys())
+        with self.lock:
+            self.requests += len(batch)
+            self.batches += 1
+        try:
+            embeddings = self.embed_batch(texts)
+            if len(embeddings) != len(texts):
+                raise ValueError(f"Expected {len(texts)} embeddings, got {len(embeddings)}")
+            for text, embedding in zip(texts, embeddings):
+                for future in waiters[text]:
+                    future.set_result(embedding)
+        except Exception as e:
+            get_logger().error(f"Error in EmbedBatcher: {e}\nTexts: {texts}")
+            # 已经拿到结果的不再改动，其余的（包括响应不足时的剩余部分）都设为异常
+            for futures in waiters.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "avg_batch_size": self.requests / self.batches if self.batches else 0.0,
+            }
@@ -0,0 +1,109 @@
+"""
+Tokenizer-aware prompt budget.
+vLLM 以 --max-model-len 16384 启动，超长的 prompt 必然失败（还会白白重试）。
+发请求之前用本地 tokenizer 计算 token 数，按优先级裁剪示例、记忆、帖子等内容，使 prompt 加上预留的输出长度不超过上限；
+裁剪后仍然放不下时抛出 PromptTooLongError，不发出请求。默认关闭（max_model_len 为 None），prompt 原样发送。
+"""
+import threading
+from typing import Callable, Dict, Optional
+from asn.utils.logger import get_logger
+
+
+class PromptTooLongError(ValueError):
+    """The prompt does not fit the context window even after trimming everything that can be trimmed."""
+
+
+def estimate_tokens(text: str) -> int:
+    # 没有 tokenizer 时的统一估计（裁剪 prompt、估计用量都用它）：英文约 4 个字符一个 token，中文约 1 个汉字（3 个字节）一个 token，
+    # 按 3 个字节一个 token 计算只会高估
+    return (len(text.encode("utf-8")) + 2) // 3
+
+
+def load_tokenizer(path: str) -> Callable[[str], int]:
+    """Token counter backed by the HuggingFace tokenizer at `path`, or the conservative estimate if it cannot be loaded."""
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(path)
+    except Exception as e:
+        get_logger().warning(f"PromptBudget: cannot load tokenizer {path} ({e}), using a conservative estimate")
+        return estimate_tokens
+    lock = threading.Lock()
+
+    def count(text: str) -> int:
+        # fast tokenizer 在多线程同时调用时可能报 "Already borrowed"
+        with lock:
+            return len(tokenizer.encode(text, add_special_tokens=False))
+    return count
+
+
+class PromptBudget:
+    """
+    Fits prompts into `max_model_len` tokens, leaving `completion_tokens[call_site]` (default `default_completion_tokens`)
+    for the response and `template_tokens` for the chat template of the two messages. `max_model_len=None` leaves prompts untouched.
+    """
+    def __init__(self, max_model_len: Optional[int] = 16384, tokenizer: str = None, default_completion_tokens: int = 1024,
+                 completion_tokens: Dict[str, int] = None, template_tokens: int = 32):
+        self.max_model_len = max_model_len
+        self.count = load_tokenizer(tokenizer) if tokenizer else estimate_tokens
+        self.default_completion_tokens = default_completion_tokens
+        # 批量反应的输出是每个帖子一个 JSON 对象
+        self.completion_tokens = {"reacts": 2048, **(completion_tokens or {})}
+        self.template_tokens = template_tokens
+        self.lock = threading.Lock()
+        self.sites = {}
+
+    def budget(self, call_site: str) -> int:
+        completion = self.completion_tokens[call_site] if call_site in self.completion_tokens else self.default_completion_tokens
+        return self.max_model_len - completion - self.template_tokens
+
+    def fit(self, call_site: str, prompt_sys: str, render: Callable[..., str], **parts) -> str:
+        """
+        Return `render(**parts)` after trimming `parts` until it fits together with `prompt_sys`.
+        Parts are trimmed in the order they are passed: a list loses its last item (the least relevant) one at a time,
+        anything else (e.g. `extra_experience`) is replaced by None as a whole.
+        """
+        if self.max_model_len is None:
+            return render(**parts)
+        budget = self.budget(call_site) - self.count(prompt_sys)
+        prompt = render(**parts)
+        tokens = self.count(prompt)
+        dropped = {}
+        for name in list(parts):
+            while tokens > budget and parts[name]:
+                if isinstance(parts[name], list):
+                    parts[name] = parts[name][:-1]
+                else:
+                    parts[name] = None
+                dropped[name] = dropped.get(name, 0) + 1
+                prompt = render(**parts)
+                tokens = self.count(prompt)
+        self._record(call_site, dropped, tokens > budget)
+        if tokens > budget:
+            raise PromptTooLongError(f"{call_site} prompt needs {tokens} tokens, only {budget} available")
+        if dropped:
+            get_logger().debug(f"PromptBudget: trimmed {dropped} from the {call_site} prompt")
+        return prompt
+
+    def _record(self, call_site: str, dropped: Dict[str, int], rejected: bool) -> None:
+        with self.lock:
+            site = self.sites.setdefault(call_site, {"calls": 0, "trimmed": 0, "rejected": 0, "dropped": {}})
+            site["calls"] += 1
+            site["trimmed"] += bool(dropped)
+            site["rejected"] += rejected
+            for name, num in dropped.items():
+                site["dropped"][name] = site["dropped"].get(name, 0) + num
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                call_site: {**site, "dropped": dict(site["dropped"]), "trim_rate": site["trimmed"] / site["calls"] if site["calls"] else 0.0}
+                for call_site, site in self.sites.items()
+            }
+
+
+PROMPT_BUDGET = PromptBudget(max_model_len=None)
+def set_prompt_budget(budget: PromptBudget) -> None:
+    global PROMPT_BUDGET
+    PROMPT_BUDGET = budget
+def get_prompt_budget() -> PromptBudget:
+    return PROMPT_BUDGET
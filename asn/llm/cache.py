@@ -0,0 +1,103 @@
+"""
+Persistent LLM response cache.
+所有调用都是 temperature=0.0，相同的请求得到相同的结果，因此可以跨运行缓存在磁盘上（SQLite）。
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Optional
+
+
+class LLMCache:
+    """
+    Content-addressed cache of chat completions, keyed by a hash of model + system prompt + prompt + sampling params.
+    Entries are evicted least-recently-used first once the total size exceeds `max_size_mb`.
+    In read-only mode (e.g. replaying a run) the cache is only looked up, never written.
+    """
+    def __init__(self, path: str = "cache/llm_cache.sqlite", max_size_mb: float = 1024, read_only: bool = False):
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if read_only:
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+            # WAL 模式允许多个进程同时读写同一个缓存文件
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON cache (last_access)")
+            self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    @staticmethod
+    def make_key(model: str, prompt_sys: str, prompt: str, **params) -> str:
+        content = json.dumps({"model": model, "system": prompt_sys, "prompt": prompt, "params": params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self.conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (time.time(), key))
+                self.conn.commit()
+            return row[0]
+
+    def set(self, key: str, response: str) -> None:
+        if self.read_only or not response:
+            return
+        size = len(response.encode("utf-8"))
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            self.size += size - (old[0] if old else 0)
+            if self.size > self.max_size:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self) -> None:
+        # 按最近访问时间从旧到新删除，直到总大小回到上限的 90% 以内
+        target = int(self.max_size * 0.9)
+        rows = self.conn.execute("SELECT key, size FROM cache ORDER BY last_access ASC").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self.conn.executemany("DELETE FROM cache WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "size_bytes": self.size,
+            "read_only": self.read_only,
+        }
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,111 @@
+"""
+Disk-backed embedding cache keyed by text hash.
+向量以 float32 顺序追加到内存映射文件中，文本哈希到行号的索引保存在 SQLite 中，前面再加一层内存 LRU。
+多个进程可以共享同一个缓存目录（追加向量时使用文件锁）。
+"""
+import os
+import fcntl
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import List, Optional
+
+
+class EmbedCache:
+    """
+    Embedding cache shared across runs and processes.
+    `path` is a directory holding `vectors.f32` (row-major float32 matrix) and `index.sqlite` (hash -> row).
+    The most recently used `capacity` vectors are also kept in memory.
+    """
+    def __init__(self, path: str = "cache/embed", dim: int = 3584, model: str = "", capacity: int = 100000):
+        self.path = path
+        self.dim = dim
+        self.model = model
+        self.capacity = capacity
+        self.lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.vector_path = os.path.join(path, "vectors.f32")
+        self.lock_path = os.path.join(path, "vectors.lock")
+        self.conn = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embed (hash TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('dim', ?)", (str(dim),))
+        self.conn.commit()
+        cached_dim = int(self.conn.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()[0])
+        if cached_dim != dim:
+            raise ValueError(f"Embedding cache at {path} has dim {cached_dim}, expected {dim}")
+        if not os.path.exists(self.vector_path):
+            open(self.vector_path, "ab").close()
+        self.vectors = None
+        self.rows = 0
+
+    def make_key(self, text: str) -> str:
+        return hashlib.sha256((self.model + "\0" + text).encode("utf-8")).hexdigest()
+
+    def _row(self, row: int) -> np.ndarray:
+        # 其他进程可能追加了新的向量，需要时重新映射文件
+        if row >= self.rows:
+            rows = os.path.getsize(self.vector_path) // (self.dim * 4)
+            self.vectors = np.memmap(self.vector_path, dtype=np.float32, mode="r", shape=(rows, self.dim)) if rows else None
+            self.rows = rows
+        return self.vectors[row]
+
+    def get(self, text: str) -> Optional[List[float]]:
+        key = self.make_key(text)
+        with self.lock:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                self.hits += 1
+                return self.lru[key].tolist()
+            row = self.conn.execute("SELECT row FROM embed WHERE hash = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            vector = np.array(self._row(row[0]))
+            self._remember(key, vector)
+            self.hits += 1
+            return vector.tolist()
+
+    def put(self, text: str, embedding: List[float]) -> None:
+        key = self.make_key(text)
+        vector = np.asarray(embedding, dtype=np.float32)
+        if vector.shape != (self.dim,):
+            return
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM embed WHERE hash = ?", (key,)).fetchone() is None:
+                with open(self.lock_path, "w") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    try:
+                        with open(self.vector_path, "ab") as f:
+                            row = f.tell() // (self.dim * 4)
+                            f.write(vector.tobytes())
+                        self.conn.execute("INSERT OR IGNORE INTO embed (hash, row) VALUES (?, ?)", (key, row))
+                        self.conn.commit()
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+            self._remember(key, vector)
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        self.lru[key] = vector
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.capacity:
+            self.lru.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        with self.lock:
+            on_disk = self.conn.execute("SELECT COUNT(*) FROM embed").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "in_memory": len(self.lru),
+            "on_disk": on_disk,
+        }
@@ -0,0 +1,190 @@
+"""
+Adaptive concurrency control (AIMD) against the inference server.
+根据每个请求的延迟和错误动态调整并发窗口：吞吐正常时加性增大窗口，延迟突增或 429/5xx 时乘性减小窗口。
+同一个 limiter 由线程和协程共享，因此所有模拟阶段共用一个并发窗口。
+"""
+import time
+import asyncio
+import threading
+import openai
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+
+def is_overload_error(error: Exception) -> bool:
+    # 429、5xx、超时和连接错误说明服务器过载
+    if isinstance(error, (openai.RateLimitError, openai.InternalServerError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limiter usable from both threads (`acquire`) and coroutines (`aacquire`).
+    Every acquire must be paired with a `release(latency=...)` on success or `release(error=...)` on failure.
+    While the window is the binding constraint it grows by `increase` per window's worth of successful requests.
+    Throughput is measured over rounds of one window of completions; when a larger window yields less than
+    `min_gain` of the proportional throughput gain, or the short-term latency exceeds `latency_tolerance` x the
+    long-term latency, or the server reports overload, the window is multiplied by `decrease`
+    (at most once per `cooldown` seconds).
+    """
+    def __init__(self, initial: int = 32, min_limit: int = 1, max_limit: int = 512, increase: float = 1.0, decrease: float = 0.7,
+                 latency_tolerance: float = 2.0, min_gain: float = 0.5, cooldown: float = 5.0, smoothing: float = 0.1, smoothing_long: float = 0.01):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.min_gain = min_gain
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.smoothing_long = smoothing_long
+        self.inflight = 0
+        self.latency = None     # 延迟的短期指数滑动平均
+        self.baseline = None    # 延迟的长期指数滑动平均
+        self.last_decrease = 0.0
+        # 吞吐测量：每轮统计一个窗口大小的完成数
+        self.round_start = time.time()
+        self.round_limit = self.limit
+        self.round_count = 0
+        self.round_saturated = 0
+        self.last_round_limit = None
+        self.throughput = None
+        self.successes = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.waiters = deque()
+
+    def _try_acquire(self) -> bool:
+        if not self.waiters and self.inflight < int(self.limit):
+            self.inflight += 1
+            return True
+        return False
+
+    def _wake(self) -> None:
+        # 空出的名额直接转交给等待者（inflight 已经替等待者加一）
+        while self.waiters and self.inflight < int(self.limit):
+            self.inflight += 1
+            self.waiters.popleft()()
+
+    def acquire(self) -> None:
+        with self.lock:
+            if self._try_acquire():
+                return
+            event = threading.Event()
+            self.waiters.append(event.set)
+        event.wait()
+
+    async def aacquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def hand_over():
+            loop.call_soon_threadsafe(self._resolve, future)
+
+        with self.lock:
+            if self._try_acquire():
+                return
+            self.waiters.append(hand_over)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def _resolve(self, future: asyncio.Future) -> None:
+        if future.cancelled():
+            # 等待者已被取消，把名额还回去
+            self.release()
+        else:
+            future.set_result(None)
+
+    def release(self, latency: float = None, error: Exception = None) -> None:
+        with self.lock:
+            saturated = self.inflight >= int(self.limit)
+            self.inflight -= 1
+            now = time.time()
+            if error is not None:
+                self.errors += 1
+                if is_overload_error(error):
+                    self._decrease(now)
+            elif latency is not None:
+                self.successes += 1
+                self.latency = latency if self.latency is None else (1 - self.smoothing) * self.latency + self.smoothing * latency
+                self.baseline = latency if self.baseline is None else (1 - self.smoothing_long) * self.baseline + self.smoothing_long * latency
+                if self.latency > self.latency_tolerance * self.baseline:
+                    # 延迟突增
+                    self._decrease(now)
+                elif saturated:
+                    self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+                self._update_throughput(now, saturated)
+            self._wake()
+
+    def _update_throughput(self, now: float, saturated: bool) -> None:
+        self.round_count += 1
+        self.round_saturated += saturated
+        if self.round_count < max(int(self.round_limit), 8):
+            return
+        throughput = self.round_count / max(now - self.round_start, 1e-6)
+        # 只有窗口是瓶颈时吞吐才反映服务器能力；窗口增大了但吞吐没有相应增长，说明服务器已饱和
+        if self.round_saturated * 2 >= self.round_count and self.throughput is not None and self.last_round_limit is not None:
+            growth = self.round_limit / self.last_round_limit
+            if growth > 1 and throughput < self.throughput * (1 + (growth - 1) * self.min_gain):
+                self._decrease(now)
+        self.throughput = throughput
+        self.last_round_limit = self.round_limit
+        self.round_start = now
+        self.round_limit = self.limit
+        self.round_count = 0
+        self.round_saturated = 0
+
+    def _decrease(self, now: float) -> None:
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+        self.last_decrease = now
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "limit": round(self.limit, 2),
+                "inflight": self.inflight,
+                "waiting": len(self.waiters),
+                "latency": self.latency,
+                "baseline_latency": self.baseline,
+                "throughput": self.throughput,
+                "successes": self.successes,
+                "errors": self.errors,
+            }
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        time_start = time.time()
+        latency, error = None, None
+        try:
+            yield
+            latency = time.time() - time_start
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # 被取消（CancelledError 不是 Exception）时也要归还名额，只是不作为延迟或错误反馈
+            self.release(latency=latency, error=error)
+
+    @asynccontextmanager
+    async def aslot(self):
+        await self.aacquire()
+        time_start = time.time()
+        latency, error = None, None
+        try:
+            yield
+            latency = time.time() - time_start
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # 被取消（CancelledError 不是 Exception）时也要归还名额，只是不作为延迟或错误反馈
+            self.release(latency=latency, error=error)
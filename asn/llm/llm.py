@@ -1,16 +1,25 @@
 import time
 import random
+import asyncio
 import threading
-from openai import OpenAI
-from typing import Any, List, Mapping
+from contextlib import nullcontext
+from typing import Any, List, Mapping, Union
 from langchain.llms.base import LLM
 from langchain_core.embeddings import Embeddings
 from asn.utils.logger import get_logger
-
-# 保存 llm 的 prompt 和 response 需要的线程锁
-import json
-lock_llm_save = threading.Lock()
-llm_out_json = []
+from asn.llm.cache import LLMCache
+from asn.llm.sink import LLMOutputSink
+from asn.llm.batcher import EmbedBatcher
+from asn.llm.embed_cache import EmbedCache
+from asn.llm.limiter import AdaptiveLimiter
+from asn.llm.router import ReplicaRouter
+from asn.llm.retry import RetryPolicy
+from asn.llm.singleflight import SingleFlight
+from asn.llm.budget import PromptBudget, estimate_tokens, set_prompt_budget, get_prompt_budget
+from asn.llm.assembly import get_prefix_stats
+from asn.llm.schema import request_params, get_fallback_stats
+from asn.llm.usage import UsageTracker, set_usage_tracker, get_usage_tracker
+from asn.llm.stream import StopCondition, consume_stream, aconsume_stream, get_stream_stats
 
 USE_SFT = False
 def set_sft(use_sft: bool) -> None:
@@ -26,6 +35,15 @@ class LLMManager:
     embed_name: str = "Local"
     embed_model: str = ""
     lora_path: str = ""
+    max_inflight: int = 256
+    llm_cache: LLMCache = None
+    llm_sink: LLMOutputSink = None
+    llm_limiter: AdaptiveLimiter = None
+    embed_limiter: AdaptiveLimiter = None
+    retry_conf: dict = {}
+    structured_output: str = None
+    streaming: bool = False
+    single_flight: bool = True
     llm: LLM = None
     embed_model: Embeddings = None
 
@@ -33,21 +51,93 @@ class LLMManager:
     def set_manager(cls, conf) -> None:
         cls.llm_name = conf["llm_name"]
         cls.llm_model = conf["llm_model"] if "llm_model" in conf else ""
+        # llm_url / embed_url 可以是多个副本的列表
         cls.llm_url = conf["llm_url"] if "llm_url" in conf else "http://localhost:8001/v1"
         cls.embed_name = conf["embed_name"]
         cls.embed_model = conf["embed_model"] if "embed_model" in conf else ""
         cls.embed_url = conf["embed_url"] if "embed_url" in conf else "http://localhost:8002/v1"
         cls.lora_path = conf["lora_path"] if "lora_path" in conf else ""
+        # 异步后端的全局并发上限（同时在途的请求数），同时也是连接池中保持的 keep-alive 连接数
+        cls.max_inflight = conf["max_inflight"] if "max_inflight" in conf else 256
+        # 磁盘上的 LLM 响应缓存，例如 cache: {path: cache/llm_cache.sqlite, max_size_mb: 1024, read_only: False}
+        cls.llm_cache = LLMCache(**conf["cache"]) if "cache" in conf and conf["cache"] else None
+        # 保存 llm 的 prompt 和 response，例如 output: {path: llm_out.jsonl, max_bytes: 268435456, compress: True}，output: False 关闭
+        if "output" in conf and not conf["output"]:
+            cls.llm_sink = None
+        else:
+            cls.llm_sink = LLMOutputSink(**conf["output"]) if "output" in conf and isinstance(conf["output"], dict) else LLMOutputSink()
+        # 自适应并发控制（AIMD），LLM 和 embedding 服务器各一个窗口，例如 adaptive_concurrency: {initial: 32, max_limit: 512}
+        if "adaptive_concurrency" in conf and conf["adaptive_concurrency"]:
+            limiter_conf = conf["adaptive_concurrency"] if isinstance(conf["adaptive_concurrency"], dict) else {}
+            cls.llm_limiter = AdaptiveLimiter(**limiter_conf)
+            cls.embed_limiter = AdaptiveLimiter(**limiter_conf)
+        else:
+            cls.llm_limiter = None
+            cls.embed_limiter = None
+        # 重试策略（指数退避 + 抖动 + 时间预算 + 熔断），例如 retry: {max_attempts: 5, base_delay: 0.5, max_delay: 30, deadline: 300, failure_threshold: 5, reset_timeout: 10}
+        cls.retry_conf = conf["retry"] if "retry" in conf and conf["retry"] else {}
+        # 结构化输出：guided_json（vLLM）或 response_format（OpenAI 兼容），默认关闭
+        cls.structured_output = conf["structured_output"] if "structured_output" in conf and conf["structured_output"] else None
+        # 流式输出，react / reacts / post 所需字段完整后立即断开，省掉 Explanation 的解码，默认关闭
+        cls.streaming = conf["streaming"] if "streaming" in conf else False
+        # 合并同时在途的相同请求（LLM 按缓存 key，embedding 按文本），默认开启
+        cls.single_flight = conf["single_flight"] if "single_flight" in conf else True
+        # 发请求前按 token 数裁剪 prompt，例如 budget: {max_model_len: 16384, tokenizer: /path/to/Qwen2.5-14B-Instruct, completion_tokens: {reacts: 2048}}，默认关闭
+        if "budget" in conf and conf["budget"]:
+            set_prompt_budget(PromptBudget(**conf["budget"]) if isinstance(conf["budget"], dict) else PromptBudget())
+        else:
+            set_prompt_budget(PromptBudget(max_model_len=None))
+        # 按调用位置/用户/模拟步统计 token、延迟和费用，价格按每百万 token 计，例如 usage: {prompt_price: 0.8, completion_price: 2.0}
+        set_usage_tracker(UsageTracker(**conf["usage"]) if "usage" in conf and conf["usage"] else UsageTracker())
         if cls.llm_name == "OpenAI":
-            cls.llm = OpenAILLM(model=cls.llm_model, base_url=cls.llm_url, api_key=conf["api_key"] if "api_key" in conf else "EMPTY")
+            cls.llm = OpenAILLM(model=cls.llm_model, base_url=cls.llm_url, api_key=conf["api_key"] if "api_key" in conf else "EMPTY", max_inflight=cls.max_inflight, cache=cls.llm_cache, sink=cls.llm_sink, limiter=cls.llm_limiter, retry=RetryPolicy(**cls.retry_conf), structured_output=cls.structured_output, streaming=cls.streaming, flight=SingleFlight() if cls.single_flight else None)
         else:
             raise ValueError(f"Unknown model name: {cls.llm_name}")
         if cls.embed_name == "OpenAI":
-            cls.embed_model = OpenAIEmbed(model=cls.embed_model, base_url=cls.embed_url, api_key=conf["api_key"] if "api_key" in conf else "EMPTY")
+            # 合并并发的 embedding 请求，例如 embed_batch: {max_batch: 64, max_wait_ms: 5}
+            embed_batch = conf["embed_batch"] if "embed_batch" in conf and conf["embed_batch"] else None
+            # 磁盘上的 embedding 缓存，例如 embed_cache: {path: cache/embed, capacity: 100000}
+            embed_cache = EmbedCache(dim=OpenAIEmbed.embedding_size, model=cls.embed_model, **conf["embed_cache"]) if "embed_cache" in conf and conf["embed_cache"] else None
+            cls.embed_model = OpenAIEmbed(model=cls.embed_model, base_url=cls.embed_url, api_key=conf["api_key"] if "api_key" in conf else "EMPTY", max_inflight=cls.max_inflight, batch=embed_batch, cache=embed_cache, limiter=cls.embed_limiter, retry=RetryPolicy(**cls.retry_conf), flight=SingleFlight() if cls.single_flight else None)
         else:
             raise ValueError(f"Unknown model name: {cls.embed_name}")
         print(f"LLM Manager set to: {cls.llm_name}, {cls.llm_model}, {cls.embed_name}, {cls.embed_model}")
 
+    @classmethod
+    def stats(cls) -> dict:
+        stats = {
+            "llm_replicas": cls.llm.router.stats(),
+            "embed_replicas": cls.embed_model.router.stats(),
+            "llm_retry": cls.llm.retry.stats(),
+            "embed_retry": cls.embed_model.retry.stats(),
+        }
+        if cls.llm_cache is not None:
+            stats["llm_cache"] = cls.llm_cache.stats()
+        if cls.embed_model.cache is not None:
+            stats["embed_cache"] = cls.embed_model.cache.stats()
+        if cls.embed_model.batcher is not None:
+            stats["embed_batch"] = cls.embed_model.batcher.stats()
+        if cls.llm.flight is not None:
+            stats["llm_single_flight"] = cls.llm.flight.stats()
+            stats["embed_single_flight"] = cls.embed_model.flight.stats()
+        stats["prefix_reuse"] = get_prefix_stats().stats()
+        stats["fallbacks"] = get_fallback_stats().stats()
+        if get_prompt_budget().max_model_len is not None:
+            stats["prompt_budget"] = get_prompt_budget().stats()
+        stats["usage"] = get_usage_tracker().stats()["by_site"]
+        if cls.streaming:
+            stats["streaming"] = get_stream_stats().stats()
+        if cls.llm_limiter is not None:
+            stats["llm_concurrency"] = cls.llm_limiter.stats()
+            stats["embed_concurrency"] = cls.embed_limiter.stats()
+        return stats
+
+    @classmethod
+    async def aclose(cls) -> None:
+        """Close the async clients and their keep-alive connections; call at the end of the event loop that used them."""
+        await cls.llm.router.aclose()
+        await cls.embed_model.router.aclose()
+
     @classmethod
     def get_llm(cls) -> LLM:
         return cls.llm
@@ -56,19 +146,32 @@ class LLMManager:
     def get_embed_model(cls) -> tuple[int, Embeddings]:
         return cls.embed_model.embed_size(), cls.embed_model 
 
+
 class OpenAILLM(LLM):
-    client: OpenAI = None
+    router: ReplicaRouter = None
+    cache: LLMCache = None
+    sink: LLMOutputSink = None
+    limiter: AdaptiveLimiter = None
+    retry: RetryPolicy = None
+    structured_output: str = None
+    streaming: bool = False
+    flight: SingleFlight = None
     model: str = None
     task_ids: List[int] = []
-    def __init__(self, api_key: str="EMPTY", base_url: str="http://localhost:8001/v1", model: str="") -> None:
+    def __init__(self, api_key: str="EMPTY", base_url: Union[str, List[str]]="http://localhost:8001/v1", model: str="", max_inflight: int=256, cache: LLMCache=None, sink: LLMOutputSink=None, limiter: AdaptiveLimiter=None, retry: RetryPolicy=None, structured_output: str=None, streaming: bool=False, flight: SingleFlight=None) -> None:
         super().__init__()
         openai_api_key = api_key
         openai_api_base = base_url
         self.model = model
-        self.client = OpenAI(
-            api_key=openai_api_key,
-            base_url=openai_api_base,
-        )
+        # base_url 可以是多个副本的列表
+        self.router = ReplicaRouter(openai_api_base, openai_api_key, max_inflight)
+        self.cache = cache
+        self.sink = sink
+        self.limiter = limiter
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.structured_output = structured_output
+        self.streaming = streaming
+        self.flight = flight
 
     def _llm_type(self) -> str:
         return "openai"
@@ -78,72 +181,167 @@ class OpenAILLM(LLM):
         return {
             "model_name": "openai"
         }
-    
-    def _call(self, prompt: str, prompt_sys="You are a helpful assistant.", sft=False, **kwargs) -> str:
-        # get_logger().debug(f"PROMPT: {prompt}\nUse SFT: {sft}")
+
+    def _new_task_id(self) -> int:
         # a random and unexisted task id
         task_id = random.randint(0, 1000000)
         while task_id in self.task_ids:
             task_id = random.randint(0, 1000000)
         self.task_ids.append(task_id)
+        return task_id
 
-        # 最多retry3次
-        retry_count = 0
-        while retry_count < 3:
-            try:
-                model = self.model if not sft else "sft"
-                time_start_call = time.time()
-                chat_response = self.client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "system", "content": prompt_sys},
-                        {"role": "user", "content": prompt},
-                    ],
-                    temperature=0.0,
-                    timeout=3000
-                )
-                response = chat_response.choices[0].message.content
-                time_end_call = time.time()
-                get_logger().debug(f"PROMPT_SYS: {prompt_sys}\nPROMPT: {prompt}\n\nRESPONSE: {response} \n\nTask ID: {task_id}\nTime cost: {time_end_call - time_start_call} s")
-                self.task_ids.remove(task_id)
-                # 保存 llm 的 prompt 和 response
-                with lock_llm_save:
-                    llm_out_json.append({
-                        "prompt": prompt,
-                        "response": response,
-                    })
-                    with open("llm_out.json", "w") as f:
-                        json.dump(llm_out_json, f, indent=4)
-                # 如果是think模型，筛掉think的内容
-                if "<think>" in response and "</think>" in response:
-                    response = response.split("</think>")[-1]
-                return response
-            except Exception as e:
-                get_logger().error(f"Error in OpenAILLM: {e}\nTask ID: {task_id}\nPrompt: {prompt}")
-                retry_count += 1
-                time.sleep(3)
-                continue
-                
-        # 失败则返回空字符串
-        get_logger().error(f"OpenAILLM failed after 3 retries. Task ID: {task_id}\nPrompt: {prompt}")
+    def _slot(self):
+        return self.limiter.slot() if self.limiter is not None else nullcontext()
+
+    def _aslot(self):
+        return self.limiter.aslot() if self.limiter is not None else nullcontext()
+
+    def _request(self, prompt: str, prompt_sys: str, sft: bool, schema: dict=None, call_site: str=None, stream: bool=False) -> dict:
+        request = {
+            "model": self.model if not sft else "sft",
+            "messages": [
+                {"role": "system", "content": prompt_sys},
+                {"role": "user", "content": prompt},
+            ],
+            "temperature": 0.0,
+            "timeout": 3000,
+        }
+        # 开启结构化输出时按 schema 约束解码
+        if schema is not None and self.structured_output:
+            request.update(request_params(self.structured_output, call_site or "output", schema))
+        if stream:
+            request["stream"] = True
+            request["stream_options"] = {"include_usage": True}
+        return request
+
+    def _cache_key(self, request: dict) -> str:
+        # stream 也在键中：提前结束的流式响应只保留所需字段，不能缓存给非流式调用，也不能与其合并为同一次请求
+        params = {k: v for k, v in request.items() if k not in ("model", "messages", "timeout")}
+        return LLMCache.make_key(request["model"], request["messages"][0]["content"], request["messages"][1]["content"], **params)
+
+    def _cached(self, request: dict):
+        if self.cache is None:
+            return None
+        response = self.cache.get(self._cache_key(request))
+        if response is not None:
+            get_logger().debug(f"LLM cache hit: {self.cache.stats()}")
+            response = self._strip_think(response)
+        return response
+
+    @staticmethod
+    def _strip_think(response: str) -> str:
+        # 如果是think模型，筛掉think的内容
+        if "<think>" in response and "</think>" in response:
+            response = response.split("</think>")[-1]
+        return response
+
+    def _on_response(self, request: dict, prompt: str, prompt_sys: str, response: str, usage, task_id: int, time_cost: float, call_site: str) -> str:
+        get_logger().debug(f"PROMPT_SYS: {prompt_sys}\nPROMPT: {prompt}\n\nRESPONSE: {response} \n\nTask ID: {task_id}\nTime cost: {time_cost} s")
         self.task_ids.remove(task_id)
-        return ""
+        if self.cache is not None:
+            self.cache.set(self._cache_key(request), response)
+        get_usage_tracker().record("llm", call_site, usage.prompt_tokens if usage else 0, usage.completion_tokens if usage else 0, time_cost)
+        # 保存 llm 的 prompt 和 response（由后台线程写入，不阻塞调用线程）
+        if self.sink is not None:
+            self.sink.write({
+                "call_site": call_site,
+                "model": request["model"],
+                "prompt_sys": prompt_sys,
+                "prompt": prompt,
+                "response": response,
+                "latency": time_cost,
+                "prompt_tokens": usage.prompt_tokens if usage else None,
+                "completion_tokens": usage.completion_tokens if usage else None,
+            })
+        return self._strip_think(response)
+
+    def _call(self, prompt: str, prompt_sys="You are a helpful assistant.", sft=False, call_site: str=None, schema: dict=None, stop_when: StopCondition=None, **kwargs) -> str:
+        # get_logger().debug(f"PROMPT: {prompt}\nUse SFT: {sft}")
+        # stop_when: 流式模式下的提前结束条件，见 asn.llm.stream
+        stream = self.streaming and stop_when is not None
+        request = self._request(prompt, prompt_sys, sft, schema, call_site, stream)
+        response = self._cached(request)
+        if response is not None:
+            return response
+        # 相同的请求正在进行时直接等待它的结果
+        if self.flight is not None:
+            return self.flight.do(self._cache_key(request), lambda: self._complete(request, prompt, prompt_sys, call_site, stream, stop_when))
+        return self._complete(request, prompt, prompt_sys, call_site, stream, stop_when)
+
+    def _complete(self, request: dict, prompt: str, prompt_sys: str, call_site: str, stream: bool, stop_when: StopCondition) -> str:
+        task_id = self._new_task_id()
+
+        def create():
+            with self._slot(), self.router.replica() as replica:
+                if stream:
+                    return consume_stream(replica.client.chat.completions.create(**request), request, stop_when, call_site)
+                chat_response = replica.client.chat.completions.create(**request)
+                return chat_response.choices[0].message.content, chat_response.usage
+
+        # 指数退避重试，超出重试次数或时间预算、或熔断器打开时抛出 LLMUnavailableError
+        try:
+            time_start_call = time.time()
+            response, usage = self.retry.call(create)
+            time_end_call = time.time()
+        except Exception as e:
+            get_logger().error(f"Error in OpenAILLM: {e}\nTask ID: {task_id}\nPrompt: {prompt}")
+            self.task_ids.remove(task_id)
+            raise
+        return self._on_response(request, prompt, prompt_sys, response, usage, task_id, time_end_call - time_start_call, call_site)
+
+    async def _acall(self, prompt: str, prompt_sys="You are a helpful assistant.", sft=False, call_site: str=None, schema: dict=None, stop_when: StopCondition=None, **kwargs) -> str:
+        """Async version of `_call` on the shared AsyncOpenAI client, bounded by the global in-flight limit."""
+        stream = self.streaming and stop_when is not None
+        request = self._request(prompt, prompt_sys, sft, schema, call_site, stream)
+        response = self._cached(request)
+        if response is not None:
+            return response
+        if self.flight is not None:
+            return await self.flight.ado(self._cache_key(request), lambda: self._acomplete(request, prompt, prompt_sys, call_site, stream, stop_when))
+        return await self._acomplete(request, prompt, prompt_sys, call_site, stream, stop_when)
+
+    async def _acomplete(self, request: dict, prompt: str, prompt_sys: str, call_site: str, stream: bool, stop_when: StopCondition) -> str:
+        task_id = self._new_task_id()
+
+        async def create():
+            async with self._aslot(), self.router.areplica() as replica:
+                if stream:
+                    return await aconsume_stream(await replica.async_pool.get().chat.completions.create(**request), request, stop_when, call_site)
+                chat_response = await replica.async_pool.get().chat.completions.create(**request)
+                return chat_response.choices[0].message.content, chat_response.usage
+
+        try:
+            time_start_call = time.time()
+            response, usage = await self.retry.acall(create)
+            time_end_call = time.time()
+        except Exception as e:
+            get_logger().error(f"Error in OpenAILLM: {e}\nTask ID: {task_id}\nPrompt: {prompt}")
+            self.task_ids.remove(task_id)
+            raise
+        return self._on_response(request, prompt, prompt_sys, response, usage, task_id, time_end_call - time_start_call, call_site)
 
 
 class OpenAIEmbed(Embeddings):
     embedding_size: int = 3584
-    client: OpenAI = None
+    router: ReplicaRouter = None
+    batcher: EmbedBatcher = None
+    cache: EmbedCache = None
+    limiter: AdaptiveLimiter = None
+    retry: RetryPolicy = None
+    flight: SingleFlight = None
     model: str = None
     task_ids: List[int] = []
-    def __init__(self, api_key: str="EMPTY", base_url: str="http://localhost:8002/v1", model: str="") -> None:
+    def __init__(self, api_key: str="EMPTY", base_url: Union[str, List[str]]="http://localhost:8002/v1", model: str="", max_inflight: int=256, batch: dict=None, cache: EmbedCache=None, limiter: AdaptiveLimiter=None, retry: RetryPolicy=None, flight: SingleFlight=None) -> None:
         super().__init__()
         openai_api_key = api_key
         openai_api_base = base_url
-        self.client = OpenAI(
-            api_key=openai_api_key,
-            base_url=openai_api_base,
-        )
+        self.router = ReplicaRouter(openai_api_base, openai_api_key, max_inflight)
         self.model = model
+        self.batcher = EmbedBatcher(self._embed_batch, **batch) if batch else None
+        self.cache = cache
+        self.limiter = limiter
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.flight = flight
 
     def _llm_type(self) -> str:
         return "openai_embed"
@@ -153,34 +351,74 @@ class OpenAIEmbed(Embeddings):
         return {
             "model_name": "openai_embed"
         }
-    
-    def embed_query(self, text: str) -> List[float]:
-        try:
-            assert text != ""
-        except Exception as e:
-            get_logger().error(f"Error in OpenAIEmbed: {e}\nText: {text}")
-            return [0.0] * self.embedding_size
+
+    def _new_task_id(self) -> int:
         task_id = random.randint(0, 1000000)
         while task_id in self.task_ids:
             task_id = random.randint(0, 1000000)
         self.task_ids.append(task_id)
-        while True:
-            try:
-                time_start_call = time.time()
-                embeddings = self.client.embeddings.create(
+        return task_id
+
+    def _slot(self):
+        return self.limiter.slot() if self.limiter is not None else nullcontext()
+
+    def _aslot(self):
+        return self.limiter.aslot() if self.limiter is not None else nullcontext()
+    
+    def _record_usage(self, texts: List[str], latency: float) -> None:
+        # 经过 EmbedBatcher 合并的请求拿不到单条文本的 usage，统一按文本长度估计 token 数；调用位置来自 usage_scope
+        get_usage_tracker().record("embed", None, sum(estimate_tokens(text) for text in texts), 0, latency)
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        # 由 EmbedBatcher 调用，一次请求嵌入多条文本
+        def create():
+            with self._slot(), self.router.replica() as replica:
+                return replica.client.embeddings.create(
                     model=self.model,
-                    input=[text],
+                    input=texts,
                     timeout=3000
                 )
-                time_end_call = time.time()
-                get_logger().debug(f"TEXT: {text}\n\nTask ID: {task_id}\nTime cost: {time_end_call - time_start_call} s")
-                return embeddings.data[0].embedding
+
+        time_start_call = time.time()
+        embeddings = self.retry.call(create)
+        time_end_call = time.time()
+        get_logger().debug(f"Batch of {len(texts)} texts\nTime cost: {time_end_call - time_start_call} s")
+        return [item.embedding for item in sorted(embeddings.data, key=lambda item: item.index)]
+
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        async def create():
+            async with self._aslot(), self.router.areplica() as replica:
+                return await replica.async_pool.get().embeddings.create(
+                    model=self.model,
+                    input=texts,
+                    timeout=3000
+                )
+
+        time_start_call = time.time()
+        embeddings = await self.retry.acall(create)
+        time_end_call = time.time()
+        get_logger().debug(f"Batch of {len(texts)} texts\nTime cost: {time_end_call - time_start_call} s")
+        return [item.embedding for item in sorted(embeddings.data, key=lambda item: item.index)]
+
+    def _embed_query(self, text: str) -> List[float]:
+        try:
+            assert text != ""
+        except Exception as e:
+            get_logger().error(f"Error in OpenAIEmbed: {e}\nText: {text}")
+            return [0.0] * self.embedding_size
+        time_start_call = time.time()
+        if self.batcher is not None:
+            embedding = self.batcher.submit(text).result()
+        else:
+            try:
+                embedding = self._embed_batch([text])[0]
             except Exception as e:
-                get_logger().error(f"Error in OpenAIEmbed: {e}\nTask ID: {task_id}\nText: {text}")
-                time.sleep(60)
-                continue
+                get_logger().error(f"Error in OpenAIEmbed: {e}\nText: {text}")
+                raise
+        self._record_usage([text], time.time() - time_start_call)
+        return embedding
     
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
         for text in texts:
             try:
                 assert text != ""
@@ -188,14 +426,116 @@ class OpenAIEmbed(Embeddings):
                 get_logger().error(f"Error in OpenAIEmbed: {e}\nText: {text}")
                 return [[0.0] * self.embedding_size] * len(texts)
         time_start_call = time.time()
-        embeddings = self.client.embeddings.create(
-            model=self.model,
-            input=texts
-        )
-        time_end_call = time.time()
-        get_logger().debug(f"TEXTS: {texts}\n\nTime cost: {time_end_call - time_start_call} s")
-        return [item.embedding for item in embeddings.data]
+        if self.batcher is not None:
+            futures = [self.batcher.submit(text) for text in texts]
+            embeddings = [future.result() for future in futures]
+        else:
+            try:
+                embeddings = self._embed_batch(texts)
+            except Exception as e:
+                get_logger().error(f"Error in OpenAIEmbed: {e}\nTexts: {texts}")
+                raise
+        self._record_usage(texts, time.time() - time_start_call)
+        return embeddings
+
+    async def _aembed_query(self, text: str) -> List[float]:
+        try:
+            assert text != ""
+        except Exception as e:
+            get_logger().error(f"Error in OpenAIEmbed: {e}\nText: {text}")
+            return [0.0] * self.embedding_size
+        time_start_call = time.time()
+        if self.batcher is not None:
+            embedding = await asyncio.wrap_future(self.batcher.submit(text))
+        else:
+            try:
+                embedding = (await self._aembed_batch([text]))[0]
+            except Exception as e:
+                get_logger().error(f"Error in OpenAIEmbed: {e}\nText: {text}")
+                raise
+        self._record_usage([text], time.time() - time_start_call)
+        return embedding
+
+    async def _aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        for text in texts:
+            try:
+                assert text != ""
+            except Exception as e:
+                get_logger().error(f"Error in OpenAIEmbed: {e}\nText: {text}")
+                return [[0.0] * self.embedding_size] * len(texts)
+        time_start_call = time.time()
+        if self.batcher is not None:
+            embeddings = list(await asyncio.gather(*[asyncio.wrap_future(self.batcher.submit(text)) for text in texts]))
+        else:
+            try:
+                embeddings = await self._aembed_batch(texts)
+            except Exception as e:
+                get_logger().error(f"Error in OpenAIEmbed: {e}\nTexts: {texts}")
+                raise
+        self._record_usage(texts, time.time() - time_start_call)
+        return embeddings
     
+    def _single_query(self, text: str) -> List[float]:
+        # 相同文本的 embedding 请求正在进行时直接等待它的结果
+        if self.flight is None or text == "":
+            return self._embed_query(text)
+        return self.flight.do(("query", text), lambda: self._embed_query(text))
+
+    def _single_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.flight is None:
+            return self._embed_documents(texts)
+        return self.flight.do(("documents", tuple(texts)), lambda: self._embed_documents(texts))
+
+    async def _asingle_query(self, text: str) -> List[float]:
+        if self.flight is None or text == "":
+            return await self._aembed_query(text)
+        return await self.flight.ado(("query", text), lambda: self._aembed_query(text))
+
+    async def _asingle_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.flight is None:
+            return await self._aembed_documents(texts)
+        return await self.flight.ado(("documents", tuple(texts)), lambda: self._aembed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.cache is None or text == "":
+            return self._single_query(text)
+        embedding = self.cache.get(text)
+        if embedding is None:
+            embedding = self._single_query(text)
+            self.cache.put(text, embedding)
+        return embedding
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.cache is None or "" in texts:
+            return self._single_documents(texts)
+        embeddings = [self.cache.get(text) for text in texts]
+        missed = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missed:
+            for i, embedding in zip(missed, self._single_documents([texts[i] for i in missed])):
+                embeddings[i] = embedding
+                self.cache.put(texts[i], embedding)
+        return embeddings
+
+    async def aembed_query(self, text: str) -> List[float]:
+        if self.cache is None or text == "":
+            return await self._asingle_query(text)
+        embedding = self.cache.get(text)
+        if embedding is None:
+            embedding = await self._asingle_query(text)
+            self.cache.put(text, embedding)
+        return embedding
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.cache is None or "" in texts:
+            return await self._asingle_documents(texts)
+        embeddings = [self.cache.get(text) for text in texts]
+        missed = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missed:
+            for i, embedding in zip(missed, await self._asingle_documents([texts[i] for i in missed])):
+                embeddings[i] = embedding
+                self.cache.put(texts[i], embedding)
+        return embeddings
+
     @classmethod
     def embed_size(cls) -> int:
         return cls.embedding_size
@@ -1,6 +1,13 @@
 
 class Prompts:
-    profile = \
+    # 以下 prompt 按共享程度从高到低拼接（见 asn/llm/assembly.py）：
+    # xxx_system 为所有 agent 共享的指令，persona 为 agent 人设，其余为每次调用的内容
+    persona = \
+"""
+Your personal characteristics: "{characteristics}"
+"""
+
+    profile_system = \
 """
 Please analyze the user's recent social media activities and interactions to identify their key characteristics and preferences.
 
@@ -17,14 +24,17 @@ Requirements:
 
 Your response should be in the second-person narrative like:
 "You are a social media user who enjoys sharing your thoughts on technology and gaming. Your activity level is high, and you often engage with content related to these topics. You express a strong interest in the latest trends, and your posts reflect a positive attitude towards innovation and creativity."
+"""
 
+    profile = \
+"""
 Here is the user's recent history of social media activities:
 {history}
 """
 
     react_system = \
 """
-    Act as a uer in social media platform. Your personal characteristics: "{characteristics}"
+    Act as a uer in social media platform.
     Your should decide whether to "Like" or "Repost" a post pushed to your feed.
     "Like" means you like the post and want to show your appreciation. "Repost" means you want to share the post with more friends.
     Consider the following aspects to decide:
@@ -37,14 +47,14 @@ Here is the user's recent history of social media activities:
 {{
     "Like": "yes / no",
     "Repost": "yes / no",
-    "Explanation": "concise explanation of your decision with 1-3 sentences"
+    "Explanation": "concise explanation of your decision with 1-3 sentences (use chinese for the explanation)"
 }}
 ```
 """
 
     reacts_system = \
 """
-Act as a user in social media platform. Your personal characteristics: "{characteristics}"
+Act as a user in social media platform.
     Your should decide whether to "Like" or "Repost" posts pushed to your feed.
     "Like" means you like the post and want to show your appreciation. "Repost" means you want to share the post with more friends.
     Consider the following aspects to decide:
@@ -55,8 +65,8 @@ Act as a user in social media platform. Your personal characteristics: "{charact
     Respond a JSON dictionary in a markdown's fenced code block as follows:
 ```json
 [
-    {{"Like": "yes / no", "Repost": "yes / no", "Explanation": "concise explanation of your decision with 1-3 sentences for the first post"}},
-    {{"Like": "yes / no", "Repost": "yes / no", "Explanation": "concise explanation of your decision with 1-3 sentences for the second post"}},
+    {{"Like": "yes / no", "Repost": "yes / no", "Explanation": "concise explanation of your decision with 1-3 sentences for the first post (use chinese for the explanation)"}},
+    {{"Like": "yes / no", "Repost": "yes / no", "Explanation": "concise explanation of your decision with 1-3 sentences for the second post (use chinese for the explanation)"}},
     ...
 ]
 ```
@@ -65,9 +75,10 @@ Act as a user in social media platform. Your personal characteristics: "{charact
 
     post_system = \
 """
-    Act as a social media user. Your personal characteristics are: "{characteristics}"
+    Act as a social media user.
     Act as a real user, you need to decide whether to post on a social platform. If you decide to post, write the content you want to publish.
     Your decision should be based on your persona characteristics and your recent memories and experiences, ensuring it is reasonable and resembles a real person's decision.
+    Make sure your style is consistent with your previous posts if you decide to post.
 
     Respond a JSON dictionary in a markdown's fenced code block as follows:
 ```json
@@ -78,56 +89,40 @@ Act as a user in social media platform. Your personal characteristics: "{charact
 ```
 """
 
+    # 同一 agent 一个 step 内多次调用时，时间和记忆相同，放在帖子之前
     react = \
 """
-    It's {timestamp} now. You read a new post in your feed: {post}
-
+    It's {timestamp} now.
     Here are your recent memories related to similar posts: 
 {memories}
 
+    You read a new post in your feed: {post}
     Decide whether to "Like" or "Repost" the post.
-Respond a JSON dictionary in a markdown's fenced code block as follows:
-```json
-{{
-    "Like": "yes / no",
-    "Repost": "yes / no",
-    "Explanation": "concise explanation of your decision with 1-3 sentences (use chinese for the explanation)"
-}}
-```
 """
 
     reacts = \
 """
-    It's {timestamp} now. You read several new posts in your feed: 
-{posts}
-
+    It's {timestamp} now.
     Here are your recent memories related to similar posts:
 {memories}
 
+    You read several new posts in your feed: 
+{posts}
 Decide whether to "Like" or "Repost" the posts.
-Respond a JSON dictionary in a markdown's fenced code block as follows:
-```json
-[
-    {{"Like": "yes / no", "Repost": "yes / no", "Explanation": "concise explanation of your decision with 1-3 sentences for the first post (use chinese for the explanation)"}},
-    {{"Like": "yes / no", "Repost": "yes / no", "Explanation": "concise explanation of your decision with 1-3 sentences for the second post (use chinese for the explanation)"}},
-    ...
-]
-```
 """
 
     post = \
 """
+Here are your previous posts you made:
+{previous_posts}
 It's {timestamp} now. Do you want to post something on social media?
 Here are your recent memories and experiences:
 {memories}
-Here are your previous posts you made, make sure your style is consistent with your previous posts if you decide to post:
-{previous_posts}
 """
 
     plan_system = \
 """
 Act as a social media user.
-Your characteristics are: {characteristics}
 You need to plan your activities on social media for one day.
 Your plan should specify the active time slots you will spend on social media.
 Just respond in list format, without any additional explanation.
@@ -138,9 +133,6 @@ Example: ["HH:MM-HH:MM", "HH:MM-HH:MM", ...]
 """
 Today is {date}.
 What's your plan for today?
-Your plan should specify the active time slots you will spend on social media.
-Just respond in list format, without any additional explanation.
-Example: ["HH:MM-HH:MM", "HH:MM-HH:MM", ...]
 """
 
     post_translation = \
@@ -194,15 +186,11 @@ Post: [Your post here]
 """
 
 # prompt: 用英文对一段行为进行简短的总结，保留原意
-PROMPT_NAIVE_MEMORY = \
+PROMPT_NAIVE_MEMORY_SYSTEM = \
 """
 You are a real human user on a social media platform. 
 Your task is to analyze your interaction in social media and provide a brief summary and reflection of your recent activity.
 
-Here is the your recent activity:
-{timestamp}:
-{behavior}
-
 Steps:
 1. Review the recorded activities to understand the context and motivation behind each action.
 2. Identify the main themes, viewpoints, or arguments in the posts you interacted with.
@@ -223,13 +211,16 @@ Requirements:
 Format your response in first-person narrative.
 """
 
-PROMPT_NAIVE_MULTI_MEMORY = \
+PROMPT_NAIVE_MEMORY = \
 """
-You are a real human user on a social media platform. Given your recent activities, you are tasked with analyzing your interactions and providing a brief summary and reflection.
-
-Here is the record of your activities:
+Here is the your recent activity:
 {timestamp}:
 {behavior}
+"""
+
+PROMPT_NAIVE_MULTI_MEMORY_SYSTEM = \
+"""
+You are a real human user on a social media platform. Given your recent activities, you are tasked with analyzing your interactions and providing a brief summary and reflection.
 
 Steps:
 1. Review the recorded activities to understand the context and motivation behind each action.
@@ -251,6 +242,13 @@ Requirements:
 Format your response in first-person narrative.
 """
 
+PROMPT_NAIVE_MULTI_MEMORY = \
+"""
+Here is the record of your activities:
+{timestamp}:
+{behavior}
+"""
+
 PROMPT_ACTIVE_PREDICTION = \
 """
 You are a real human user on a social media platform. 
@@ -281,12 +279,9 @@ Time: [Your predicted time here if Browsing or Posting / None]
 Explanation: [Your reasoning here]
 """
 
-PROMPT_DAILY_REFLECTION = \
+PROMPT_DAILY_REFLECTION_SYSTEM = \
 """
-You are a real human on a social media platform. Here is the record of your activities in the past day:
-{timestamp}:
-{behavior}
-
+You are a real human on a social media platform.
 Your task is to analyze your interactions and reflect on your daily social media activities.
 
 Please consider the following aspects:
@@ -299,6 +294,35 @@ Requirements:
 Your response should be 1-3 sentences long, summarizing your daily social media activities.
 """
 
+PROMPT_DAILY_REFLECTION = \
+"""
+Here is the record of your activities in the past day:
+{timestamp}:
+{behavior}
+"""
+
+# prompt: 把一个周期（默认一周）内的旧记忆整合成一条周期总结
+PROMPT_CONSOLIDATION_SYSTEM = \
+"""
+You are a real human on a social media platform.
+Your task is to condense your memories of a past period into one summary that you will keep instead of them.
+
+Please keep:
+- The topics and kinds of content you engaged with, and how you engaged (reading, liking, sharing, posting).
+- Any views you expressed and anything that changed during the period.
+
+Requirements:
+- Use specific dates instead of words like "this week."
+
+Your response should be 2-4 sentences long.
+"""
+
+PROMPT_CONSOLIDATION = \
+"""
+Here are your memories from {period}:
+{memories}
+"""
+
 # prompt: 从用户的特征和相关的记忆中预测用户对于某个帖子的行为
 PROMPT_REACT = \
 """
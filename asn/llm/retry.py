@@ -0,0 +1,186 @@
+"""
+Retry policy shared by the LLM and embedding clients.
+指数退避 + 随机抖动，避免服务器恢复时所有线程在同一时刻重试；每次调用有总的时间预算（deadline）；
+熔断器在服务器不可用时让调用快速失败，只放行一个试探请求。
+"""
+import time
+import random
+import asyncio
+import threading
+import openai
+from typing import Callable, Awaitable, Any
+from asn.utils.logger import get_logger
+
+
+class LLMUnavailableError(Exception):
+    """Raised when a request still fails after the retry budget is spent or the circuit is open."""
+
+
+class CircuitOpenError(LLMUnavailableError):
+    """Raised when the circuit breaker is open and the deadline does not allow waiting for it."""
+
+
+class LLMRequestError(LLMUnavailableError):
+    """Raised without retrying when the server rejects the request itself (bad request, context overflow, auth)."""
+
+
+def is_retryable_error(error: Exception) -> bool:
+    # 请求本身有问题（如超出上下文长度、参数错误）时重试也没有用
+    return not isinstance(error, (openai.BadRequestError, openai.AuthenticationError, openai.PermissionDeniedError, openai.NotFoundError, openai.UnprocessableEntityError))
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures. While open, calls wait (or fail fast);
+    after `reset_timeout` seconds a single trial request is let through (half-open),
+    which closes the circuit on success or re-opens it on failure.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_at = None    # 半开状态下试探请求的发出时间
+        self.opens = 0
+        self.lock = threading.Lock()
+
+    def wait_time(self) -> float:
+        """Seconds to wait before a request may be sent; 0 means go ahead (possibly as the half-open trial)."""
+        with self.lock:
+            if self.state == "closed":
+                return 0.0
+            now = time.time()
+            if self.state == "open":
+                if now < self.opened_at + self.reset_timeout:
+                    return self.opened_at + self.reset_timeout - now
+                self.state = "half-open"
+                self.trial_at = None
+            # 试探请求被取消或迟迟没有结果时，允许再放行一个
+            if self.trial_at is None or now - self.trial_at > self.reset_timeout:
+                self.trial_at = now
+                return 0.0
+            # 试探请求还在进行中，其他请求稍后再看
+            return min(1.0, self.reset_timeout)
+
+    def record_success(self) -> None:
+        with self.lock:
+            if self.state != "closed":
+                get_logger().info("Circuit closed, server recovered")
+            self.state = "closed"
+            self.failures = 0
+            self.trial_at = None
+
+    def release_trial(self) -> None:
+        # 试探请求因请求本身的问题被拒绝，不能说明服务器是否恢复，让下一个请求继续试探
+        with self.lock:
+            if self.state == "half-open":
+                self.trial_at = None
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.state == "half-open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                if self.state == "closed":
+                    get_logger().error(f"Circuit opened after {self.failures} consecutive failures")
+                self.state = "open"
+                self.opened_at = time.time()
+                self.trial_at = None
+                self.opens += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "opens": self.opens,
+            }
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, bounded by `max_attempts` and a per-call `deadline` (seconds),
+    in front of a circuit breaker. Non-retryable errors (bad requests) are raised immediately as LLMRequestError.
+    """
+    def __init__(self, max_attempts: int = 5, base_delay: float = 0.5, max_delay: float = 30.0, deadline: float = 300.0,
+                 failure_threshold: int = 5, reset_timeout: float = 10.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _next_wait(self, time_start: float, attempt: int, error: Exception) -> float:
+        """Record a failed attempt and return how long to sleep, or raise if the budget is spent."""
+        if not is_retryable_error(error):
+            # 请求本身有问题，既不算服务器故障也不算成功
+            self.breaker.release_trial()
+            self.rejected += 1
+            raise LLMRequestError(f"Request rejected: {error}") from error
+        self.breaker.record_failure()
+        if attempt + 1 >= self.max_attempts:
+            self.failures += 1
+            raise LLMUnavailableError(f"Failed after {attempt + 1} attempts: {error}") from error
+        delay = self.backoff(attempt)
+        if time.time() - time_start + delay > self.deadline:
+            self.failures += 1
+            raise LLMUnavailableError(f"Deadline of {self.deadline} s exceeded after {attempt + 1} attempts: {error}") from error
+        self.retries += 1
+        get_logger().debug(f"Retry {attempt + 1}/{self.max_attempts - 1} in {delay:.2f} s after error: {error}")
+        return delay
+
+    def _breaker_wait(self, time_start: float) -> float:
+        wait = self.breaker.wait_time()
+        if wait > 0 and time.time() - time_start + wait > self.deadline:
+            self.failures += 1
+            raise CircuitOpenError(f"Circuit open, not retrying within the deadline of {self.deadline} s")
+        # 加入抖动，避免熔断恢复时所有等待者同时发出请求
+        return wait * random.uniform(1.0, 1.5) if wait > 0 else 0.0
+
+    def call(self, fn: Callable[[], Any]) -> Any:
+        time_start = time.time()
+        attempt = 0
+        while True:
+            wait = self._breaker_wait(time_start)
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                result = fn()
+            except Exception as e:
+                time.sleep(self._next_wait(time_start, attempt, e))
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def acall(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        time_start = time.time()
+        attempt = 0
+        while True:
+            wait = self._breaker_wait(time_start)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            try:
+                result = await fn()
+            except Exception as e:
+                await asyncio.sleep(self._next_wait(time_start, attempt, e))
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    def stats(self) -> dict:
+        return {
+            "retries": self.retries,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "circuit": self.breaker.stats(),
+        }
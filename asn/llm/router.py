@@ -0,0 +1,174 @@
+"""
+Multi-endpoint routing for OpenAI-compatible servers.
+llm_url / embed_url 可以是多个 vLLM 副本的列表，请求发往在途请求最少的副本；
+连续失败的副本暂时移出轮转，由后台线程探测恢复后再加入。
+"""
+import time
+import asyncio
+import threading
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from contextlib import contextmanager, asynccontextmanager
+from typing import List, Union
+from asn.utils.logger import get_logger
+from asn.llm.limiter import is_overload_error
+
+
+class AsyncClientPool:
+    """
+    AsyncOpenAI client shared by all coroutines.
+    The client (and its keep-alive connection pool) is bound to the event loop it was created in,
+    so it is re-created lazily when used from a different loop; `aclose` it before its loop ends.
+    """
+    def __init__(self, api_key: str, base_url: str, max_inflight: int = 256):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_inflight = max_inflight
+        self.loop = None
+        self.client: AsyncOpenAI = None
+
+    def get(self) -> AsyncOpenAI:
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_inflight, max_keepalive_connections=self.max_inflight),
+                timeout=3000,
+            )
+            self.client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, http_client=http_client)
+            self.loop = loop
+        return self.client
+
+    async def aclose(self) -> None:
+        if self.client is not None and self.loop is asyncio.get_running_loop():
+            await self.client.close()
+        self.client = None
+        self.loop = None
+
+
+class Replica:
+    def __init__(self, url: str, api_key: str, max_inflight: int = 256):
+        self.url = url
+        self.client = OpenAI(api_key=api_key, base_url=url)
+        self.async_pool = AsyncClientPool(api_key, url, max_inflight)
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.latency = None
+        self.healthy = True
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency": self.latency,
+        }
+
+
+class ReplicaRouter:
+    """
+    Least-outstanding-requests balancing over one or more replicas, with a global in-flight limit for coroutines.
+    A replica is taken out of rotation after `failure_threshold` consecutive overload/connection errors
+    and probed every `probe_interval` seconds until it answers again.
+    """
+    def __init__(self, urls: Union[str, List[str]], api_key: str = "EMPTY", max_inflight: int = 256, failure_threshold: int = 3, probe_interval: float = 10.0):
+        if isinstance(urls, str):
+            urls = [urls]
+        self.replicas = [Replica(url, api_key, max_inflight) for url in urls]
+        self.max_inflight = max_inflight
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.lock = threading.Lock()
+        self.loop = None
+        self.semaphore: asyncio.Semaphore = None
+        self.probe_thread = threading.Thread(target=self._probe, name="ReplicaProbe", daemon=True)
+        self.probe_thread.start()
+
+    def _acquire(self) -> Replica:
+        with self.lock:
+            candidates = [replica for replica in self.replicas if replica.healthy]
+            if not candidates:
+                # 所有副本都不可用时仍然尝试，由调用方的重试逻辑处理失败
+                candidates = self.replicas
+            replica = min(candidates, key=lambda replica: replica.outstanding)
+            replica.outstanding += 1
+            replica.requests += 1
+            return replica
+
+    def _release(self, replica: Replica, latency: float = None, error: Exception = None) -> None:
+        with self.lock:
+            replica.outstanding -= 1
+            if error is not None:
+                replica.errors += 1
+                if is_overload_error(error):
+                    replica.consecutive_errors += 1
+                    if replica.healthy and replica.consecutive_errors >= self.failure_threshold:
+                        replica.healthy = False
+                        get_logger().error(f"Replica {replica.url} taken out of rotation after {replica.consecutive_errors} consecutive errors: {error}")
+            elif latency is not None:
+                replica.consecutive_errors = 0
+                replica.latency = latency if replica.latency is None else 0.9 * replica.latency + 0.1 * latency
+
+    @contextmanager
+    def replica(self):
+        replica = self._acquire()
+        time_start = time.time()
+        latency, error = None, None
+        try:
+            yield replica
+            latency = time.time() - time_start
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # 被取消时也要减少在途请求数，否则该副本一直被当作繁忙
+            self._release(replica, latency=latency, error=error)
+
+    @asynccontextmanager
+    async def areplica(self):
+        # asyncio.Semaphore 绑定到创建时的事件循环，事件循环变化时重新创建
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.semaphore = asyncio.Semaphore(self.max_inflight)
+            self.loop = loop
+        async with self.semaphore:
+            replica = self._acquire()
+            time_start = time.time()
+            latency, error = None, None
+            try:
+                yield replica
+                latency = time.time() - time_start
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                # 被取消时也要减少在途请求数，否则该副本一直被当作繁忙
+                self._release(replica, latency=latency, error=error)
+
+    async def aclose(self) -> None:
+        """Close the async clients of all replicas (call from the loop they were used in)."""
+        for replica in self.replicas:
+            await replica.async_pool.aclose()
+
+    def _probe(self) -> None:
+        while True:
+            time.sleep(self.probe_interval)
+            for replica in self.replicas:
+                if replica.healthy:
+                    continue
+                try:
+                    replica.client.models.list(timeout=5)
+                except Exception as e:
+                    get_logger().debug(f"Replica {replica.url} still unavailable: {e}")
+                    continue
+                with self.lock:
+                    replica.healthy = True
+                    replica.consecutive_errors = 0
+                get_logger().info(f"Replica {replica.url} back in rotation")
+
+    def stats(self) -> List[dict]:
+        with self.lock:
+            return [replica.stats() for replica in self.replicas]
@@ -0,0 +1,77 @@
+"""
+JSON schemas for structured output (schema-constrained decoding).
+开启 structured_output 后，react / reacts / post / plan 请求会带上 JSON schema，
+由 vLLM 的 guided_json 或 OpenAI 兼容的 response_format 约束输出格式；同时统计解析失败后走回退路径的次数。
+"""
+import threading
+
+
+YES_NO = {"type": "string", "enum": ["yes", "no"]}
+
+REACT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "Like": YES_NO,
+        "Repost": YES_NO,
+        "Explanation": {"type": "string"},
+    },
+    "required": ["Like", "Repost", "Explanation"],
+}
+
+POST_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "Post": {"type": "string"},
+        "Explanation": {"type": "string"},
+    },
+    "required": ["Post", "Explanation"],
+}
+
+PLAN_SCHEMA = {
+    "type": "array",
+    "items": {"type": "string", "pattern": "^[0-2][0-9]:[0-5][0-9]-[0-2][0-9]:[0-5][0-9]$"},
+}
+
+
+def reacts_schema(num_posts: int) -> dict:
+    # 数组长度固定为本批次的帖子数
+    return {
+        "type": "array",
+        "items": REACT_SCHEMA,
+        "minItems": num_posts,
+        "maxItems": num_posts,
+    }
+
+
+def request_params(mode: str, name: str, schema: dict) -> dict:
+    """Extra chat completion parameters that constrain the output to `schema`."""
+    if mode == "guided_json":
+        return {"extra_body": {"guided_json": schema}}
+    if mode == "response_format":
+        return {"response_format": {"type": "json_schema", "json_schema": {"name": name, "schema": schema}}}
+    raise ValueError(f"Unknown structured output mode: {mode}")
+
+
+class FallbackStats:
+    """Counts, per call site, how many responses could not be used and fell back to the default path."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sites = {}
+
+    def record(self, call_site: str, fallback: bool) -> None:
+        with self.lock:
+            site = self.sites.setdefault(call_site, {"calls": 0, "fallbacks": 0})
+            site["calls"] += 1
+            site["fallbacks"] += fallback
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                call_site: {**site, "fallback_rate": site["fallbacks"] / site["calls"] if site["calls"] else 0.0}
+                for call_site, site in self.sites.items()
+            }
+
+
+FALLBACK_STATS = FallbackStats()
+def get_fallback_stats() -> FallbackStats:
+    return FALLBACK_STATS
@@ -0,0 +1,94 @@
+"""
+Single-flight deduplication of identical in-flight requests.
+多个 agent 并行时经常在同一时刻发出完全相同的请求（被多人转发的热门消息的 embedding、固定的记忆检索 query、空历史的 profile prompt）。
+相同 key 的并发请求只发出一次网络调用，其余调用等待并共享它的结果（或异常）；线程和协程（包括不同事件循环）之间都可以共享。
+发出请求的协程被取消时不把取消传给等待者，它们重新加入，由其中一个重新发出请求；等待者自己被取消也不影响其他调用。
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class _LeaderCancelled(Exception):
+    """Set on a flight whose leader was cancelled; its followers join again instead of failing."""
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time; concurrent callers with the same key wait for it and count as collapsed."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.calls = 0
+        self.collapsed = 0
+
+    def _join(self, key: Hashable, rejoin: bool = False):
+        # 返回 (future, 是否由当前调用者发出请求)；rejoin 表示 leader 被取消后重新加入，不重复计数
+        with self.lock:
+            if not rejoin:
+                self.calls += 1
+            if key in self.inflight:
+                if not rejoin:
+                    self.collapsed += 1
+                return self.inflight[key], False
+            future = Future()
+            self.inflight[key] = future
+            return future, True
+
+    def _finish(self, key: Hashable, future: Future, result: Any = None, error: BaseException = None) -> None:
+        with self.lock:
+            del self.inflight[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        rejoin = False
+        while True:
+            future, leader = self._join(key, rejoin)
+            if leader:
+                break
+            try:
+                return future.result()
+            except _LeaderCancelled:
+                rejoin = True
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def ado(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Async version of `do`, `fn` is a coroutine function."""
+        rejoin = False
+        while True:
+            future, leader = self._join(key, rejoin)
+            if leader:
+                break
+            try:
+                # shield：等待者被取消时不能取消共享的 future
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except _LeaderCancelled:
+                rejoin = True
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            self._finish(key, future, error=_LeaderCancelled())
+            raise
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "collapsed": self.collapsed,
+                "collapse_rate": self.collapsed / self.calls if self.calls else 0.0,
+                "inflight": len(self.inflight),
+            }
@@ -0,0 +1,90 @@
+"""
+Streaming sink for LLM prompts and responses.
+调用线程只把记录放进队列，由后台线程以 JSONL 追加写入文件，文件达到上限后轮转（可选 gzip 压缩）。
+"""
+import os
+import gzip
+import json
+import time
+import queue
+import atexit
+import threading
+from asn.utils.logger import get_logger
+
+
+class LLMOutputSink:
+    """
+    Append-only JSONL writer fed by a queue and drained by a background thread.
+    When the current file exceeds `max_bytes` it is rotated to `<path>.<n>` (or `<path>.<n>.gz` if `compress`).
+    Pending records are flushed on `close()`, which is also registered to run at interpreter exit.
+    """
+    def __init__(self, path: str = "llm_out.jsonl", max_bytes: int = 256 * 1024 * 1024, compress: bool = False, flush_interval: float = 1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.dropped = 0
+        self.written = 0
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="LLMOutputSink", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, record: dict) -> None:
+        if self.closed:
+            self.dropped += 1
+            return
+        record.setdefault("time", time.time())
+        self.queue.put(record)
+
+    def _run(self) -> None:
+        last_flush = time.time()
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                record = None
+            if record is not None:
+                if record is StopIteration:
+                    break
+                try:
+                    self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    self.written += 1
+                except Exception as e:
+                    get_logger().error(f"Error in LLMOutputSink: {e}")
+                    self.dropped += 1
+            if time.time() - last_flush >= self.flush_interval or (record is None and self.queue.empty()):
+                self.file.flush()
+                last_flush = time.time()
+                if self.file.tell() >= self.max_bytes:
+                    self._rotate()
+        self.file.flush()
+        self.file.close()
+
+    def _rotate(self) -> None:
+        self.file.close()
+        index = 1
+        while os.path.exists(f"{self.path}.{index}") or os.path.exists(f"{self.path}.{index}.gz"):
+            index += 1
+        if self.compress:
+            with open(self.path, "rb") as f_in, gzip.open(f"{self.path}.{index}.gz", "wb") as f_out:
+                while True:
+                    chunk = f_in.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    f_out.write(chunk)
+            os.remove(self.path)
+        else:
+            os.rename(self.path, f"{self.path}.{index}")
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(StopIteration)
+        self.thread.join()
@@ -0,0 +1,280 @@
+"""
+Deterministic offline stand-in for the vLLM OpenAI-compatible servers.
+不需要 GPU 即可运行整个模拟流程，用于在 CPU 机器上测量和分析模拟器本身的吞吐：
+/v1/chat/completions 按 Prompts 中的 prompt 类型返回符合格式（或请求中 JSON schema）的固定 JSON，
+/v1/embeddings 返回以文本哈希为种子的确定性向量，/v1/models 用于健康检查。
+延迟分布、并发上限（吞吐）和失败率都可以配置。
+
+Usage:
+    python -m asn.llm.standin --port 8001 --latency 0.5 --max-concurrency 64
+    python -m asn.llm.standin --port 8002 --dim 3584 --latency 0.02
+"""
+import re
+import json
+import time
+import base64
+import random
+import hashlib
+import argparse
+import threading
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from asn.llm.prompt import Prompts, PROMPT_NAIVE_MEMORY_SYSTEM, PROMPT_NAIVE_MULTI_MEMORY_SYSTEM, PROMPT_DAILY_REFLECTION_SYSTEM
+from asn.llm.schema import REACT_SCHEMA, POST_SCHEMA, PLAN_SCHEMA, reacts_schema
+from asn.llm.budget import estimate_tokens
+
+
+# 按 system prompt 的开头识别 prompt 类型
+FAMILIES = [
+    ("reacts", Prompts.reacts_system.format()),
+    ("react", Prompts.react_system.format()),
+    ("post", Prompts.post_system.format()),
+    ("plan", Prompts.plan_system),
+    ("profile", Prompts.profile_system),
+    ("memory", PROMPT_NAIVE_MEMORY_SYSTEM),
+    ("multi-memory", PROMPT_NAIVE_MULTI_MEMORY_SYSTEM),
+    ("daily-reflection", PROMPT_DAILY_REFLECTION_SYSTEM),
+]
+
+TOPICS = ["technology", "sports", "music", "politics", "travel", "food", "gaming", "movies"]
+
+
+def prompt_family(prompt_sys: str) -> str:
+    for family, instructions in FAMILIES:
+        if prompt_sys.startswith(instructions.rstrip()):
+            return family
+    return "other"
+
+
+def count_posts(prompt: str) -> int:
+    # reacts 的帖子在 "posts in your feed:" 之后逐行编号
+    posts = prompt.split("posts in your feed:")[-1]
+    return max(1, len([line for line in posts.split("\n") if re.match(r"^\d+\. ", line)]))
+
+
+def instance_from_schema(schema: dict, rng: random.Random):
+    """A deterministic value valid under the (small) subset of JSON schema used in asn.llm.schema."""
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    if schema.get("type") == "object":
+        return {key: instance_from_schema(value, rng) for key, value in schema.get("properties", {}).items()}
+    if schema.get("type") == "array":
+        num = schema.get("minItems", rng.randint(1, 3))
+        return [instance_from_schema(schema.get("items", {}), rng) for _ in range(num)]
+    if schema.get("type") == "string" and "pattern" in schema:
+        # 目前只有 plan 的时间段使用 pattern
+        start = rng.randint(0, 22)
+        return "%02d:00-%02d:%02d" % (start, rng.randint(start + 1, 23), rng.choice([0, 30, 59]))
+    if schema.get("type") in ("integer", "number"):
+        return rng.randint(0, 10)
+    if schema.get("type") == "boolean":
+        return rng.random() < 0.5
+    return "I find this about %s interesting." % rng.choice(TOPICS)
+
+
+def canned_response(request: dict) -> str:
+    messages = request["messages"]
+    prompt_sys = messages[0]["content"] if len(messages) > 1 else ""
+    prompt = messages[-1]["content"]
+    rng = random.Random(hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest())
+    # 请求中带有 JSON schema（结构化输出）时直接按 schema 生成
+    if "guided_json" in request:
+        return json.dumps(instance_from_schema(request["guided_json"], rng))
+    if isinstance(request.get("response_format"), dict) and request["response_format"].get("type") == "json_schema":
+        return json.dumps(instance_from_schema(request["response_format"]["json_schema"]["schema"], rng))
+    family = prompt_family(prompt_sys)
+    if family == "reacts":
+        return "```json\n%s\n```" % json.dumps(instance_from_schema(reacts_schema(count_posts(prompt)), rng), indent=4)
+    if family == "react":
+        return "```json\n%s\n```" % json.dumps(instance_from_schema(REACT_SCHEMA, rng), indent=4)
+    if family == "post":
+        post = instance_from_schema(POST_SCHEMA, rng)
+        if rng.random() < 0.5:
+            post["Post"] = "No post"
+        return "```json\n%s\n```" % json.dumps(post, indent=4)
+    if family == "plan":
+        return json.dumps(instance_from_schema(PLAN_SCHEMA, rng))
+    if family == "profile":
+        return "You are a social media user who enjoys %s and %s. Your activity level is %s." % (rng.choice(TOPICS), rng.choice(TOPICS), rng.choice(["high", "moderate", "low"]))
+    if family in ("memory", "multi-memory", "daily-reflection"):
+        return "I read some posts about %s and %s, and chose to %s." % (rng.choice(TOPICS), rng.choice(TOPICS), rng.choice(["like one of them", "repost one of them", "keep silent"]))
+    return "OK."
+
+
+def embedding(text: str, dim: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class StandinServer(ThreadingHTTPServer):
+    """
+    `latency` is the mean service time of a chat completion (plus `latency_per_token` per completion token),
+    drawn from a `latency_dist` of "fixed", "exponential" or "lognormal"; embeddings take `embed_latency` per request.
+    At most `max_concurrency` requests are served at once, further requests queue (up to `max_queue`, then 429).
+    A fraction `failure_rate` of requests fails with 503. Streamed completions (`stream: true`) are sent in chunks of about one token.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, dim: int = 3584, model: str = "standin", latency: float = 0.0, latency_dist: str = "fixed", latency_per_token: float = 0.0,
+                 embed_latency: float = 0.0, max_concurrency: int = 0, max_queue: int = 0, failure_rate: float = 0.0, seed: int = 0):
+        super().__init__(address, StandinHandler)
+        self.dim = dim
+        self.model = model
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.latency_per_token = latency_per_token
+        self.embed_latency = embed_latency
+        self.slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency > 0 else None
+        self.max_queue = max_queue
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.requests = 0
+        self.cancelled = 0
+
+    def service_time(self, base: float, tokens: int = 0) -> float:
+        with self.lock:
+            if self.latency_dist == "exponential":
+                base = self.rng.expovariate(1 / base) if base > 0 else 0.0
+            elif self.latency_dist == "lognormal":
+                base = base * self.rng.lognormvariate(-0.125, 0.5)
+        return base + tokens * self.latency_per_token
+
+    def should_fail(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            return self.rng.random() < self.failure_rate
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: StandinServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status: int, message: str) -> None:
+        self._send(status, {"error": {"message": message, "type": "standin_error", "code": status}})
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send(200, {"object": "list", "data": [{"id": self.server.model, "object": "model", "created": 0, "owned_by": "standin"}]})
+        else:
+            self._error(404, f"Unknown path {self.path}")
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path.endswith("/chat/completions"):
+            handle = self._chat
+        elif self.path.endswith("/embeddings"):
+            handle = self._embeddings
+        else:
+            return self._error(404, f"Unknown path {self.path}")
+        server = self.server
+        if server.slots is not None:
+            with server.lock:
+                if server.max_queue and server.waiting >= server.max_queue:
+                    return self._error(429, "Too many requests")
+                server.waiting += 1
+            server.slots.acquire()
+            with server.lock:
+                server.waiting -= 1
+        try:
+            if server.should_fail():
+                return self._error(503, "Injected failure")
+            handle(request)
+        finally:
+            if server.slots is not None:
+                server.slots.release()
+
+    def _chat(self, request: dict) -> None:
+        content = canned_response(request)
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in request["messages"])
+        completion_tokens = estimate_tokens(content)
+        if request.get("stream"):
+            return self._chat_stream(request, content, prompt_tokens, completion_tokens)
+        time.sleep(self.server.service_time(self.server.latency, completion_tokens))
+        self._send(200, {
+            "id": "chatcmpl-standin",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", self.server.model),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def _chat_stream(self, request: dict, content: str, prompt_tokens: int, completion_tokens: int) -> None:
+        # Server-sent events，约每 4 个字符一个 token；客户端提前断开时停止生成
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        chunk = {"id": "chatcmpl-standin", "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get("model", self.server.model)}
+        events = [{**chunk, "choices": [{"index": 0, "delta": {"role": "assistant", "content": content[i:i + 4]}, "finish_reason": None}]} for i in range(0, len(content), 4)]
+        events.append({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if isinstance(request.get("stream_options"), dict) and request["stream_options"].get("include_usage"):
+            events.append({**chunk, "choices": [], "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}})
+        time.sleep(self.server.service_time(self.server.latency))
+        try:
+            for event in events:
+                self.wfile.write(b"data: " + json.dumps(event).encode("utf-8") + b"\n\n")
+                self.wfile.flush()
+                time.sleep(self.server.latency_per_token)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            with self.server.lock:
+                self.server.cancelled += 1
+
+    def _embeddings(self, request: dict) -> None:
+        texts = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        use_base64 = request.get("encoding_format") == "base64"
+        data = []
+        for i, text in enumerate(texts):
+            vector = embedding(text, self.server.dim)
+            data.append({
+                "object": "embedding",
+                "index": i,
+                "embedding": base64.b64encode(vector.tobytes()).decode("ascii") if use_base64 else vector.tolist(),
+            })
+        time.sleep(self.server.service_time(self.server.embed_latency))
+        prompt_tokens = sum(estimate_tokens(text) for text in texts)
+        self._send(200, {
+            "object": "list",
+            "data": data,
+            "model": request.get("model", self.server.model),
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline OpenAI-compatible stand-in for the LLM and embedding servers")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--dim", type=int, default=3584, help="embedding dimension")
+    parser.add_argument("--model", type=str, default="standin")
+    parser.add_argument("--latency", type=float, default=0.0, help="mean chat completion latency in seconds")
+    parser.add_argument("--latency-dist", type=str, default="fixed", choices=["fixed", "exponential", "lognormal"])
+    parser.add_argument("--latency-per-token", type=float, default=0.0, help="extra seconds per completion token")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="mean embedding request latency in seconds")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="requests served at once, 0 for unlimited")
+    parser.add_argument("--max-queue", type=int, default=0, help="queued requests before answering 429, 0 for unlimited")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of requests failing with 503")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server = StandinServer((args.host, args.port), dim=args.dim, model=args.model, latency=args.latency, latency_dist=args.latency_dist,
+                           latency_per_token=args.latency_per_token, embed_latency=args.embed_latency, max_concurrency=args.max_concurrency,
+                           max_queue=args.max_queue, failure_rate=args.failure_rate, seed=args.seed)
+    print(f"Stand-in server listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
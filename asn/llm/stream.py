@@ -0,0 +1,145 @@
+"""
+Streaming completions with early termination.
+react / reacts / post 只需要 Like、Repost、Post 字段，后面的 Explanation 不会被使用。
+流式模式下逐块检查已生成的文本，所需字段都完整后立即关闭连接（vLLM 随之中止该请求），节省解码 token 和尾延迟。
+"""
+import re
+import json
+import threading
+from typing import Callable, List, Optional
+from openai.types import CompletionUsage
+from asn.llm.budget import estimate_tokens
+
+
+# 返回完整响应文本表示可以提前结束，否则返回 None；有 reset 方法的条件在每次（包括重试）读流之前重置
+StopCondition = Callable[[str], Optional[str]]
+
+
+def _key_prefixes(keys: List[str]) -> str:
+    # 字段名只收到一部分时的所有可能（包括只收到开头的引号）
+    return "|".join(sorted({re.escape(key[:i]) for key in keys for i in range(len(key) + 1)}, key=len, reverse=True))
+
+
+class JSONFieldsStop:
+    """
+    Stop once the string fields `keys` are complete in `num_objects` JSON objects (None for a single object).
+    The response is rebuilt as JSON from the extracted fields, so the usual parsers accept it.
+    Each call only scans the text after the last complete field (and the field still being received).
+    """
+    def __init__(self, keys: List[str], num_objects: int = None):
+        self.keys = keys
+        self.num_objects = num_objects
+        names = "|".join(re.escape(key) for key in keys)
+        # 完整的字段，或者文本末尾尚未收完的字段
+        self.pattern = re.compile(
+            r'"(?P<key>%s)"(?:\s*:\s*"(?P<value>(?:[^"\\]|\\.)*)"|\s*(?::\s*(?:"(?:[^"\\]|\\.)*\\?)?)?\Z)|"(?:%s)\Z' % (names, _key_prefixes(keys))
+        )
+        self.reset()
+
+    def reset(self) -> None:
+        self.offset = 0
+        self.values = {key: [] for key in self.keys}
+
+    def __call__(self, text: str) -> Optional[str]:
+        offset = len(text)
+        for match in self.pattern.finditer(text, self.offset):
+            if match.group("value") is None:
+                # 未收完的字段下次从它的开头重新匹配
+                offset = match.start()
+                break
+            self.values[match.group("key")].append(json.loads('"%s"' % match.group("value")))
+        self.offset = offset
+        count = 1 if self.num_objects is None else self.num_objects
+        if any(len(found) < count for found in self.values.values()):
+            return None
+        objects = [{key: self.values[key][i] for key in self.keys} for i in range(count)]
+        return json.dumps(objects[0] if self.num_objects is None else objects, ensure_ascii=False)
+
+
+def react_stop() -> StopCondition:
+    return JSONFieldsStop(["Like", "Repost"])
+
+
+def reacts_stop(num_posts: int) -> StopCondition:
+    # 收齐 num_posts 个对象就结束：模型多输出的对象被忽略，长度不符只有在少于 num_posts 个对象（读完整个流）时才能发现
+    return JSONFieldsStop(["Like", "Repost"], num_posts)
+
+
+def post_stop() -> StopCondition:
+    return JSONFieldsStop(["Post"])
+
+
+class StreamStats:
+    """Per call site: streamed calls, how many stopped early, and the number of chunks received."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sites = {}
+
+    def record(self, call_site: str, early: bool, chunks: int) -> None:
+        with self.lock:
+            site = self.sites.setdefault(call_site or "other", {"calls": 0, "early_stops": 0, "chunks": 0})
+            site["calls"] += 1
+            site["early_stops"] += early
+            site["chunks"] += chunks
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                call_site: {**site, "avg_chunks": site["chunks"] / site["calls"] if site["calls"] else 0.0}
+                for call_site, site in self.sites.items()
+            }
+
+
+STREAM_STATS = StreamStats()
+def get_stream_stats() -> StreamStats:
+    return STREAM_STATS
+
+
+def _estimated_usage(request: dict, chunks: int) -> CompletionUsage:
+    # 提前关闭的流收不到最后的 usage，按 prompt 长度和收到的块数（vLLM 约每块一个 token）估计
+    prompt_tokens = sum(estimate_tokens(message["content"]) for message in request["messages"])
+    return CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=chunks, total_tokens=prompt_tokens + chunks)
+
+
+def consume_stream(stream, request: dict, stop_when: StopCondition, call_site: str):
+    """Read a chat completion stream until it ends or `stop_when` is satisfied; returns `(response, usage)`."""
+    text, usage, chunks = "", None, 0
+    if hasattr(stop_when, "reset"):
+        stop_when.reset()
+    try:
+        for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                text += chunk.choices[0].delta.content
+                chunks += 1
+                response = stop_when(text)
+                if response is not None:
+                    STREAM_STATS.record(call_site, True, chunks)
+                    return response, _estimated_usage(request, chunks)
+    finally:
+        stream.close()
+    STREAM_STATS.record(call_site, False, chunks)
+    return text, usage if usage is not None else _estimated_usage(request, chunks)
+
+
+async def aconsume_stream(stream, request: dict, stop_when: StopCondition, call_site: str):
+    """Async version of `consume_stream`."""
+    text, usage, chunks = "", None, 0
+    if hasattr(stop_when, "reset"):
+        stop_when.reset()
+    try:
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                text += chunk.choices[0].delta.content
+                chunks += 1
+                response = stop_when(text)
+                if response is not None:
+                    STREAM_STATS.record(call_site, True, chunks)
+                    return response, _estimated_usage(request, chunks)
+    finally:
+        await stream.close()
+    STREAM_STATS.record(call_site, False, chunks)
+    return text, usage if usage is not None else _estimated_usage(request, chunks)
@@ -0,0 +1,137 @@
+"""
+Per-call-site token, latency and cost accounting.
+每次 LLM / embedding 调用按调用位置（call_site）、用户和模拟步记录 token 数和延迟，在每个 checkpoint 导出为 JSON 和 Prometheus 文本格式。
+用户和 embedding 的调用位置通过 contextvars 传递（线程和协程各自独立），LLM 的调用位置由调用方直接传入。
+"""
+import os
+import json
+import asyncio
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable
+
+
+CURRENT_USER: ContextVar = ContextVar("asn_usage_user", default=None)
+CURRENT_SITE: ContextVar = ContextVar("asn_usage_call_site", default=None)
+
+
+@contextmanager
+def usage_scope(user: Any = None, call_site: str = None):
+    """Attribute the calls made inside the block to `user` and (for embeddings) `call_site`."""
+    tokens = []
+    if user is not None:
+        tokens.append((CURRENT_USER, CURRENT_USER.set(user)))
+    if call_site is not None:
+        tokens.append((CURRENT_SITE, CURRENT_SITE.set(call_site)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def bind_user(user: Any, fn: Callable) -> Callable:
+    """Wrap `fn` (a function or a coroutine function) so that its calls are attributed to `user`, e.g. for executor.submit."""
+    if asyncio.iscoroutinefunction(fn):
+        async def arun(*args, **kwargs):
+            with usage_scope(user=user):
+                return await fn(*args, **kwargs)
+        return arun
+
+    def run(*args, **kwargs):
+        with usage_scope(user=user):
+            return fn(*args, **kwargs)
+    return run
+
+
+def _counters() -> dict:
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency": 0.0, "cost": 0.0}
+
+
+class UsageTracker:
+    """
+    Aggregates usage by (kind, call_site), by user and by simulation step.
+    `kind` is "llm" or "embed". Prices are per million tokens; latency is the summed wall time of the calls (seconds).
+    """
+    def __init__(self, prompt_price: float = 0.0, completion_price: float = 0.0, embed_price: float = 0.0):
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self.embed_price = embed_price
+        self.step = "init"
+        self.by_site = {}
+        self.by_user = {}
+        self.by_step = {}
+        self.lock = threading.Lock()
+
+    def set_step(self, step: str) -> None:
+        self.step = step
+
+    def record(self, kind: str, call_site: str, prompt_tokens: int = 0, completion_tokens: int = 0, latency: float = 0.0) -> None:
+        call_site = call_site or CURRENT_SITE.get() or "other"
+        user = CURRENT_USER.get()
+        prompt_tokens = prompt_tokens or 0
+        completion_tokens = completion_tokens or 0
+        if kind == "embed":
+            cost = prompt_tokens * self.embed_price / 1e6
+        else:
+            cost = (prompt_tokens * self.prompt_price + completion_tokens * self.completion_price) / 1e6
+        site_key = f"{kind}:{call_site}"
+        with self.lock:
+            targets = [
+                self.by_site.setdefault(site_key, _counters()),
+                self.by_step.setdefault(self.step, {}).setdefault(site_key, _counters()),
+            ]
+            if user is not None:
+                targets.append(self.by_user.setdefault(str(user), {}).setdefault(site_key, _counters()))
+            for counters in targets:
+                counters["calls"] += 1
+                counters["prompt_tokens"] += prompt_tokens
+                counters["completion_tokens"] += completion_tokens
+                counters["latency"] += latency
+                counters["cost"] += cost
+
+    def stats(self) -> dict:
+        with self.lock:
+            return json.loads(json.dumps({
+                "by_site": self.by_site,
+                "by_user": self.by_user,
+                "by_step": self.by_step,
+            }))
+
+    def to_prometheus(self) -> str:
+        # 只按调用位置导出，用户和步的维度基数太高，保留在 JSON 中
+        metrics = [
+            ("calls", "asn_llm_calls_total", "Number of calls"),
+            ("prompt_tokens", "asn_llm_prompt_tokens_total", "Prompt (input) tokens"),
+            ("completion_tokens", "asn_llm_completion_tokens_total", "Completion (output) tokens"),
+            ("latency", "asn_llm_latency_seconds_total", "Summed call latency in seconds"),
+            ("cost", "asn_llm_cost_total", "Estimated cost"),
+        ]
+        with self.lock:
+            sites = {key: dict(counters) for key, counters in self.by_site.items()}
+        lines = []
+        for field, name, help_text in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for key, counters in sorted(sites.items()):
+                kind, call_site = key.split(":", 1)
+                lines.append(f'{name}{{kind="{kind}",call_site="{call_site}"}} {counters[field]}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str) -> None:
+        """Write `usage.json` and `usage.prom` into the directory `path`."""
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(os.path.join(path, "usage.json"), "w") as f:
+            json.dump(self.stats(), f, indent=4)
+        with open(os.path.join(path, "usage.prom"), "w") as f:
+            f.write(self.to_prometheus())
+
+
+USAGE_TRACKER = UsageTracker()
+def set_usage_tracker(tracker: UsageTracker) -> None:
+    global USAGE_TRACKER
+    USAGE_TRACKER = tracker
+def get_usage_tracker() -> UsageTracker:
+    return USAGE_TRACKER
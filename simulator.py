@@ -3,13 +3,25 @@ import json
 import time
 import random
 from datetime import datetime
+import asyncio
 import threading
+from typing import List
 from asn.utils.logger import get_logger
 from asn.utils.time import *
 from asn.env.environment import Environment, User, Message
 from asn.agent.agent import Agent, LLMAgent, NaiveAgent
 from asn.agent.action import Act
+from asn.agent.memory import NaiveMemoryModule
 from asn.data.data import Data
+from asn.llm.llm import LLMManager
+from asn.llm.usage import usage_scope, bind_user, get_usage_tracker
+from asn.agent.summarizer import MemorySummarizer, set_memory_summarizer, get_memory_summarizer
+from asn.agent.template import TemplateMemory, set_template_memory, get_template_memory
+from asn.agent.memory_store import SharedMemoryStore, set_shared_memory_store, get_shared_memory_store
+from asn.agent.retriever import set_native_retriever
+from asn.agent.consolidation import MemoryBudget, set_memory_budget, get_memory_budget
+from asn.env.ann import ANNBackend, set_ann_backend, get_ann_backend
+from asn.env.timeline import FollowFeed, set_follow_feed
 from langchain_core.utils import mock_now
 from concurrent.futures import ThreadPoolExecutor
 
@@ -26,6 +38,9 @@ class Simulator:
             get_logger().info(f"Loading model from {conf['load_model']}")
             with open(conf["load_model"], "r") as f:
                 model_dict = json.load(f)
+                # 共享记忆库需要先于各 agent 的记忆模块加载
+                if "memory_store" in model_dict:
+                    set_shared_memory_store(SharedMemoryStore.load(model_dict["memory_store"]))
                 self.env = Environment.load_from_dict(model_dict["env"])
             get_logger().info("Model loaded.")
             print("Model loaded.")
@@ -50,11 +65,29 @@ class Simulator:
                 model_dict = {
                     "env": self.env.save_to_dict(save_path),
                 }
+                if get_shared_memory_store() is not None:
+                    model_dict["memory_store"] = get_shared_memory_store().save(save_path)
                 json.dump(model_dict, f, indent=4)
             get_logger().info(f"Model initialized and saved to {save_path}")
+            self._log_stats(save_path)
             print(f"Model initialized and saved to {save_path}")
 
 
+    def _log_stats(self, save_path: str):
+        # 每个 checkpoint 记录各组件的统计，并导出用量
+        get_logger().info(f"LLM stats: {LLMManager.stats()}")
+        if get_memory_summarizer() is not None:
+            get_logger().info(f"Memory summarizer stats: {get_memory_summarizer().stats()}")
+        if get_template_memory() is not None:
+            get_logger().info(f"Template memory stats: {get_template_memory().stats()}")
+        if get_shared_memory_store() is not None:
+            get_logger().info(f"Shared memory store stats: {get_shared_memory_store().stats()}")
+        if get_memory_budget() is not None:
+            get_logger().info(f"Memory budget stats: {get_memory_budget().stats()}")
+        if get_ann_backend() is not None:
+            get_logger().info(f"ANN backend stats: {get_ann_backend().stats()}")
+        get_usage_tracker().dump(save_path)
+
     # Initialize enviroment from data
     def init_env_from_data(self, env: Environment, data: Data):
         get_logger().info("Initializing environment...")
@@ -130,7 +163,7 @@ class Simulator:
                         with env.lock_message:
                             if hist["post_id"] in pid2mid:  # 只处理存在于系统之中的消息
                                 msg = env.id2message[env.id2message[pid2mid[hist["post_id"]]].origin_id()]
-                                msg.liked_by.append((user.id, hist["timestamp"]))
+                                env.like_message(msg, user.id, hist["timestamp"])
                                 user.like(msg.origin_id())
                                 env.log_act(user, msg, Act("like", msg.text, datetime.strptime(hist["timestamp"], TIME_FORMAT)), use_act_time=True)
                 time_step = add_interval(time_step, interval)
@@ -140,7 +173,7 @@ class Simulator:
         if parallel:
             threads = []
             for user in env.users:
-                t = threading.Thread(target=replay_user_history, args=(user, ))
+                t = threading.Thread(target=bind_user(user.id, replay_user_history), args=(user, ))
                 threads.append(t)
                 t.start()
             for t in threads:
@@ -165,7 +198,7 @@ class Simulator:
         if parallel:
             threads = []
             for user in env.users:
-                t = threading.Thread(target=get_user_profile, args=(user,))
+                t = threading.Thread(target=bind_user(user.id, get_user_profile), args=(user,))
                 threads.append(t)
                 t.start()
             for t in threads:
@@ -176,55 +209,147 @@ class Simulator:
         get_logger().info("User profile got.")
 
 
-    def simulate_user(self, user: User, env: Environment, data: Data, conf: dict):
-        # Step 1：为用户分发消息
-        msgs = env.distribute_messages_for_user_by_time(user, str_to_datetime(sub_interval(datetime_to_str(env.now), conf["time_intv"])), env.now)
+    def _record_react(self, user: User, env: Environment, msg: Message, act: Act, embed=None):
+        # 记录用户对一条消息的反应；转发消息的 embedding 可以预先算好（异步模式），否则在 add_message 中计算
+        if act.type == "like":
+            user.like(msg.origin_id())
+            with env.lock_message:
+                env.like_message(env.id2message[msg.origin_id()], user.id, datetime_to_str(env.now))
+        if act.type == "retweet" or act.type == "repost":
+            user.repost(msg.origin_id())
+            with env.lock_message:
+                env.id2message[msg.origin_id()].reposted_by.append((user.id, datetime_to_str(env.now)))
+                message = Message(id=str(len(env.messages)), type="repost", text=msg.text, author_id=user.id, timestamp=env.now, quote_id=msg.origin_id())
+                message.embed = embed
+                env.add_message(message, need_embed=embed is None)
+        env.log_act(user, msg, act)
+
+    def _record_post(self, user: User, env: Environment, act: Act, embed=None):
+        with env.lock_message:
+            message = Message(id=str(len(env.messages)), type="post", text=act.text, author_id=user.id, timestamp=env.now)
+            message.embed = embed
+            env.add_message(message, need_embed=embed is None)
+            user.post(message.id)
+            env.log_act(user, message, act)
+            get_logger().info(f"User {user.id} post: {act.text} at {env.now}")
+
+    def _distribute(self, users: List[User]) -> dict:
+        # Step 1：为本步所有活跃用户分发消息
+        time_begin = str_to_datetime(sub_interval(datetime_to_str(self.env.now), self.conf["time_intv"]))
+        return {user.id: self.env.distribute_messages_for_user_by_time(user, time_begin, self.env.now) for user in users}
+
+    def _prefetch_users(self, users: List[User], msgs_of: dict) -> List[User]:
+        # 使用共享记忆库且批量反应时，本步所有用户对信息流的记忆检索合并为一次（一次 embedding 请求、一次打分）
+        if get_shared_memory_store() is None or self.conf["react_strategy"] != "batch":
+            return []
+        return [user for user in users if isinstance(user.agent, LLMAgent) and user.agent.memory._shared() and msgs_of[user.id]]
+
+    def _prefetch_memories(self, users: List[User], msgs_of: dict) -> dict:
+        users = self._prefetch_users(users, msgs_of)
+        if not users:
+            return {}
+        queries = [LLMAgent.feed_query([msg.text for msg in msgs_of[user.id]]) for user in users]
+        try:
+            memories = NaiveMemoryModule.fetch_memories_many([user.agent.memory for user in users], queries, self.env.now)
+        except Exception as e:
+            # 批量检索失败时各用户在 recieve_all 中各自检索
+            get_logger().error(f"Error in fetching memories for {len(users)} users at {self.env.now}: {e}")
+            return {}
+        return {user.id: memories_retrieved for user, memories_retrieved in zip(users, memories)}
+
+    async def _aprefetch_memories(self, users: List[User], msgs_of: dict) -> dict:
+        users = self._prefetch_users(users, msgs_of)
+        if not users:
+            return {}
+        queries = [LLMAgent.feed_query([msg.text for msg in msgs_of[user.id]]) for user in users]
+        try:
+            memories = await NaiveMemoryModule.afetch_memories_many([user.agent.memory for user in users], queries, self.env.now)
+        except Exception as e:
+            get_logger().error(f"Error in fetching memories for {len(users)} users at {self.env.now}: {e}")
+            return {}
+        return {user.id: memories_retrieved for user, memories_retrieved in zip(users, memories)}
+
+    def simulate_user(self, user: User, env: Environment, data: Data, conf: dict, msgs: List[Message] = None, memories_retrieved=None):
+        # Step 1：为用户分发消息（simulate_step 中已为所有活跃用户分发好）
+        if msgs is None:
+            msgs = env.distribute_messages_for_user_by_time(user, str_to_datetime(sub_interval(datetime_to_str(env.now), conf["time_intv"])), env.now)
         get_logger().info(f"User {user.id} read {len(msgs)} messages at {env.now}. Messages from {sub_interval(datetime_to_str(env.now), conf['time_intv'])} to {env.now}")
         # Step 2：用户对消息做出反应
         if conf["react_strategy"] == "one": # 一次对一条消息做出反应
             for msg in msgs:
                 acts = user.read_post(msg.text, env.now)
-            for act in acts:
-                if act.type == "like":
-                    user.like(msg.origin_id())
-                if act.type == "retweet" or act.type == "repost":
-                    user.repost(msg.origin_id())
-                if act.type == "retweet" or act.type == "repost":
-                    with env.lock_message:
-                        env.id2message[msg.origin_id()].reposted_by.append((user.id, datetime_to_str(env.now)))
-                        message = Message(id=str(len(env.messages)), type="repost", text=msg.text, author_id=user.id, timestamp=env.now, quote_id=msg.origin_id())
-                        env.add_message(message)
-                if act.type == "like":
-                    with env.lock_message:
-                        env.id2message[msg.origin_id()].liked_by.append((user.id, datetime_to_str(env.now)))
-                env.log_act(user, msg, act)
+                for act in acts:
+                    self._record_react(user, env, msg, act)
         elif conf["react_strategy"] == "batch": # 批量对消息做出反应，兼顾效率和准确性
-            actss = user.read_posts([msg.text for msg in msgs], env.now)
+            actss = user.read_posts([msg.text for msg in msgs], env.now, memories_retrieved)
             for i, msg in enumerate(msgs):
                 for act in actss[i]:
-                    if act.type == "like":
-                        user.like(msg.origin_id())
-                    if act.type == "retweet" or act.type == "repost":
-                        user.repost(msg.origin_id())
-                    if act.type == "retweet" or act.type == "repost":
-                        with env.lock_message:
-                            env.id2message[msg.origin_id()].reposted_by.append((user.id, datetime_to_str(env.now)))
-                            message = Message(id=str(len(env.messages)), type="repost", text=msg.text, author_id=user.id, timestamp=env.now, quote_id=msg.origin_id())
-                            env.add_message(message)
-                    if act.type == "like":
-                        with env.lock_message:
-                            env.id2message[msg.origin_id()].liked_by.append((user.id, datetime_to_str(env.now)))
-                    env.log_act(user, msg, act)
+                    self._record_react(user, env, msg, act)
         # Step 3：用户发布新内容
         previous_posts = [hist["text"] for hist in data.get_history_by_time(user.id, time_end=conf["time_init_end"]) if hist["type"] == "post"][-3:]
         acts = user.agent.generate(env.now, previous_posts=previous_posts)
         for act in acts:
-            with env.lock_message:
-                message = Message(id=str(len(env.messages)), type="post", text=act.text, author_id=user.id, timestamp=env.now)
-                env.add_message(message)
-                user.post(message.id)
-                env.log_act(user, message, act)
-                get_logger().info(f"User {user.id} post: {act.text} at {env.now}")
+            self._record_post(user, env, act)
+
+
+    async def _arecord_reacts(self, user: User, env: Environment, msg: Message, acts: List[Act]):
+        embed_model = env.recommender.embed_model
+        for act in acts:
+            embed = None
+            if act.type == "retweet" or act.type == "repost":
+                # 在锁外异步计算转发消息的 embedding
+                with usage_scope(call_site="message"):
+                    embed = await embed_model.aembed_query(msg.text)
+            self._record_react(user, env, msg, act, embed)
+
+    async def asimulate_user(self, user: User, env: Environment, data: Data, conf: dict, msgs: List[Message] = None, memories_retrieved=None):
+        """
+        Async version of `simulate_user`, driven by the async LLM backend.
+        """
+        # Step 1：为用户分发消息（asimulate_step 中已为所有活跃用户分发好）
+        if msgs is None:
+            msgs = env.distribute_messages_for_user_by_time(user, str_to_datetime(sub_interval(datetime_to_str(env.now), conf["time_intv"])), env.now)
+        get_logger().info(f"User {user.id} read {len(msgs)} messages at {env.now}. Messages from {sub_interval(datetime_to_str(env.now), conf['time_intv'])} to {env.now}")
+        # Step 2：用户对消息做出反应
+        if conf["react_strategy"] == "one": # 一次对一条消息做出反应
+            for msg in msgs:
+                acts = await user.aread_post(msg.text, env.now)
+                await self._arecord_reacts(user, env, msg, acts)
+        elif conf["react_strategy"] == "batch": # 批量对消息做出反应，兼顾效率和准确性
+            actss = await user.aread_posts([msg.text for msg in msgs], env.now, memories_retrieved)
+            for i, msg in enumerate(msgs):
+                await self._arecord_reacts(user, env, msg, actss[i])
+        # Step 3：用户发布新内容
+        previous_posts = [hist["text"] for hist in data.get_history_by_time(user.id, time_end=conf["time_init_end"]) if hist["type"] == "post"][-3:]
+        acts = await user.agent.agenerate(env.now, previous_posts=previous_posts)
+        for act in acts:
+            with usage_scope(call_site="message"):
+                embed = await env.recommender.embed_model.aembed_query(act.text)
+            self._record_post(user, env, act, embed)
+
+
+    async def asimulate_step(self, time_step):
+        # 所有用户的请求在同一个事件循环中并发，由 LLMManager 的 max_inflight 限制同时在途的请求数
+        if time_step[-8:] == "00:00:00":
+            await asyncio.gather(*[bind_user(user.id, user.agent.amake_plan)(self.env.now) for user in self.env.users])
+        users_active = []
+        for user in self.env.users:
+            for intv in user.agent.plan.plan:
+                if user.agent.plan.within_intv(intv, time_step):
+                    get_logger().info(f"User {user.id} is active at {time_step}. Plan: {intv} in {user.agent.plan.plan}")
+                    users_active.append(user)
+                    break
+        # 本步所有活跃用户的推荐一次批量算好（时间窗口与 simulate_user 中分发消息的窗口相同）
+        self.env.recommend_all(users_active, str_to_datetime(sub_interval(datetime_to_str(self.env.now), self.conf["time_intv"])), self.env.now)
+        msgs_of = self._distribute(users_active)
+        memories_of = await self._aprefetch_memories(users_active, msgs_of)
+        results = await asyncio.gather(*[
+            bind_user(user.id, self.asimulate_user)(user, self.env, self.data, self.conf, msgs_of[user.id], memories_of.get(user.id))
+            for user in users_active
+        ], return_exceptions=True)
+        for user, result in zip(users_active, results):
+            if isinstance(result, Exception):
+                get_logger().error(f"Error in simulating user {user.id} at {time_step}: {result}")
 
 
     def simulate_step(self, time_step):
@@ -233,27 +358,49 @@ class Simulator:
             with ThreadPoolExecutor(max_workers=self.conf["max_workers"]) as executor:
                 for user in self.env.users:
                     # user.agent.make_plan(self.env.now)
-                    executor.submit(user.agent.make_plan, self.env.now)
+                    executor.submit(bind_user(user.id, user.agent.make_plan), self.env.now)
+        users_active = []
+        for user in self.env.users:
+            # 检查time_step是否在agent.plan活跃时间范围内
+            for intv in user.agent.plan.plan:
+                if user.agent.plan.within_intv(intv, time_step):
+                    get_logger().info(f"User {user.id} is active at {time_step}. Plan: {intv} in {user.agent.plan.plan}")
+                    users_active.append(user)
+                    break
+        # 本步所有活跃用户的推荐一次批量算好（时间窗口与 simulate_user 中分发消息的窗口相同）
+        self.env.recommend_all(users_active, str_to_datetime(sub_interval(datetime_to_str(self.env.now), self.conf["time_intv"])), self.env.now)
+        msgs_of = self._distribute(users_active)
+        memories_of = self._prefetch_memories(users_active, msgs_of)
         with ThreadPoolExecutor(max_workers=self.conf["max_workers"]) as executor:
-            for user in self.env.users:
-                # 检查time_step是否在agent.plan活跃时间范围内
-                for intv in user.agent.plan.plan:
-                    if user.agent.plan.within_intv(intv, time_step):
-                        get_logger().info(f"User {user.id} is active at {time_step}. Plan: {intv} in {user.agent.plan.plan}")
-                        # self.simulate_user(user, self.env, self.data, self.conf)
-                        executor.submit(self.simulate_user, user, self.env, self.data, self.conf)
-                        break
+            for user in users_active:
+                # self.simulate_user(user, self.env, self.data, self.conf)
+                executor.submit(bind_user(user.id, self.simulate_user), user, self.env, self.data, self.conf, msgs_of[user.id], memories_of.get(user.id))
 
 
     def simulate(self):
         intv = self.conf["interval"]
         time_step = self.env.now.strftime(TIME_FORMAT)
         time_end = self.conf["time_sim_end"]
+        # 异步模式下整个模拟共用一个事件循环，异步客户端的 keep-alive 连接跨步复用，结束时关闭
+        loop = asyncio.new_event_loop() if "async" in self.conf and self.conf["async"] else None
+        try:
+            self._simulate(loop, intv, time_step, time_end)
+        finally:
+            if loop is not None:
+                loop.run_until_complete(LLMManager.aclose())
+                loop.run_until_complete(loop.shutdown_asyncgens())
+                loop.close()
+
+    def _simulate(self, loop: asyncio.AbstractEventLoop, intv: str, time_step: str, time_end: str):
         while time_step < time_end:
             get_logger().info(f"Simulating at {time_step}.")
             print(f"Simulating at {time_step}.")
+            get_usage_tracker().set_step(time_step)
             with mock_now(self.env.now):
-                self.simulate_step(time_step)
+                if loop is not None:
+                    loop.run_until_complete(self.asimulate_step(time_step))
+                else:
+                    self.simulate_step(time_step)
             # 更新环境时间
             time_step = add_interval(time_step, intv)
             self.env.update_time(str_to_datetime(time_step), intv)
@@ -268,8 +415,11 @@ class Simulator:
                     model_dict = {
                         "env": self.env.save_to_dict(save_path),
                     }
+                    if get_shared_memory_store() is not None:
+                        model_dict["memory_store"] = get_shared_memory_store().save(save_path)
                     json.dump(model_dict, f, indent=4)
                 get_logger().info(f"Model saved to {save_path}")
+                self._log_stats(save_path)
 
 
 if __name__ == "__main__":
@@ -308,6 +458,27 @@ if __name__ == "__main__":
 
     # Set LLMManager
     LLMManager.set_manager(conf["llm"])
+    # 记忆总结在后台线程池中完成，不占用 agent 每一步的关键路径
+    if "deferred_memory" in conf and conf["deferred_memory"]:
+        set_memory_summarizer(MemorySummarizer(**conf["deferred_memory"]) if isinstance(conf["deferred_memory"], dict) else MemorySummarizer())
+    # 只有阅读、没有互动的批次按模板写入记忆，不调用 LLM
+    if "template_memory" in conf and conf["template_memory"]:
+        set_template_memory(TemplateMemory(**conf["template_memory"]) if isinstance(conf["template_memory"], dict) else TemplateMemory())
+    # 记忆检索使用基于 NumPy 数组的原生检索器，代替 LangChain 的 TimeWeightedVectorStoreRetriever（默认关闭）
+    set_native_retriever(conf["native_memory"] if "native_memory" in conf else False)
+    # 每个 agent 的记忆数超过预算时把旧记忆整合成周期总结（需要原生检索器或共享记忆库）
+    if "memory_budget" in conf and conf["memory_budget"]:
+        set_memory_budget(MemoryBudget(**conf["memory_budget"]) if isinstance(conf["memory_budget"], dict) else MemoryBudget())
+    # 消息数超过阈值后推荐器用 FAISS ANN 索引取兴趣候选（需在创建 Environment 之前设置）
+    if "ann" in conf and conf["ann"]:
+        set_ann_backend(ANNBackend(**conf["ann"]) if isinstance(conf["ann"], dict) else ANNBackend())
+    # 关注内容的读取方式：fan_out 写入时推送到关注者收件箱，limit 限制每次读取的关注消息数（需在创建 Environment 之前设置）
+    if "follow_feed" in conf and conf["follow_feed"]:
+        set_follow_feed(FollowFeed(**conf["follow_feed"]) if isinstance(conf["follow_feed"], dict) else FollowFeed())
+    # 所有 agent 的记忆放在同一个分区向量库中（加载 checkpoint 时由 Simulator 从 checkpoint 中恢复）
+    if "shared_memory" in conf and conf["shared_memory"] and not ("load_model" in conf and conf["load_model"]):
+        embed_size, embed_model = LLMManager.get_embed_model()
+        set_shared_memory_store(SharedMemoryStore(embed_size, **conf["shared_memory"]) if isinstance(conf["shared_memory"], dict) else SharedMemoryStore(embed_size))
 
     # Simulation
     simulator = Simulator(conf)
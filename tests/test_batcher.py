@@ -0,0 +1,35 @@
+import pytest
+from asn.llm.batcher import EmbedBatcher
+
+
+def test_batches_concurrent_requests():
+    calls = []
+    def embed_batch(texts):
+        calls.append(list(texts))
+        return [[float(len(text))] for text in texts]
+    batcher = EmbedBatcher(embed_batch, max_batch=8, max_wait_ms=50)
+    futures = [batcher.submit(text) for text in ["a", "bb", "a", "ccc"]]
+    assert [future.result(timeout=5) for future in futures] == [[1.0], [2.0], [1.0], [3.0]]
+    # 相同文本在同一批次中只请求一次
+    assert sum(len(texts) for texts in calls) == 3
+    assert batcher.stats()["requests"] == 4
+
+
+def test_short_response_fails_every_waiter():
+    def embed_batch(texts):
+        return [[0.0]] * (len(texts) - 1)
+    batcher = EmbedBatcher(embed_batch, max_batch=8, max_wait_ms=50)
+    futures = [batcher.submit(text) for text in ["a", "b", "c"]]
+    for future in futures:
+        with pytest.raises(ValueError, match="Expected 3 embeddings, got 2"):
+            future.result(timeout=5)
+
+
+def test_error_fails_every_waiter():
+    def embed_batch(texts):
+        raise RuntimeError("server down")
+    batcher = EmbedBatcher(embed_batch, max_batch=8, max_wait_ms=50)
+    futures = [batcher.submit(text) for text in ["a", "a", "b"]]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="server down"):
+            future.result(timeout=5)
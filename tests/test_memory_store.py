@@ -0,0 +1,88 @@
+import zlib
+import warnings
+import numpy as np
+import faiss
+from datetime import datetime, timedelta
+from langchain_core.embeddings import Embeddings
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from langchain_community.docstore import InMemoryDocstore
+from langchain.retrievers import TimeWeightedVectorStoreRetriever
+from asn.agent.retriever import NativeMemoryRetriever
+from asn.agent.memory_store import SharedMemoryStore, SharedMemoryRetriever, fetch_many
+
+warnings.filterwarnings("ignore")
+
+DIM = 8
+TIME_START = datetime(2024, 3, 1)
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic random embeddings seeded by the text, no server needed."""
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return np.random.default_rng(zlib.crc32(text.encode())).normal(size=DIM).tolist()
+
+
+def _memories(n: int, prefix: str = "m"):
+    return [(Document(page_content=f"{prefix}{i}", metadata={"created_at": TIME_START + timedelta(hours=i)}), TIME_START + timedelta(hours=i)) for i in range(n)]
+
+
+def _contents(documents):
+    return [document.page_content for document in documents]
+
+
+def test_native_and_shared_rank_like_faiss():
+    # 没有时间衰减时三者的排序只由相关度决定，应完全一致
+    embeddings = HashEmbeddings()
+    faiss_retriever = TimeWeightedVectorStoreRetriever(
+        vectorstore=FAISS(embeddings, faiss.IndexFlatIP(DIM), InMemoryDocstore(), {}, normalize_L2=True),
+        decay_rate=0.0, k=5, search_kwargs={"k": 20})
+    native = NativeMemoryRetriever(embeddings, DIM, k=5, decay_rate=0.0, search_k=20)
+    shared = SharedMemoryRetriever(SharedMemoryStore(DIM), embeddings, k=5, decay_rate=0.0, search_k=20)
+    for document, created_at in _memories(60):
+        for retriever in (faiss_retriever, native, shared):
+            retriever.add_documents([document], current_time=created_at)
+    for query in [f"q{j}" for j in range(30)]:
+        expected = _contents(faiss_retriever.invoke(query))
+        assert len(expected) == 5
+        assert _contents(native.invoke(query, TIME_START)) == expected
+        assert _contents(shared.invoke(query, TIME_START)) == expected
+
+
+def test_shared_ranks_like_native_with_decay():
+    embeddings = HashEmbeddings()
+    now = TIME_START + timedelta(days=3)
+    native = NativeMemoryRetriever(embeddings, DIM, k=5, decay_rate=0.01, search_k=20)
+    shared = SharedMemoryRetriever(SharedMemoryStore(DIM), embeddings, k=5, decay_rate=0.01, search_k=20)
+    for document, created_at in _memories(60):
+        native.add_documents([document], current_time=created_at)
+        shared.add_documents([document], current_time=created_at)
+    for query in [f"q{j}" for j in range(30)]:
+        assert _contents(shared.invoke(query, now)) == _contents(native.invoke(query, now))
+
+
+def _shared_retrievers(embeddings):
+    store = SharedMemoryStore(DIM, capacity=4)
+    retrievers = [SharedMemoryRetriever(store, embeddings, k=3, decay_rate=0.01, search_k=10) for _ in range(4)]
+    for i, retriever in enumerate(retrievers):
+        for document, created_at in _memories(10 + i, prefix=f"a{i}-"):
+            retriever.add_documents([document], current_time=created_at)
+    return retrievers
+
+
+def test_partitions_are_isolated_and_batched_search_matches():
+    # 检索会更新访问时间，批量检索和逐个检索各用一份相同的存储
+    embeddings = HashEmbeddings()
+    batched_retrievers, retrievers = _shared_retrievers(embeddings), _shared_retrievers(embeddings)
+    now = TIME_START + timedelta(days=1)
+    queries = [f"q{i}" for i in range(len(retrievers))]
+    batched = fetch_many(batched_retrievers, queries, now)
+    for i, (retriever, query) in enumerate(zip(retrievers, queries)):
+        single = _contents(retriever.invoke(query, now))
+        assert _contents(batched[i]) == single
+        # 每个 agent 只能检索到自己分区的记忆
+        assert all(content.startswith(f"a{i}-") for content in single)
+        assert len(retriever) == 10 + i
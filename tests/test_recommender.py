@@ -0,0 +1,95 @@
+import random
+import numpy as np
+import pytest
+from datetime import datetime, timedelta
+from asn.llm.llm import LLMManager
+from asn.env.ann import ANNBackend
+from asn.env.environment import User, Message
+from asn.env.recommender import Recommender
+
+DIM = 16
+TIME_START = datetime(2024, 2, 1)
+TIME_NOW = TIME_START + timedelta(days=10)
+
+
+class FakeEmbedModel:
+    """Only the embedding size is used; messages come with their embeddings."""
+    def embed_size(self) -> int:
+        return DIM
+
+
+@pytest.fixture
+def recommender(monkeypatch):
+    monkeypatch.setattr(LLMManager, "embed_model", FakeEmbedModel(), raising=False)
+    monkeypatch.setattr("asn.env.ann.ANN_BACKEND", None)
+    return Recommender(capacity=16)
+
+
+def _fill(recommender: Recommender, n: int, seed: int = 0):
+    # 随机的原始消息和转发，部分消息被点赞
+    rng = np.random.default_rng(seed)
+    messages = []
+    for i in range(n):
+        quote_id = messages[int(rng.integers(0, i))].origin_id() if i > 10 and rng.random() < 0.2 else None
+        message = Message(str(i), "repost" if quote_id else "post", "text", int(rng.integers(0, 20)), TIME_START + timedelta(minutes=int(rng.integers(0, 14400))), quote_id=quote_id)
+        message.embed = rng.normal(size=DIM).tolist()
+        recommender.add(message)
+        messages.append(message)
+    origins = [message for message in messages if message.origin_id() == message.id]
+    likes = random.Random(seed)
+    for _ in range(n // 2):
+        recommender.like(likes.choice(origins))
+    return messages, origins
+
+
+def _users(origins, n: int = 12, seed: int = 0):
+    # 各种情况：没有喜欢的帖子、没有交互过的帖子、喜欢的帖子不在候选中
+    rng = random.Random(seed)
+    users, interacted_ids = [], []
+    for i in range(n):
+        user = User(i, {}, None, {})
+        for message in rng.sample(origins, i * 2):
+            user.like(message.id)
+        users.append(user)
+        interacted_ids.append(set(message.id for message in rng.sample(origins, rng.randint(0, 30))) | set(user.get_like_ids()))
+    return users, interacted_ids
+
+
+def _assert_batch_equals_single(recommender, users, interacted_ids, messages=None, top_k: int = 10):
+    batch = recommender.recommend_all(users, messages, top_k=top_k, interacted_ids=interacted_ids, time_now=TIME_NOW, chunk_users=5)
+    assert set(batch.keys()) == set(user.id for user in users)
+    for user, ids in zip(users, interacted_ids):
+        single = recommender.recommend(user, messages, top_k=top_k, interacted_ids=ids, time_now=TIME_NOW)
+        assert set(batch[user.id]) == set(single)
+        assert len(single) <= top_k
+
+
+def test_recommend_all_equals_recommend(recommender):
+    _, origins = _fill(recommender, 500)
+    users, interacted_ids = _users(origins)
+    _assert_batch_equals_single(recommender, users, interacted_ids)
+    _assert_batch_equals_single(recommender, users, interacted_ids, top_k=7)
+
+
+def test_recommend_all_equals_recommend_in_window(recommender):
+    messages, origins = _fill(recommender, 500)
+    window = [message for message in messages if message.timestamp >= TIME_NOW - timedelta(days=2)]
+    users, interacted_ids = _users(origins)
+    _assert_batch_equals_single(recommender, users, interacted_ids, window)
+
+
+def test_recommend_all_without_interactions(recommender):
+    _, origins = _fill(recommender, 200)
+    users, _ = _users(origins, n=4)
+    batch = recommender.recommend_all(users, top_k=10, time_now=TIME_NOW)
+    for user in users:
+        assert set(batch[user.id]) == set(recommender.recommend(user, top_k=10, interacted_ids=[], time_now=TIME_NOW))
+
+
+def test_recommend_all_equals_recommend_with_ann(recommender, monkeypatch):
+    monkeypatch.setattr("asn.env.ann.ANN_BACKEND", ANNBackend(kind="hnsw", threshold=300, candidates=64, recent=50))
+    _, origins = _fill(recommender, 600)
+    recommender.ann_builder.join(10)
+    assert recommender.ann is not None and len(recommender.ann) == 600
+    users, interacted_ids = _users(origins)
+    _assert_batch_equals_single(recommender, users, interacted_ids)
@@ -0,0 +1,49 @@
+import zlib
+import warnings
+import numpy as np
+import faiss
+from datetime import datetime, timedelta
+from langchain_core.embeddings import Embeddings
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from langchain_community.docstore import InMemoryDocstore
+from langchain.retrievers import TimeWeightedVectorStoreRetriever
+from asn.agent.retriever import NativeMemoryRetriever
+
+warnings.filterwarnings("ignore")
+
+DIM = 8
+TIME_START = datetime(2024, 3, 1)
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic random embeddings seeded by the text, no server needed."""
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return np.random.default_rng(zlib.crc32(text.encode())).normal(size=DIM).tolist()
+
+
+def _memories(n: int, prefix: str = "m"):
+    return [(Document(page_content=f"{prefix}{i}", metadata={"created_at": TIME_START + timedelta(hours=i)}), TIME_START + timedelta(hours=i)) for i in range(n)]
+
+
+def _contents(documents):
+    return [document.page_content for document in documents]
+
+
+def test_native_ranks_like_faiss():
+    # 没有时间衰减时两者的排序只由相关度决定，应完全一致
+    embeddings = HashEmbeddings()
+    faiss_retriever = TimeWeightedVectorStoreRetriever(
+        vectorstore=FAISS(embeddings, faiss.IndexFlatIP(DIM), InMemoryDocstore(), {}, normalize_L2=True),
+        decay_rate=0.0, k=5, search_kwargs={"k": 20})
+    native = NativeMemoryRetriever(embeddings, DIM, k=5, decay_rate=0.0, search_k=20)
+    for document, created_at in _memories(60):
+        for retriever in (faiss_retriever, native):
+            retriever.add_documents([document], current_time=created_at)
+    for query in [f"q{j}" for j in range(30)]:
+        expected = _contents(faiss_retriever.invoke(query))
+        assert len(expected) == 5
+        assert _contents(native.invoke(query, TIME_START)) == expected
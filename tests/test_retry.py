@@ -0,0 +1,82 @@
+import time
+import asyncio
+import pytest
+from asn.llm.retry import RetryPolicy, LLMUnavailableError, CircuitOpenError
+
+
+class Flaky:
+    """Fails the first `failures` calls, then returns "ok"."""
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ConnectionError("server down")
+        return "ok"
+
+    async def acall(self):
+        return self()
+
+
+def test_retries_until_success():
+    policy = RetryPolicy(max_attempts=5, base_delay=0.001, max_delay=0.001)
+    fn = Flaky(2)
+    assert policy.call(fn) == "ok"
+    assert fn.calls == 3
+    assert policy.stats()["retries"] == 2
+    assert policy.stats()["circuit"]["state"] == "closed"
+
+
+def test_gives_up_after_max_attempts():
+    policy = RetryPolicy(max_attempts=3, base_delay=0.001, max_delay=0.001)
+    fn = Flaky(10)
+    with pytest.raises(LLMUnavailableError, match="Failed after 3 attempts"):
+        policy.call(fn)
+    assert fn.calls == 3
+    assert policy.stats()["failures"] == 1
+
+
+def test_deadline():
+    policy = RetryPolicy(max_attempts=1000, base_delay=0.05, max_delay=0.05, deadline=0.2, failure_threshold=1000)
+    fn = Flaky(1000)
+    time_start = time.time()
+    with pytest.raises(LLMUnavailableError, match="Deadline of 0.2 s exceeded"):
+        policy.call(fn)
+    assert time.time() - time_start < 0.2 + 0.1
+    assert fn.calls < 1000
+
+
+def test_deadline_async():
+    policy = RetryPolicy(max_attempts=1000, base_delay=0.05, max_delay=0.05, deadline=0.2, failure_threshold=1000)
+    fn = Flaky(1000)
+    with pytest.raises(LLMUnavailableError, match="Deadline of 0.2 s exceeded"):
+        asyncio.run(policy.acall(fn.acall))
+
+
+def test_breaker_open_fails_fast():
+    policy = RetryPolicy(max_attempts=2, base_delay=0.001, max_delay=0.001, deadline=1, failure_threshold=2, reset_timeout=10)
+    fn = Flaky(10)
+    with pytest.raises(LLMUnavailableError):
+        policy.call(fn)
+    assert policy.stats()["circuit"]["state"] == "open"
+    # 熔断期间的调用不发出请求，等待时间超过 deadline 时立即失败
+    calls = fn.calls
+    time_start = time.time()
+    with pytest.raises(CircuitOpenError):
+        policy.call(fn)
+    assert fn.calls == calls
+    assert time.time() - time_start < 0.1
+
+
+def test_breaker_half_open_trial_closes_circuit():
+    policy = RetryPolicy(max_attempts=2, base_delay=0.001, max_delay=0.001, deadline=5, failure_threshold=2, reset_timeout=0.1)
+    fn = Flaky(2)
+    with pytest.raises(LLMUnavailableError):
+        policy.call(fn)
+    assert policy.stats()["circuit"]["state"] == "open"
+    # reset_timeout 之后放行一个试探请求，成功后熔断器关闭
+    assert policy.call(fn) == "ok"
+    assert fn.calls == 3
+    assert policy.stats()["circuit"] == {"state": "closed", "consecutive_failures": 0, "opens": 1}
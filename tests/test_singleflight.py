@@ -0,0 +1,87 @@
+import time
+import asyncio
+import threading
+import pytest
+from asn.llm.singleflight import SingleFlight
+
+
+def test_collapses_concurrent_calls():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "result"
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("key", fn)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("key", fn))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while flight.stats()["collapsed"] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+    assert results == ["result"] * 4
+    assert len(calls) == 1
+    assert flight.stats() == {"calls": 4, "collapsed": 3, "collapse_rate": 0.75, "inflight": 0}
+
+
+def test_error_is_shared():
+    flight = SingleFlight()
+    async def main():
+        async def fn():
+            await asyncio.sleep(0.05)
+            raise ConnectionError("server down")
+        return await asyncio.gather(*[flight.ado("key", fn) for _ in range(3)], return_exceptions=True)
+    results = asyncio.run(main())
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert flight.stats()["collapsed"] == 2
+
+
+def test_leader_cancelled_followers_rejoin():
+    flight = SingleFlight()
+    calls = []
+    async def main():
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return "result"
+        leader = asyncio.create_task(flight.ado("key", fn))
+        await asyncio.sleep(0.01)
+        followers = [asyncio.create_task(flight.ado("key", fn)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(*followers)
+    # leader 被取消不会传给等待者，其中一个重新发出请求
+    assert asyncio.run(main()) == ["result"] * 3
+    assert len(calls) == 2
+    assert flight.stats() == {"calls": 4, "collapsed": 3, "collapse_rate": 0.75, "inflight": 0}
+
+
+def test_follower_cancelled_does_not_affect_others():
+    flight = SingleFlight()
+    calls = []
+    async def main():
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return "result"
+        leader = asyncio.create_task(flight.ado("key", fn))
+        await asyncio.sleep(0.01)
+        followers = [asyncio.create_task(flight.ado("key", fn)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        followers[0].cancel()
+        results = await asyncio.gather(leader, *followers, return_exceptions=True)
+        return results
+    results = asyncio.run(main())
+    assert isinstance(results[1], asyncio.CancelledError)
+    assert results[0] == results[2] == "result"
+    assert len(calls) == 1